@@ -0,0 +1,177 @@
+# asyncio_staged_pipeline.py
+# Runs items through a sequence of stages that work at the same time, connected by bounded queues.
+# The items come from a source iterator (the first stage), and each stage has a number of tasks that take items from
+# its input queue, call the stage function in the stage's own thread pool (so blocking file system calls don't hold
+# up the other stages) and put the items that the function returns on the next stage's queue. A full queue makes the
+# stage before it wait (back-pressure), so no more than the queue size of items are ever waiting between two stages.
+# Each stage keeps statistics of how busy it was and how deep its input queue got, which show the stage that limits
+# the throughput of the pipeline.
+# Requires Python 3.7 or later. Used by fairfax-pre-and-post-process-grouper.py.
+
+import asyncio
+import concurrent.futures
+import time
+
+END_OF_ITEMS = object()
+
+
+class StageStatistics:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+        self.output_wait_count = 0
+        self.queue_depth_total = 0
+        self.queue_depth_samples = 0
+        self.queue_depth_maximum = 0
+
+    def sample_queue_depth(self, queue_depth):
+        self.queue_depth_total += queue_depth
+        self.queue_depth_samples += 1
+        self.queue_depth_maximum = max(self.queue_depth_maximum, queue_depth)
+
+    def mean_queue_depth(self):
+        if self.queue_depth_samples == 0:
+            return 0.0
+        return float(self.queue_depth_total) / self.queue_depth_samples
+
+    # The fraction of the elapsed time that the stage's tasks were calling the stage function
+    def utilisation(self, elapsed_seconds):
+        if elapsed_seconds <= 0:
+            return 0.0
+        return self.busy_seconds / (self.concurrency * elapsed_seconds)
+
+
+class PipelineStage:
+    # stage_function takes one item and returns an iterable of the items for the next stage (which can be empty)
+    def __init__(self, name, stage_function, concurrency=1):
+        if concurrency < 1:
+            raise ValueError("stage=" + name + " concurrency=" + str(concurrency) + " must be at least 1")
+        self.name = name
+        self.stage_function = stage_function
+        self.concurrency = concurrency
+        self.statistics = StageStatistics(name, concurrency)
+
+    def outputs(self, item):
+        return list(self.stage_function(item))
+
+
+class StagedPipeline:
+    # The items that the last stage returns are passed to sink (on the event loop's thread, so sink doesn't need to be
+    # thread-safe)
+    def __init__(self, source_name, source_items, stages, queue_size, sink=None):
+        if queue_size < 1:
+            raise ValueError("queue_size=" + str(queue_size) + " must be at least 1")
+        self.source_iterator = iter(source_items)
+        self.source_statistics = StageStatistics(source_name, 1)
+        self.stages = stages
+        self.queue_size = queue_size
+        self.sink = sink
+        self.elapsed_seconds = 0.0
+
+    def run(self):
+        started = time.time()
+        try:
+            asyncio.run(self.run_stages())
+        finally:
+            self.elapsed_seconds = time.time() - started
+
+    def all_statistics(self):
+        return [self.source_statistics] + [stage.statistics for stage in self.stages]
+
+    # The stage whose tasks were busy for the largest fraction of the elapsed time
+    def limiting_statistics(self):
+        return max(self.all_statistics(), key=lambda statistics: statistics.utilisation(self.elapsed_seconds))
+
+    async def run_stages(self):
+        source_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        stage_executors = [concurrent.futures.ThreadPoolExecutor(max_workers=stage.concurrency)
+                           for stage in self.stages]
+        queues = [asyncio.Queue(maxsize=self.queue_size) for stage in self.stages]
+
+        tasks = [asyncio.ensure_future(self.feed(queues[0], self.stages[0].concurrency, source_executor))]
+        for stage_index, stage in enumerate(self.stages):
+            if stage_index + 1 < len(self.stages):
+                output_queue = queues[stage_index + 1]
+                output_concurrency = self.stages[stage_index + 1].concurrency
+            else:
+                output_queue = None
+                output_concurrency = 0
+            # The last of the stage's tasks to finish tells the next stage that there are no more items
+            remaining_tasks = [stage.concurrency]
+            for task_index in range(stage.concurrency):
+                tasks.append(asyncio.ensure_future(self.run_stage_task(
+                    stage, queues[stage_index], output_queue, output_concurrency, remaining_tasks,
+                    stage_executors[stage_index])))
+
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Calls that are already running in the thread pools can't be cancelled, so they're waited for
+            for executor in [source_executor] + stage_executors:
+                executor.shutdown(wait=True)
+            close_source = getattr(self.source_iterator, "close", None)
+            if close_source is not None:
+                close_source()
+
+    async def feed(self, output_queue, output_concurrency, source_executor):
+        loop = asyncio.get_running_loop()
+        statistics = self.source_statistics
+        while True:
+            started = time.time()
+            item = await loop.run_in_executor(source_executor, next, self.source_iterator, END_OF_ITEMS)
+            statistics.busy_seconds += time.time() - started
+            if item is END_OF_ITEMS:
+                break
+            statistics.items_out += 1
+            await self.put(output_queue, item, statistics)
+        for task_index in range(output_concurrency):
+            await output_queue.put(END_OF_ITEMS)
+
+    async def run_stage_task(self, stage, input_queue, output_queue, output_concurrency, remaining_tasks,
+                             stage_executor):
+        loop = asyncio.get_running_loop()
+        statistics = stage.statistics
+        while True:
+            statistics.sample_queue_depth(input_queue.qsize())
+            started = time.time()
+            item = await input_queue.get()
+            statistics.input_wait_seconds += time.time() - started
+            if item is END_OF_ITEMS:
+                break
+            statistics.items_in += 1
+
+            started = time.time()
+            output_items = await loop.run_in_executor(stage_executor, stage.outputs, item)
+            statistics.busy_seconds += time.time() - started
+
+            for output_item in output_items:
+                statistics.items_out += 1
+                if output_queue is not None:
+                    await self.put(output_queue, output_item, statistics)
+                elif self.sink is not None:
+                    self.sink(output_item)
+
+        remaining_tasks[0] -= 1
+        if remaining_tasks[0] == 0 and output_queue is not None:
+            for task_index in range(output_concurrency):
+                await output_queue.put(END_OF_ITEMS)
+
+    @staticmethod
+    async def put(queue, item, statistics):
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+        started = time.time()
+        await queue.put(item)
+        statistics.output_wait_seconds += time.time() - started
+        statistics.output_wait_count += 1
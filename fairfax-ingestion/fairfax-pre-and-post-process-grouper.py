@@ -12,18 +12,85 @@
 # Requires source_folder, target_pre_process_folder, target_post_process_folder, for_review_folder.
 # Uses starting_date, ending_date.
 # One or the other: do_pre_processing, do_post_processing
-# Optional create_targets, move_files, verbose, test.
+# Optional create_targets, move_files, verbose, test, benchmark.
 
 import argparse
+import array
+import collections
+import contextlib
 import datetime
+import errno
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import platform
+import shutil
+import signal
+import socket
+import stat
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
+
+try:
+    import concurrent.futures
+except ImportError:
+    # Python 2.7 only has concurrent.futures when the 'futures' backport is installed
+    concurrent = None
+
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2.7
+    lru_cache = None
+
+try:
+    intern_string = sys.intern
+except AttributeError:
+    # Python 2.7
+    intern_string = intern
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    # Python 3.9 and later only have xml.etree.ElementTree, which uses the C accelerator when it's available
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on all platforms, in which case reflinks aren't available either
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2.7 only has scandir when the 'scandir' backport is installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# The directory crawler is shared by the scripts in this repository, and kept in the utilities folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "utilities"))
+from parallel_directory_crawler import CRAWL_MAXIMUM_PENDING_DIRECTORIES, ParallelDirectoryCrawler
 
-move_or_copy_flags = ""
 is_sun_os = False
 unacceptable_parameters = False
 source_folder = ""
@@ -35,6 +102,21 @@ ending_date = None
 
 create_targets = False
 move_files = False
+digest_cache = None
+post_process_index = None
+processing_journal = None
+processing_plan = None
+source_inventory = None
+resumed_journal_state = None
+# The devices whose file systems can't reflink (to the target file systems), so reflinks from them aren't tried again
+reflink_unsupported_devices = set()
+journal_units = threading.local()
+issue_batches = threading.local()
+
+processing_statistics = collections.OrderedDict()
+processing_statistics_lock = threading.Lock()
+# The statistics that are maximums rather than totals, so that the statistics of shards can be merged
+maximum_statistic_names = set()
 
 DATE_PARSE_FORMAT = "%Y%m%d"
 DATE_DISPLAY_FORMAT = "%Y-%m-%d"
@@ -59,21 +141,140 @@ FAIRFAX_PDF_FILE_FULL_REGEX_PATTERN = "(?<titleCode>[a-zA-Z0-9]{3,4})(?<editionC
                                       "-(?<date>\\d{8})-(?<sequenceLetter>[A-Za-z]{0,2})(?<sequenceNumber>\\d{1,4})" +\
                                       "(?<qualifier>.*?)\\.[pP]{1}[dD]{1}[fF]{1}"
 
+# Folders named <yyyyMMdd> or <titleCode>_<yyyyMMdd>
+DATED_FOLDER_NAME_REGEX_PATTERN = "^(?:.*_)?(?P<date>\\d{8})$"
+DATED_FOLDER_NAME_REGEX = re.compile(DATED_FOLDER_NAME_REGEX_PATTERN)
+
 EXISTS_IN_POST_PROCESSING_BUT_NOT_THE_SAME_FILE_FOLDER_NAME = "EXISTS-IN-POST-PROCESSING-BUT-NOT-THE-SAME-FILE"
 
-print("Python version: " + platform.python_version() + ", complete: " + str(sys.version_info))
+# md5 sums are calculated in-process. Files are read into a reused buffer, unless they are large enough that mapping
+# them into memory is cheaper than copying them through the buffer.
+MD5_READ_BUFFER_SIZE = 1024 * 1024
+MD5_MMAP_THRESHOLD_SIZE = 64 * 1024 * 1024
+
+# Files are compared by size first, then by their first and last blocks, and only then by their full md5 sums
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# There are only a few thousand distinct file dates, so the parsed dates of all of them are kept
+FILE_DATE_CACHE_SIZE = 100000
+
+# Cached digests are written to the digest cache in batches, as committing every digest would be slower than hashing
+DIGEST_CACHE_COMMIT_BATCH_SIZE = 500
+# Shards share the digest cache file, so each of them commits every write, and waits for the others' writes to finish
+DIGEST_CACHE_SHARD_COMMIT_BATCH_SIZE = 1
+DIGEST_CACHE_BUSY_TIMEOUT_SECONDS = 60.0
+DIGEST_CACHE_DEFAULT_MAX_AGE_DAYS = 365
+DIGEST_CACHE_DEFAULT_MAX_ENTRIES = 10000000
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Files are copied in-kernel where possible. These errors mean the kernel can't copy between the given files, in which
+# case the copy falls back to reading and writing through a buffer.
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+KERNEL_COPY_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Instead of copying, files can be hard linked or reflinked (sharing the source's data blocks until either is changed)
+# when the source and target are on the same file system. These errors mean the link can't be made, in which case the
+# file is copied instead.
+LINK_MODES = ["copy", "hardlink", "reflink", "auto"]
+LINK_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                           errno.EPERM, errno.EMLINK)
+# Of those, these errors mean no reflink can be made from the source's file system, rather than from a single file
+REFLINK_UNSUPPORTED_DEVICE_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP)
+# The Linux FICLONE ioctl, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Journal records are flushed as they are written, but only synced to disk in batches
+JOURNAL_FSYNC_BATCH_SIZE = 100
+JOURNAL_TAIL_SIZE = 4096
+
+# Each pre-process <date>/<title_code> folder can have a manifest of the files moved or copied into it
+ISSUE_MANIFEST_FILE_NAME = ".fairfax-grouper-manifest"
+
+# The number of post-processed issues whose mets.xml checksums are kept in memory
+METS_CHECKSUMS_CACHE_SIZE = 64
+# The digest algorithms used in mets.xml CHECKSUMTYPE attributes and Rosetta dnx fixityType keys, as hashlib names
+METS_CHECKSUM_ALGORITHMS = {"MD5": "md5", "SHA-1": "sha1", "SHA1": "sha1", "SHA-256": "sha256", "SHA256": "sha256",
+                            "SHA-512": "sha512", "SHA512": "sha512"}
+
+# Folders modified this recently before they are listed may still be changing, so their mtimes aren't kept in the
+# source inventory snapshot (and they are listed again in the next run)
+INVENTORY_RECENTLY_MODIFIED_SECONDS = 2.0
+
+# The defaults for watching the source folder: how often it is checked, how long a file must be unmodified before it
+# is processed, the most files processed in each batch, and how often the caches of folder contents are rebuilt
+WATCH_DEFAULT_INTERVAL_SECONDS = 60
+WATCH_DEFAULT_SETTLE_SECONDS = 60
+WATCH_DEFAULT_BATCH_SIZE = 1000
+WATCH_DEFAULT_CACHE_REFRESH_SECONDS = 600
+# When watching, the inventory snapshot is written at most this often (and when the watch stops), as each write is of
+# the whole snapshot
+WATCH_INVENTORY_SAVE_SECONDS = 600
+# How often the control socket's server checks whether it has been closed
+CONTROL_SOCKET_ACCEPT_TIMEOUT_SECONDS = 1.0
+
+# When post-processing with workers, the most 'done' folders waiting for each worker, and the number of locks that the
+# target folders are spread over (the same target folder always has the same lock)
+POST_PROCESS_PENDING_FOLDERS_PER_WORKER = 4
+TARGET_FOLDER_LOCK_COUNT = 256
+
+# How often the shard processes are checked on while waiting for their results
+SHARD_RESULT_POLL_SECONDS = 1.0
+
+# The stages of the pre-processing pipeline that follow scanning the source folder, the default number of tasks for
+# each of them and the default number of items that can wait between two stages
+PIPELINE_STAGE_NAMES = ["classify", "compare", "act"]
+PIPELINE_DEFAULT_CONCURRENCY = "classify=1,compare=8,act=4"
+PIPELINE_DEFAULT_QUEUE_SIZE = 256
+
+# The kinds of files in a FairfaxFileTable
+FILE_KIND_OTHER = 0
+FILE_KIND_PDF = 1
+FILE_KIND_DONE = 2
+FILE_KIND_METS_XML = 3
+
+# How paths are affected by the operations in a processing plan
+PLANNED_FILE = "file"
+PLANNED_FOLDER = "folder"
+PLANNED_REMOVED = "removed"
+PLAN_OPERATION_TYPES = ["mkdir", "move", "copy", "delete-file", "delete-folder"]
+PLAN_FOLDER_PARAMETER_NAMES = ["source_folder", "target_pre_process_folder", "target_post_process_folder",
+                               "for_review_folder"]
+
+BENCHMARK_MD5_NUMBER_OF_FILES = 200
+BENCHMARK_MD5_FILE_SIZE = 256 * 1024
+BENCHMARK_MOVE_OR_COPY_NUMBER_OF_FILES = 200
+BENCHMARK_MOVE_OR_COPY_FILE_SIZE = 256 * 1024
+BENCHMARK_FAIRFAX_FILE_NUMBER_OF_FILES = 100000
+BENCHMARK_FAIRFAX_FILE_NUMBER_OF_FOLDERS = 100
+BENCHMARK_CRAWL_DEEP_TREE_DEPTH = 6
+BENCHMARK_CRAWL_DEEP_TREE_BRANCHES = 3
+BENCHMARK_CRAWL_WIDE_TREE_FOLDERS = 500
+BENCHMARK_CRAWL_FILES_PER_FOLDER = 5
+BENCHMARK_CRAWL_THREADS = 16
+# Added to every directory listing to simulate the latency of a network file system
+BENCHMARK_CRAWL_LISTING_LATENCY_SECONDS = 0.002
 
+print("Python version: " + platform.python_version() + ", complete: " + str(sys.version_info))
 
-class FairfaxFile:
-    is_fairfax_pdf_file = False
-    is_done_file = False
-    is_mets_xml_file = False
-    is_other_file = False
 
-    def __init__(self, file_path):
-        self.file_name = os.path.basename(file_path)
-        self.dirname = os.path.dirname(file_path)
-        self.full_path = file_path
+# There can be millions of FairfaxFile instances, so they are kept compact: no per-instance __dict__, the dirname shared
+# (interned) between all the files in a folder, the full_path calculated when needed and the title_code, edition_code
+# and file dates shared between all the files with the same values.
+class FairfaxFile(object):
+    __slots__ = ["file_name", "dirname", "is_fairfax_pdf_file", "is_done_file", "is_mets_xml_file", "is_other_file",
+                 "title_code", "edition_code", "file_date_string", "file_date", "qualifier", "extension"]
+
+    def __init__(self, file_path, dirname=None, file_name=None):
+        if dirname is None:
+            dirname = os.path.dirname(file_path)
+            file_name = os.path.basename(file_path)
+        self.file_name = file_name
+        self.dirname = intern_string(dirname)
+        self.is_fairfax_pdf_file = False
+        self.is_done_file = False
+        self.is_mets_xml_file = False
+        self.is_other_file = False
         match = FAIRFAX_PDF_FILE_REGEX.search(self.file_name)
         if match is None:
             if self.file_name == "done":
@@ -84,18 +285,31 @@ class FairfaxFile:
                 self.is_other_file = True
         else:
             self.is_fairfax_pdf_file = True
-            self.title_code = match.group("titleCode")
-            self.edition_code = match.group("editionCode")
-            self.file_date_string = match.group("date")
-            self.file_date = convert_string_to_date(self.file_date_string)
+            title_code = match.group("titleCode")
+            edition_code = match.group("editionCode")
+            self.file_date_string = intern_string(match.group("date"))
+            self.file_date = convert_file_date_string_to_date(self.file_date_string)
             self.qualifier = match.group("qualifier")
-            self.extension = match.group("extension")
-            if len(self.title_code) == 4 and len(self.edition_code) == 2:
-                self.edition_code = self.title_code[3:4] + self.edition_code
-                self.title_code = self.title_code[0:3]
-
+            self.extension = intern_string(match.group("extension"))
+            if len(title_code) == 4 and len(edition_code) == 2:
+                edition_code = title_code[3:4] + edition_code
+                title_code = title_code[0:3]
+            self.title_code = intern_string(title_code)
+            self.edition_code = intern_string(edition_code)
+
+    @property
+    def full_path(self):
+        if not self.dirname:
+            return self.file_name
+        return os.path.join(self.dirname, self.file_name)
+
+    # Files are sorted in the order of their full paths. Most comparisons are between files in the same folder, which
+    # compare as (dirname, file_name) would without joining the full paths. Files in different folders still compare
+    # their full paths, as a folder 'b' sorts before 'b-c' but 'b/file' sorts after 'b-c/file'.
     def __lt__(self, other):
         if isinstance(other, FairfaxFile):
+            if self.dirname == other.dirname:
+                return self.file_name < other.file_name
             return self.full_path < other.full_path
         else:
             return self.full_path < other
@@ -119,6 +333,871 @@ class FairfaxFile:
             print("    extension=" + self.extension)
 
 
+# The same classification as FairfaxFile, but for a whole folder of file names at a time and kept as columns: the
+# folder, kind, date (as an ordinal) and title_code (as an index into title_codes) of each file are kept in arrays, and
+# only the file name is a separate object. Rows are the indexes of files in the table.
+class FairfaxFileTable:
+    def __init__(self):
+        self.folder_paths = []
+        self.folder_ids = array.array('l')
+        self.file_names = []
+        self.kinds = array.array('B')
+        self.date_ordinals = array.array('l')
+        self.title_ids = array.array('l')
+        self.title_codes = []
+        self.title_ids_by_code = {}
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def title_id(self, title_code):
+        title_id = self.title_ids_by_code.get(title_code)
+        if title_id is None:
+            title_id = len(self.title_codes)
+            self.title_codes.append(title_code)
+            self.title_ids_by_code[title_code] = title_id
+        return title_id
+
+    def add_folder(self, folder_path, file_names):
+        folder_id = len(self.folder_paths)
+        self.folder_paths.append(intern_string(folder_path))
+        kinds = array.array('B')
+        date_ordinals = array.array('l')
+        title_ids = array.array('l')
+        for file_name in file_names:
+            match = FAIRFAX_PDF_FILE_REGEX.search(file_name)
+            if match is None:
+                if file_name == "done":
+                    kinds.append(FILE_KIND_DONE)
+                elif file_name == "mets.xml":
+                    kinds.append(FILE_KIND_METS_XML)
+                else:
+                    kinds.append(FILE_KIND_OTHER)
+                date_ordinals.append(0)
+                title_ids.append(-1)
+            else:
+                title_code = match.group("titleCode")
+                if len(title_code) == 4 and len(match.group("editionCode")) == 2:
+                    title_code = title_code[0:3]
+                kinds.append(FILE_KIND_PDF)
+                date_ordinals.append(convert_file_date_string_to_date(match.group("date")).toordinal())
+                title_ids.append(self.title_id(title_code))
+        self.folder_ids.extend(itertools.repeat(folder_id, len(kinds)))
+        self.file_names.extend(file_names)
+        self.kinds.extend(kinds)
+        self.date_ordinals.extend(date_ordinals)
+        self.title_ids.extend(title_ids)
+
+    # The rows of the PDF files dated from starting_date to ending_date (inclusive)
+    def pdf_rows_in_date_range(self, starting_date, ending_date):
+        starting_ordinal = starting_date.toordinal()
+        ending_ordinal = ending_date.toordinal()
+        return array.array('l', itertools.compress(
+            range(len(self.kinds)), [kind == FILE_KIND_PDF and starting_ordinal <= date_ordinal <= ending_ordinal
+                                     for kind, date_ordinal in zip(self.kinds, self.date_ordinals)]))
+
+    # The rows sorted by date, then by file name
+    def rows_sorted_by_date(self, rows):
+        return array.array('l', sorted(rows, key=lambda row: (self.date_ordinals[row], self.file_names[row])))
+
+    # The rows grouped by issue (the same date and title_code), in the order each issue is first found
+    def rows_by_issue(self, rows):
+        issue_rows = collections.OrderedDict()
+        for row in rows:
+            issue_key = (self.date_ordinals[row], self.title_ids[row])
+            rows_for_issue = issue_rows.get(issue_key)
+            if rows_for_issue is None:
+                rows_for_issue = issue_rows[issue_key] = array.array('l')
+            rows_for_issue.append(row)
+        return issue_rows
+
+
+# Digests are keyed by the file's (device, inode) and are only valid while the file's size and mtime are unchanged.
+# With write-ahead logging, looking up digests doesn't wait for another process that is writing to the same file.
+class DigestCache:
+    def __init__(self, cache_path, max_age_days, max_entries, commit_batch_size=DIGEST_CACHE_COMMIT_BATCH_SIZE):
+        self.cache_path = cache_path
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.commit_batch_size = commit_batch_size
+        self.uncommitted_count = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, timeout=DIGEST_CACHE_BUSY_TIMEOUT_SECONDS,
+                                          check_same_thread=False)
+        if cache_path != ":memory:":
+            # A cache can lose its last few writes if the machine fails, so commits don't wait for the disk
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS digests (device INTEGER, inode INTEGER, size INTEGER, " +
+                                "mtime REAL, algorithm TEXT, digest TEXT, last_used REAL, " +
+                                "PRIMARY KEY (device, inode, algorithm))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)")
+        self.connection.commit()
+
+    def lookup(self, file_stat, algorithm="md5", count_misses=True):
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, digest FROM digests WHERE device=? AND inode=? AND " +
+                                          "algorithm=?", (file_stat.st_dev, file_stat.st_ino, algorithm)).fetchone()
+            if row is None or row[0] != file_stat.st_size or row[1] != file_stat.st_mtime:
+                if count_misses:
+                    increment_statistic("digest cache misses")
+                    if row is not None:
+                        increment_statistic("digest cache stale entries")
+                return None
+            self.connection.execute("UPDATE digests SET last_used=? WHERE device=? AND inode=? AND algorithm=?",
+                                    (time.time(), file_stat.st_dev, file_stat.st_ino, algorithm))
+            self.count_uncommitted()
+        increment_statistic("digest cache hits")
+        return row[2]
+
+    def store(self, file_stat, digest, algorithm="md5"):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO digests (device, inode, size, mtime, algorithm, digest, " +
+                                    "last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime,
+                                     algorithm, digest, time.time()))
+            self.count_uncommitted()
+
+    def count_uncommitted(self):
+        self.uncommitted_count += 1
+        if self.uncommitted_count >= self.commit_batch_size:
+            self.connection.commit()
+            self.uncommitted_count = 0
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.uncommitted_count = 0
+
+    def evict(self):
+        with self.lock:
+            oldest_last_used = time.time() - (self.max_age_days * SECONDS_PER_DAY)
+            evicted_count = self.connection.execute("DELETE FROM digests WHERE last_used < ?",
+                                                    (oldest_last_used,)).rowcount
+            evicted_count += self.connection.execute("DELETE FROM digests WHERE rowid NOT IN (SELECT rowid FROM " +
+                                                     "digests ORDER BY last_used DESC LIMIT ?)",
+                                                     (self.max_entries,)).rowcount
+            self.connection.commit()
+            self.uncommitted_count = 0
+        increment_statistic("digest cache evicted entries", evicted_count)
+
+    # Shards don't evict, as the process that started them evicts once they have all finished
+    def close(self, is_evicting=True):
+        if is_evicting:
+            self.evict()
+        else:
+            self.commit()
+        with self.lock:
+            self.connection.close()
+
+
+# Used in place of os.DirEntry when scandir is not available
+class ListedDirectoryEntry:
+    def __init__(self, directory_path, name):
+        self.name = name
+        self.path = os.path.join(directory_path, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+# An index of the files in the post-process content/streams folders. The folders for a title_code and year are scanned
+# once, the first time a file with that title_code and year is looked up. Only date folders between starting_date and
+# ending_date are scanned.
+class PostProcessIndex:
+    POST_PROCESS_TYPES = ["newspapers", "magazines"]
+
+    def __init__(self, post_processing_folder, first_date, last_date):
+        self.post_processing_folder = post_processing_folder
+        self.first_date = first_date
+        self.last_date = last_date
+        self.indexed_files = {}
+        self.lock = threading.Lock()
+
+    def index_title_code_year(self, post_process_type, title_code, year_string):
+        indexed_files = {}
+        year_folder = os.path.join(self.post_processing_folder, post_process_type, title_code, year_string)
+        if not os.path.isdir(year_folder):
+            return indexed_files
+        for date_entry in scan_directory(year_folder):
+            if not date_entry.is_dir() or not self.is_date_folder_in_range(date_entry.name):
+                continue
+            streams_folder = os.path.join(date_entry.path, "content", "streams")
+            if not os.path.isdir(streams_folder):
+                continue
+            known_directories.add(streams_folder)
+            increment_statistic("post-process index folders scanned")
+            for file_entry in scan_directory(streams_folder):
+                if file_entry.is_file():
+                    indexed_files[(date_entry.name, file_entry.name)] = (file_entry.path, file_entry.stat().st_size)
+
+        return indexed_files
+
+    def is_date_folder_in_range(self, date_folder_name):
+        try:
+            folder_date = datetime.datetime.strptime(date_folder_name, DATE_PARSE_FORMAT).date()
+        except ValueError:
+            # Not a date folder, so it can't be excluded by date
+            return True
+        return self.first_date <= folder_date <= self.last_date
+
+    # Returns the path and size of the post-processed file, or (None, None) if there is no post-processed file
+    def find(self, fairfax_file):
+        year_string = str(fairfax_file.file_date.year)
+        for post_process_type in PostProcessIndex.POST_PROCESS_TYPES:
+            index_key = (post_process_type, fairfax_file.title_code, year_string)
+            with self.lock:
+                indexed_files = self.indexed_files.get(index_key)
+                if indexed_files is None:
+                    indexed_files = self.index_title_code_year(post_process_type, fairfax_file.title_code,
+                                                               year_string)
+                    self.indexed_files[index_key] = indexed_files
+            indexed_file = indexed_files.get((fairfax_file.file_date_string, fairfax_file.file_name))
+            if indexed_file is not None:
+                return indexed_file
+
+        return None, None
+
+
+# The directories known to exist, from creating them or from listing them. Most files share their target folders with
+# the files before them, so the existence checks for those folders are done once rather than for every file. If a
+# known directory is removed by something else, the operation that fails because of it forgets it, creates it again
+# and retries. The known sub-directories of each known directory are kept as well, so that forgetting a directory
+# only has to look at the directories within it.
+class KnownDirectories:
+    def __init__(self):
+        self.directory_paths = set()
+        self.sub_directory_paths = {}
+        self.lock = threading.Lock()
+
+    def contains(self, directory_path):
+        with self.lock:
+            return os.path.normpath(directory_path) in self.directory_paths
+
+    # The parent directories of a directory exist as well
+    def add(self, directory_path):
+        directory_path = os.path.normpath(directory_path)
+        with self.lock:
+            while directory_path not in self.directory_paths and directory_path != os.path.dirname(directory_path):
+                self.directory_paths.add(directory_path)
+                parent_path = os.path.dirname(directory_path)
+                self.sub_directory_paths.setdefault(parent_path, set()).add(directory_path)
+                directory_path = parent_path
+
+    # The directories within a directory are gone as well
+    def forget(self, directory_path):
+        directory_path = os.path.normpath(directory_path)
+        with self.lock:
+            parent_sub_directory_paths = self.sub_directory_paths.get(os.path.dirname(directory_path))
+            if parent_sub_directory_paths is not None:
+                parent_sub_directory_paths.discard(directory_path)
+            forgotten_paths = [directory_path]
+            while forgotten_paths:
+                forgotten_path = forgotten_paths.pop()
+                self.directory_paths.discard(forgotten_path)
+                forgotten_paths.extend(self.sub_directory_paths.pop(forgotten_path, ()))
+
+
+known_directories = KnownDirectories()
+
+
+# The numbered names already used in a folder for duplicates of a name, for example <name>-DUPLICATE-<number>.pdf. The
+# folder is listed once, the first time a duplicate name is needed there, and after that the lowest unused number is
+# found without checking the folder again. A single check that the name is still unused guards against it having been
+# created by something else since the folder was listed.
+class DuplicateNameIndex:
+    def __init__(self):
+        self.folder_names = {}
+        self.used_numbers = {}
+        self.next_numbers = {}
+        self.lock = threading.Lock()
+
+    def used_numbers_in_folder(self, folder_path, name_prefix, name_suffix):
+        folder_names = self.folder_names.get(folder_path)
+        if folder_names is None:
+            try:
+                folder_names = list_folder_names(folder_path)
+            except OSError:
+                folder_names = set()
+            self.folder_names[folder_path] = folder_names
+            increment_statistic("duplicate name folders listed")
+
+        used_numbers = set()
+        for folder_name in folder_names:
+            if folder_name.startswith(name_prefix) and folder_name.endswith(name_suffix) and \
+                    len(folder_name) > len(name_prefix) + len(name_suffix):
+                number_string = folder_name[len(name_prefix):len(folder_name) - len(name_suffix)]
+                if number_string.isdigit() and str(int(number_string)) == number_string:
+                    used_numbers.add(int(number_string))
+        return used_numbers
+
+    # Returns the path of <name_prefix><lowest unused number><name_suffix> in the folder
+    def allocate(self, folder_path, name_prefix, name_suffix):
+        index_key = (os.path.normpath(folder_path), name_prefix, name_suffix)
+        with self.lock:
+            used_numbers = self.used_numbers.get(index_key)
+            if used_numbers is None:
+                used_numbers = self.used_numbers_in_folder(index_key[0], name_prefix, name_suffix)
+                self.used_numbers[index_key] = used_numbers
+            candidate_number = self.next_numbers.get(index_key, 0)
+            is_candidate_unused = False
+            while not is_candidate_unused:
+                while candidate_number in used_numbers:
+                    candidate_number += 1
+                used_numbers.add(candidate_number)
+                candidate_path = os.path.join(folder_path, name_prefix + str(candidate_number) + name_suffix)
+                is_candidate_unused = not is_file_or_directory(candidate_path)
+                if not is_candidate_unused:
+                    increment_statistic("duplicate names created since folder listed")
+            self.next_numbers[index_key] = candidate_number + 1
+
+        increment_statistic("duplicate names allocated")
+        return candidate_path
+
+
+duplicate_names = DuplicateNameIndex()
+
+
+# A manifest of the files in a pre-process <date>/<title_code> folder, one line per file: name, size, mtime and md5
+# (tab separated). Lines are appended as files are moved or copied into the folder, and a later line for the same name
+# replaces an earlier one. An entry is only used while the file still has the same size and mtime.
+class IssueManifest:
+    def __init__(self, folder_path):
+        self.manifest_path = os.path.join(folder_path, ISSUE_MANIFEST_FILE_NAME)
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load_entries(self):
+        self.entries = {}
+        try:
+            with open(self.manifest_path, "rb") as manifest_file:
+                for line in manifest_file:
+                    if not isinstance(line, str):
+                        line = line.decode("utf-8", "surrogateescape")
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 4:
+                        self.entries[fields[0]] = (int(fields[1]), float(fields[2]), str(fields[3]))
+        except (IOError, OSError) as load_exception:
+            if load_exception.errno != errno.ENOENT:
+                raise
+        increment_statistic("issue manifests loaded")
+
+    # Returns the md5 sum of the file, or None if the manifest doesn't have it
+    def lookup(self, file_name, file_stat):
+        with self.lock:
+            if self.entries is None:
+                self.load_entries()
+            entry = self.entries.get(file_name)
+        if entry is None or entry[0] != file_stat.st_size or entry[1] != file_stat.st_mtime:
+            return None
+        increment_statistic("issue manifest hits")
+        return entry[2]
+
+    def add(self, file_name, file_stat, md5sum):
+        if "\t" in file_name or "\n" in file_name:
+            return
+        with self.lock:
+            if self.entries is None:
+                self.load_entries()
+            self.entries[file_name] = (file_stat.st_size, file_stat.st_mtime, md5sum)
+            with open(self.manifest_path, "ab") as manifest_file:
+                manifest_line = file_name + "\t" + str(file_stat.st_size) + "\t" + repr(file_stat.st_mtime) + \
+                                "\t" + md5sum + "\n"
+                if not isinstance(manifest_line, bytes):
+                    manifest_line = manifest_line.encode("utf-8", "surrogateescape")
+                manifest_file.write(manifest_line)
+        increment_statistic("issue manifest entries written")
+
+
+issue_manifests = {}
+issue_manifests_lock = threading.Lock()
+
+
+directory_crawler = None
+
+
+# The checksums of the files recorded in a mets.xml, by file name. A mets:file element either has the checksum in its
+# CHECKSUM and CHECKSUMTYPE attributes, or (as written by Rosetta) refers with its ADMID attribute to an amdSec whose
+# dnx fileFixity section has the fixityType and fixityValue. The file is read as a stream and each element is cleared
+# once it has been read, so large mets.xml files don't have to fit in memory.
+def read_mets_checksums(mets_path):
+    checksums = {}
+    fixity_by_amd_id = {}
+    file_amd_ids = []
+    amd_ids = []
+    fixity_keys = {}
+    file_href = None
+    is_in_file_fixity = False
+    count_file_system_call("open")
+    with open(mets_path, "rb") as mets_file:
+        for event, element in ElementTree.iterparse(mets_file, events=("start", "end")):
+            tag = element.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if tag in ("amdSec", "techMD") and element.get("ID"):
+                    amd_ids.append(element.get("ID"))
+                elif tag == "section" and element.get("id") == "fileFixity":
+                    is_in_file_fixity = True
+                elif tag == "record":
+                    fixity_keys = {}
+                continue
+
+            if tag == "key" and is_in_file_fixity:
+                fixity_keys[element.get("id")] = (element.text or "").strip()
+            elif tag == "record" and is_in_file_fixity:
+                algorithm = METS_CHECKSUM_ALGORITHMS.get(fixity_keys.get("fixityType", "").upper())
+                if algorithm is not None and fixity_keys.get("fixityValue"):
+                    for amd_id in amd_ids:
+                        fixity_by_amd_id[amd_id] = (algorithm, fixity_keys["fixityValue"].lower())
+            elif tag == "section":
+                is_in_file_fixity = False
+            elif tag in ("amdSec", "techMD") and element.get("ID"):
+                amd_ids.pop()
+            elif tag == "FLocat":
+                file_href = element.get("{http://www.w3.org/1999/xlink}href")
+            elif tag == "file":
+                if file_href:
+                    file_name = file_href.replace("\\", "/").rsplit("/", 1)[-1]
+                    algorithm = METS_CHECKSUM_ALGORITHMS.get((element.get("CHECKSUMTYPE") or "").upper())
+                    if algorithm is not None and element.get("CHECKSUM"):
+                        checksums[file_name] = (algorithm, element.get("CHECKSUM").lower())
+                    elif element.get("ADMID"):
+                        file_amd_ids.append((file_name, element.get("ADMID").split()))
+                file_href = None
+            element.clear()
+
+    # The amdSec elements can come before or after the fileSec
+    for file_name, file_amd_id_list in file_amd_ids:
+        for amd_id in file_amd_id_list:
+            if amd_id in fixity_by_amd_id:
+                checksums[file_name] = fixity_by_amd_id[amd_id]
+                break
+
+    return checksums
+
+
+# The mets.xml checksums of the most recently used post-processed issues, by mets.xml path
+class MetsChecksumsCache:
+    def __init__(self, maximum_size):
+        self.maximum_size = maximum_size
+        self.checksums_by_mets_path = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def checksums(self, mets_path):
+        with self.lock:
+            checksums = self.checksums_by_mets_path.pop(mets_path, None)
+            if checksums is not None:
+                self.checksums_by_mets_path[mets_path] = checksums
+                return checksums
+
+        try:
+            checksums = read_mets_checksums(mets_path)
+            increment_statistic("mets.xml files read")
+        except (IOError, OSError) as read_exception:
+            if read_exception.errno != errno.ENOENT:
+                raise
+            checksums = {}
+        except ElementTree.ParseError as parse_exception:
+            increment_statistic("mets.xml files not parsed")
+            if verbose:
+                timestamp_message("WARNING: mets.xml could not be parsed, mets_path=" + mets_path + ", " +
+                                  str(parse_exception))
+            checksums = {}
+
+        with self.lock:
+            self.checksums_by_mets_path[mets_path] = checksums
+            while len(self.checksums_by_mets_path) > self.maximum_size:
+                self.checksums_by_mets_path.popitem(last=False)
+        return checksums
+
+
+mets_checksums_cache = MetsChecksumsCache(METS_CHECKSUMS_CACHE_SIZE)
+
+
+# The PDF files of an issue (the same file_date_string and title_code) share a pre-process target folder and a
+# post-process content/streams folder. When they are processed as a batch, the target folder is created once and
+# each of those folders is listed once, instead of being checked for each file. Only one thread processes a given
+# issue, so the listings stay accurate while the issue is processed.
+class IssueBatch:
+    def __init__(self, file_date_string, title_code, pre_processing_folder, post_processing_folder):
+        self.file_date_string = file_date_string
+        self.title_code = title_code
+        self.target_folder = pre_processing_folder + "/" + file_date_string + "/" + title_code
+        self.post_processing_folder = post_processing_folder
+        self.is_target_folder_made = False
+        self.target_folder_names = None
+        self.post_processing_streams_folders = None
+        self.file_system_call_count = 0
+        self.processes_started_count = 0
+
+    def make_target_folder(self):
+        if not self.is_target_folder_made:
+            make_directory_path(self.target_folder)
+            self.is_target_folder_made = True
+
+    def target_folder_contains(self, file_name):
+        if self.target_folder_names is None:
+            self.make_target_folder()
+            self.target_folder_names = list_folder_names(self.target_folder)
+        return file_name in self.target_folder_names
+
+    def add_to_target_folder(self, file_name):
+        if self.target_folder_names is not None:
+            self.target_folder_names.add(file_name)
+
+    # Returns the path and size of the post-processed file, or (None, None) if there is no post-processed file
+    def find_post_processing_file(self, fairfax_file):
+        if self.post_processing_streams_folders is None:
+            self.post_processing_streams_folders = []
+            for post_process_type in PostProcessIndex.POST_PROCESS_TYPES:
+                streams_folder = self.post_processing_folder + "/" + post_process_type + "/" + self.title_code + \
+                                 "/" + str(fairfax_file.file_date.year) + "/" + self.file_date_string + \
+                                 "/content/streams"
+                try:
+                    file_names = set(entry.name for entry in scan_directory(streams_folder) if entry.is_file())
+                    known_directories.add(streams_folder)
+                except OSError:
+                    file_names = set()
+                self.post_processing_streams_folders.append((streams_folder, file_names))
+
+        for streams_folder, file_names in self.post_processing_streams_folders:
+            if fairfax_file.file_name in file_names:
+                return streams_folder + "/" + fairfax_file.file_name, None
+
+        return None, None
+
+
+# The journal is a file of JSON records, one per line, that is only ever appended to:
+#   ["RUN", parameters]                                    the parameters of the run
+#   ["FOUND", path]                                        a file found when scanning the source folder
+#   ["SCAN-COMPLETE"]                                      all the files in the source folder have been found
+#   ["BEGIN", sequence, unit, operation, source, target]   an operation is about to start
+#   ["END", sequence]                                      the operation has completed
+#   ["DONE", unit]                                         all processing of the unit (a found file) has completed
+#   ["RUN-COMPLETE"]                                       the run has completed
+# Each unit has at most one operation, so a unit with a completed operation is done.
+class ProcessingJournal:
+    def __init__(self, journal_path, next_sequence=0, append=False):
+        self.journal_path = journal_path
+        self.next_sequence = next_sequence
+        self.unsynced_count = 0
+        self.lock = threading.Lock()
+        self.journal_file = open(journal_path, "ab" if append else "wb")
+
+    def write_record(self, record):
+        with self.lock:
+            self.journal_file.write((json.dumps(record) + "\n").encode("utf-8"))
+            self.journal_file.flush()
+            self.unsynced_count += 1
+            if self.unsynced_count >= JOURNAL_FSYNC_BATCH_SIZE:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.journal_file.fileno())
+        self.unsynced_count = 0
+
+    def begin_operation(self, unit, operation, source, target):
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+        self.write_record(["BEGIN", sequence, unit, operation, source, target])
+        return sequence
+
+    def close(self, is_run_complete):
+        if is_run_complete:
+            self.write_record(["RUN-COMPLETE"])
+        with self.lock:
+            self.sync()
+            self.journal_file.close()
+
+
+class JournalState:
+    def __init__(self):
+        self.parameters = None
+        self.found_paths = []
+        self.is_scan_complete = False
+        self.is_run_complete = False
+        self.begun_operations = collections.OrderedDict()
+        self.done_units = set()
+        self.next_sequence = 0
+
+    @classmethod
+    def load(cls, journal_path):
+        journal_state = cls()
+        with open(journal_path, "rb") as journal_file:
+            for line in journal_file:
+                try:
+                    record = [journal_value(value) for value in json.loads(line.decode("utf-8"))]
+                except ValueError:
+                    # A partly written last record, from when the run stopped
+                    continue
+                record_type = record[0]
+                if record_type == "RUN":
+                    journal_state.parameters = record[1]
+                elif record_type == "FOUND":
+                    journal_state.found_paths.append(record[1])
+                elif record_type == "SCAN-COMPLETE":
+                    journal_state.is_scan_complete = True
+                elif record_type == "BEGIN":
+                    journal_state.begun_operations[record[1]] = record[2:]
+                    journal_state.next_sequence = max(journal_state.next_sequence, record[1] + 1)
+                elif record_type == "END":
+                    unit = journal_state.begun_operations.pop(record[1])[0]
+                    if unit is not None:
+                        journal_state.done_units.add(unit)
+                elif record_type == "DONE":
+                    journal_state.done_units.add(record[1])
+                elif record_type == "RUN-COMPLETE":
+                    journal_state.is_run_complete = True
+
+        return journal_state
+
+    # Operations that were started but not completed
+    def unfinished_operations(self):
+        return list(self.begun_operations.values())
+
+
+# A plan is a file of JSON records, one per line. The first is ["PLAN", parameters] and each of the others is an
+# operation: [operation, source, target, size, md5]. A delete-folder operation also lists the files in the folder that
+# other planned operations move or delete, and the files that are planned to remain in it until it is deleted:
+# ["delete-folder", folder, None, None, None, planned sources, remaining files]. While the plan is made, the paths that
+# the planned operations would create or remove are tracked, so that later decisions see the effects of earlier ones,
+# just as they would if the operations were actually done.
+class ProcessingPlan:
+    def __init__(self, plan_path):
+        self.plan_path = plan_path
+        self.planned_paths = {}
+        self.planned_file_sources = {}
+        self.planned_folder_names = {}
+        self.operation_count = 0
+        self.lock = threading.Lock()
+        self.plan_file = open(plan_path, "wb")
+
+    def write_record(self, record):
+        with self.lock:
+            self.plan_file.write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def add_operation(self, operation, source_path, target_path, size=None, digest=None, folder_contents=None):
+        record = [operation, source_path, target_path, size, digest]
+        if folder_contents is not None:
+            record.extend(folder_contents)
+        self.write_record(record)
+        with self.lock:
+            self.operation_count += 1
+        increment_statistic("planned operations: " + operation)
+
+    def set_path_type(self, the_path, planned_type):
+        the_path = os.path.normpath(the_path)
+        folder_path, name = os.path.split(the_path)
+        with self.lock:
+            self.planned_paths[the_path] = planned_type
+            folder_names = self.planned_folder_names.setdefault(folder_path, set())
+            if planned_type == PLANNED_REMOVED:
+                folder_names.discard(name)
+            else:
+                folder_names.add(name)
+
+    # Returns PLANNED_FILE, PLANNED_FOLDER or PLANNED_REMOVED, or None if the path isn't affected by the plan
+    def path_type(self, the_path):
+        with self.lock:
+            return self.planned_paths.get(os.path.normpath(the_path))
+
+    # The path that a planned file would be moved or copied from, so that it can be compared before it exists
+    def planned_file_source(self, the_path):
+        with self.lock:
+            return self.planned_file_sources.get(os.path.normpath(the_path), the_path)
+
+    def folder_names(self, folder_path, existing_names):
+        folder_path = os.path.normpath(folder_path)
+        folder_names = set(existing_names)
+        with self.lock:
+            for name in self.planned_folder_names.get(folder_path, ()):
+                if self.planned_paths.get(os.path.join(folder_path, name)) == PLANNED_REMOVED:
+                    folder_names.discard(name)
+                else:
+                    folder_names.add(name)
+        return folder_names
+
+    def plan_make_directory(self, directory_path):
+        self.add_operation("mkdir", None, directory_path)
+        # Parent folders are created as well
+        folder_path = os.path.normpath(directory_path)
+        while folder_path and folder_path != os.path.dirname(folder_path) and not is_directory(folder_path):
+            self.set_path_type(folder_path, PLANNED_FOLDER)
+            folder_path = os.path.dirname(folder_path)
+
+    def plan_move_or_copy(self, operation, source_path, target_path):
+        size = None
+        digest = None
+        if os.path.isfile(source_path) and not os.path.islink(source_path):
+            size = os.path.getsize(source_path)
+            digest = get_md5_sum(source_path)
+        self.add_operation(operation, source_path, target_path, size, digest)
+        if os.path.isdir(source_path) and not os.path.islink(source_path):
+            self.set_path_type(target_path, PLANNED_FOLDER)
+        else:
+            self.set_path_type(target_path, PLANNED_FILE)
+            with self.lock:
+                self.planned_file_sources[os.path.normpath(target_path)] = source_path
+        if operation == "move":
+            self.set_path_type(source_path, PLANNED_REMOVED)
+
+    def plan_delete(self, operation, the_path):
+        size = None
+        folder_contents = None
+        if operation == "delete-file":
+            size = os.path.getsize(the_path)
+        else:
+            folder_contents = self.planned_folder_contents(the_path)
+        self.add_operation(operation, the_path, None, size, folder_contents=folder_contents)
+        self.set_path_type(the_path, PLANNED_REMOVED)
+
+    # Returns the files in the folder that earlier planned operations remove, and the files that remain in it
+    def planned_folder_contents(self, folder_path):
+        planned_sources = []
+        remaining_paths = []
+        for walked_folder_path, folder_names, file_names in os.walk(folder_path):
+            linked_folder_names = [name for name in folder_names
+                                   if os.path.islink(os.path.join(walked_folder_path, name))]
+            for name in sorted(file_names + linked_folder_names):
+                the_path = os.path.join(walked_folder_path, name)
+                if self.path_type(the_path) == PLANNED_REMOVED:
+                    planned_sources.append(the_path)
+                else:
+                    remaining_paths.append(the_path)
+        return [planned_sources, remaining_paths]
+
+    def close(self):
+        with self.lock:
+            self.plan_file.close()
+
+
+# A snapshot of the folders under the source folder, kept between pre-processing runs as a gzip file of JSON records,
+# one per line. The first is ["INVENTORY", parameters] and each of the others is a folder:
+# [relative_path, mtime, sub-folder names, [[file name, size, mtime], ...]]. A folder whose mtime is the same as in the
+# snapshot has had no entries added, removed or renamed, so it isn't listed again. The folders are recorded while the
+# source folder is scanned, and only replace the previous snapshot when the scan completes. When watching, there may be
+# no snapshot file, and the folders recorded in each scan are the previous snapshot of the next. The snapshot file is
+# only written when the folders have changed since it was loaded or last written.
+class SourceInventory:
+    def __init__(self, snapshot_path, parameters):
+        self.snapshot_path = snapshot_path
+        self.parameters = parameters
+        self.previous_folders = {}
+        self.recorded_folders = {}
+        self.is_changed = False
+        self.saved_time = 0.0
+
+    # Returns False (and uses none of it) when the snapshot was written with different parameters
+    def load(self):
+        with gzip.open(self.snapshot_path, "rb") as snapshot_file:
+            for line_number, line in enumerate(snapshot_file):
+                record = json.loads(line.decode("utf-8"))
+                if line_number == 0:
+                    if record[0] != "INVENTORY" or record[1] != self.parameters:
+                        return False
+                    continue
+                relative_path, folder_mtime, sub_folder_names, files = record
+                self.previous_folders[journal_value(relative_path)] = (
+                    folder_mtime, [journal_value(sub_folder_name) for sub_folder_name in sub_folder_names],
+                    [[journal_value(file_name), file_size, file_mtime] for file_name, file_size, file_mtime in files])
+        return True
+
+    # Returns the (mtime, sub-folder names, files) of the folder in the previous snapshot, or None
+    def previous_folder(self, relative_path):
+        return self.previous_folders.get(relative_path)
+
+    def record_folder(self, relative_path, folder_mtime, sub_folder_names, files):
+        self.recorded_folders[relative_path] = (folder_mtime, sub_folder_names, files)
+
+    # Nothing is recorded when the source folder couldn't be scanned, in which case the previous snapshot is kept
+    def complete_scan(self):
+        if not self.recorded_folders:
+            return
+        if self.recorded_folders != self.previous_folders:
+            self.is_changed = True
+        self.previous_folders = self.recorded_folders
+        self.recorded_folders = {}
+
+    # Returns whether the snapshot file was written. It isn't written again within minimum_seconds of the last write.
+    def save(self, minimum_seconds=0):
+        if self.snapshot_path is None or not self.is_changed or time.time() < self.saved_time + minimum_seconds:
+            return False
+        new_snapshot_path = self.snapshot_path + ".new"
+        with gzip.open(new_snapshot_path, "wb") as snapshot_file:
+            snapshot_file.write((json.dumps(["INVENTORY", self.parameters]) + "\n").encode("utf-8"))
+            for relative_path, folder in self.previous_folders.items():
+                snapshot_file.write((json.dumps([relative_path] + list(folder)) + "\n").encode("utf-8"))
+        os.rename(new_snapshot_path, self.snapshot_path)
+        self.is_changed = False
+        self.saved_time = time.time()
+        return True
+
+
+# Serves a Unix socket on which each connection sends one command line and gets back one line of JSON from
+# handle_command. Connections are handled by their own threads. Only the socket's owner can connect to it.
+class ControlServer:
+    def __init__(self, socket_path, handle_command):
+        self.socket_path = socket_path
+        self.handle_command = handle_command
+        self.is_closed = False
+        if os.path.lexists(socket_path):
+            # Left behind by a watch that was killed (validate_watch_parameters checked that nothing is listening on it)
+            os.remove(socket_path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(socket_path)
+        os.chmod(socket_path, stat.S_IRUSR | stat.S_IWUSR)
+        self.server_socket.listen(5)
+        self.server_socket.settimeout(CONTROL_SOCKET_ACCEPT_TIMEOUT_SECONDS)
+        self.server_thread = threading.Thread(target=self.serve)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def serve(self):
+        while not self.is_closed:
+            try:
+                connection, address = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.is_closed:
+                    return
+                raise
+            connection.settimeout(None)
+            connection_thread = threading.Thread(target=self.handle_connection, args=(connection,))
+            connection_thread.daemon = True
+            connection_thread.start()
+
+    def handle_connection(self, connection):
+        try:
+            request = b""
+            while not request.endswith(b"\n") and len(request) < 1024:
+                received = connection.recv(1024)
+                if not received:
+                    break
+                request += received
+            response = self.handle_command(request.decode("utf-8", "replace").strip())
+            connection.sendall((json.dumps(response) + "\n").encode("utf-8"))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def close(self):
+        self.is_closed = True
+        self.server_thread.join()
+        self.server_socket.close()
+        os.remove(self.socket_path)
+
+
 class FileComparison:
     def __init__(self, source_file, target_file, is_target_a_file, are_files_the_same):
         self.source_file = source_file
@@ -134,6 +1213,76 @@ def convert_string_to_date(date_string):
         raise argparse.ArgumentTypeError(date_string + " is not a proper date string in the format 'yyyyMMdd'")
 
 
+def increment_statistic(statistic_name, amount=1):
+    with processing_statistics_lock:
+        processing_statistics[statistic_name] = processing_statistics.get(statistic_name, 0) + amount
+
+
+def maximum_statistic(statistic_name, value):
+    with processing_statistics_lock:
+        processing_statistics[statistic_name] = max(processing_statistics.get(statistic_name, value), value)
+        maximum_statistic_names.add(statistic_name)
+
+
+def merge_statistics(statistics_items, maximum_names):
+    for statistic_name, statistic_value in statistics_items:
+        if statistic_name in maximum_names:
+            maximum_statistic(statistic_name, statistic_value)
+        else:
+            increment_statistic(statistic_name, statistic_value)
+
+
+# File system calls are counted so that the effect of options like batch_by_issue can be measured
+def count_file_system_call(call_name):
+    increment_statistic("file system calls: " + call_name)
+    issue_batch = getattr(issue_batches, "current", None)
+    if issue_batch is not None:
+        issue_batch.file_system_call_count += 1
+
+
+def count_process_started():
+    increment_statistic("processes started")
+    issue_batch = getattr(issue_batches, "current", None)
+    if issue_batch is not None:
+        issue_batch.processes_started_count += 1
+
+
+def display_processing_statistics():
+    if len(processing_statistics) > 0:
+        timestamp_message("Processing statistics:")
+        for statistic_name, statistic_value in processing_statistics.items():
+            timestamp_message("    " + statistic_name + "=" + str(statistic_value))
+
+
+def memoise_file_dates(convert_function):
+    if lru_cache is not None:
+        return lru_cache(maxsize=FILE_DATE_CACHE_SIZE)(convert_function)
+
+    # Python 2.7 has no lru_cache, so instead the memoised dates are cleared whenever the cache is full
+    memoised_dates = {}
+
+    def convert_with_memoised_dates(date_string):
+        memoised_date = memoised_dates.get(date_string)
+        if memoised_date is None:
+            memoised_date = convert_function(date_string)
+            if len(memoised_dates) >= FILE_DATE_CACHE_SIZE:
+                memoised_dates.clear()
+            memoised_dates[date_string] = memoised_date
+        return memoised_date
+
+    return convert_with_memoised_dates
+
+
+convert_file_date_string_to_date = memoise_file_dates(convert_string_to_date)
+
+
+def journal_value(value):
+    # Python 2.7 loads JSON strings as unicode, but paths are str everywhere else
+    if not isinstance(value, str) and type(value).__name__ == "unicode":
+        return value.encode("utf-8")
+    return value
+
+
 def parse_parameters():
     parser = argparse.ArgumentParser(description="Process pre-and-post processed Fairfax files by grouping them by " +
                                                  "date and titleCode in appropriate pre-process and " +
@@ -165,14 +1314,111 @@ def parse_parameters():
                         help='Indicates that non-pdf files will be processed. By default only PDF files are processed.')
     parser.add_argument('--move_files', dest='move_files', action='store_true',
                         help='Indicates that files will be moved to the target folder instead of copied')
+    parser.add_argument('--link_mode', choices=LINK_MODES, default="copy",
+                        help='How files are copied when they are not moved: copy the data (the default), create ' +
+                             'hard links, create reflinks, or auto (a reflink, otherwise a hard link). When a link ' +
+                             'cannot be made, for example between file systems, the data is copied')
+    parser.add_argument('--no_global_sort', dest='no_global_sort', action='store_true',
+                        help='Indicates that files are processed while the source folder is being scanned, in ' +
+                             'per-folder sorted order, instead of after all files have been found and sorted')
+    parser.add_argument('--prune_dated_folders', dest='prune_dated_folders', action='store_true',
+                        help='Indicates that source folders named yyyyMMdd or <titleCode>_yyyyMMdd with dates ' +
+                             'outside of starting_date and ending_date are not scanned when pre-processing or ' +
+                             'listing unique files')
+    parser.add_argument('--index_post_process', dest='index_post_process', action='store_true',
+                        help='Indicates that the post-process content/streams folders are scanned once per ' +
+                             'title_code and year, instead of checking for each post-processed file separately')
+    parser.add_argument('--batch_by_issue', dest='batch_by_issue', action='store_true',
+                        help='Indicates that PDF files are pre-processed in batches of the same date and ' +
+                             'title_code, creating and listing their target folders once per batch')
+    parser.add_argument('--plan_only', type=str, default=None,
+                        help='The file path of a plan of the mkdir, move, copy and delete operations that ' +
+                             'pre-processing or post-processing would do. The operations are only planned, not done')
+    parser.add_argument('--apply_plan', type=str, default=None,
+                        help='The file path of a plan written with --plan_only whose operations will be done')
+    parser.add_argument('--mets_checksums', dest='mets_checksums', action='store_true',
+                        help='Indicates that the checksums recorded in the mets.xml of post-processed issues are ' +
+                             'used instead of reading the post-processed files when comparing them')
+    parser.add_argument('--issue_manifests', dest='issue_manifests', action='store_true',
+                        help='Indicates that a manifest of the name, size, mtime and md5 sum of each file moved or ' +
+                             'copied into a pre-process <date>/<title_code> folder is kept in that folder, and used ' +
+                             'instead of reading those files again when comparing them')
+    parser.add_argument('--inventory_snapshot', type=str, default=None,
+                        help='The file path of a snapshot of the folders and files under source_folder, written at ' +
+                             'the end of each pre-processing run. Folders that have not changed since the snapshot ' +
+                             'are not listed again, and only new or changed files are pre-processed')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='Indicates that the grouper keeps running, checking source_folder for new and changed ' +
+                             'files every watch_interval seconds and pre-processing or post-processing them in batches')
+    parser.add_argument('--watch_interval', type=int, default=WATCH_DEFAULT_INTERVAL_SECONDS,
+                        help='The number of seconds between checks of source_folder when watching. The default is ' +
+                             str(WATCH_DEFAULT_INTERVAL_SECONDS))
+    parser.add_argument('--watch_settle_seconds', type=int, default=WATCH_DEFAULT_SETTLE_SECONDS,
+                        help='When watching, files modified in the last watch_settle_seconds may still be being ' +
+                             'written, so they are left until a later check. The default is ' +
+                             str(WATCH_DEFAULT_SETTLE_SECONDS))
+    parser.add_argument('--watch_batch_size', type=int, default=WATCH_DEFAULT_BATCH_SIZE,
+                        help='The most files processed in each batch when watching. The default is ' +
+                             str(WATCH_DEFAULT_BATCH_SIZE))
+    parser.add_argument('--watch_cache_refresh_seconds', type=int, default=WATCH_DEFAULT_CACHE_REFRESH_SECONDS,
+                        help='When watching, the post-process index and the other caches of folder contents are ' +
+                             'rebuilt after this number of seconds. The digest cache is kept. The default is ' +
+                             str(WATCH_DEFAULT_CACHE_REFRESH_SECONDS))
+    parser.add_argument('--control_socket', type=str, default=None,
+                        help='When watching, the file path of a Unix socket that accepts the commands status ' +
+                             '(which reports the progress of the watch) and flush (which checks source_folder ' +
+                             'straight away)')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='The file path of a journal of the files found and the operations done when ' +
+                             'pre-processing or post-processing, so that an interrupted run can be resumed')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Indicates that the interrupted run recorded in the journal will be resumed')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='The number of worker processes that the files are split between, by date, once they ' +
+                             'have been found. The default is 1, which processes all the files in this process')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of worker threads used for pre-processing and post-processing. The ' +
+                             'default is 1, which processes files sequentially')
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                        help='Indicates that pre-processing is done in a pipeline of stages (scan, classify, compare ' +
+                             'and act) that run at the same time, connected by bounded queues. Requires Python 3.7 ' +
+                             'or later')
+    parser.add_argument('--pipeline_concurrency', type=str, default=PIPELINE_DEFAULT_CONCURRENCY,
+                        help='A comma-separated list of stage=tasks for the classify, compare and act stages of the ' +
+                             'pipeline. The default is ' + PIPELINE_DEFAULT_CONCURRENCY)
+    parser.add_argument('--pipeline_queue_size', type=int, default=PIPELINE_DEFAULT_QUEUE_SIZE,
+                        help='The most items that wait between two stages of the pipeline. The default is ' +
+                             str(PIPELINE_DEFAULT_QUEUE_SIZE))
+    parser.add_argument('--crawl_threads', type=int, default=1,
+                        help='The number of threads used to list the folders under source_folder. The default is ' +
+                             '1, which lists folders one at a time')
+    parser.add_argument('--digest_cache', type=str, default=None,
+                        help='The file path of a digest cache, which keeps md5 sums of unchanged files between runs. ' +
+                             'It is created if it does not already exist')
+    parser.add_argument('--digest_cache_max_age_days', type=int, default=DIGEST_CACHE_DEFAULT_MAX_AGE_DAYS,
+                        help='Digest cache entries that have not been used for this number of days are evicted')
+    parser.add_argument('--digest_cache_max_entries', type=int, default=DIGEST_CACHE_DEFAULT_MAX_ENTRIES,
+                        help='The maximum number of entries kept in the digest cache. The least recently used ' +
+                             'entries are evicted first')
+    parser.add_argument('--copy_digest_algorithms', type=str, default=None,
+                        help='A comma-separated list of digest algorithms (for example md5,sha256) calculated while ' +
+                             'files are copied. The digests are kept in the digest cache (in memory if there is no ' +
+                             'digest cache), so the copied files do not need to be read again to compare them')
+    parser.add_argument('--verify_copies', dest='verify_copies', action='store_true',
+                        help='Indicates that each copied file is read again and its digest checked against the ' +
+                             'digest calculated while copying')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Indicates that operations will be done in a verbose manner')
     parser.add_argument('--test', dest='test', action='store_true',
                         help='Indicates that only tests will be run')
+    parser.add_argument('--benchmark', dest='benchmark', action='store_true',
+                        help='Indicates that only benchmarks will be run')
 
     parser.set_defaults(do_pre_processing=False, do_post_processing=False, do_list_unique_files=False,
                         create_targets=False, pre_process_include_non_pdf_files=False, move_files=False,
-                        verbose=False, test=False)
+                        no_global_sort=False, prune_dated_folders=False, index_post_process=False, batch_by_issue=False,
+                        mets_checksums=False, issue_manifests=False, resume=False, pipeline=False,
+                        watch=False, verify_copies=False, verbose=False, test=False, benchmark=False)
 
     args = parser.parse_args()
 
@@ -181,26 +1427,117 @@ def parse_parameters():
 
 def determine_if_sun_os():
     global is_sun_os
-    output = subprocess.check_output(["uname"])
-    is_sun_os = "sunos" in str(output).lower()
+    is_sun_os = "sunos" in platform.system().lower()
     print("is_sun_os=" + str(is_sun_os))
 
 
+# Returns the stat of the path, or None if the path does not exist (with the same result as os.path.exists)
+def stat_if_exists(the_path):
+    count_file_system_call("stat")
+    try:
+        return os.stat(the_path)
+    except (OSError, ValueError):
+        return None
+
+
+# When a plan is being made, paths are checked as if the planned operations had already been done
+def planned_path_type(the_path):
+    if processing_plan is None:
+        return None
+    return processing_plan.path_type(the_path)
+
+
 def is_directory(directory_path):
-    return os.path.exists(directory_path) and not os.path.isfile(directory_path)
+    planned_type = planned_path_type(directory_path)
+    if planned_type is not None:
+        return planned_type == PLANNED_FOLDER
+    if known_directories.contains(directory_path):
+        increment_statistic("directory cache: stat and mkdir calls avoided")
+        return True
+    path_stat = stat_if_exists(directory_path)
+    return path_stat is not None and not stat.S_ISREG(path_stat.st_mode)
 
 
 def is_file(file_path):
-    return os.path.exists(file_path) and os.path.isfile(file_path)
+    planned_type = planned_path_type(file_path)
+    if planned_type is not None:
+        return planned_type == PLANNED_FILE
+    path_stat = stat_if_exists(file_path)
+    return path_stat is not None and stat.S_ISREG(path_stat.st_mode)
 
 
 def is_file_or_directory(file_path):
-    return os.path.exists(file_path)
+    planned_type = planned_path_type(file_path)
+    if planned_type is not None:
+        return planned_type != PLANNED_REMOVED
+    return stat_if_exists(file_path) is not None
+
+
+def list_folder_names(folder_path):
+    count_file_system_call("listdir")
+    if processing_plan is None:
+        try:
+            folder_names = set(os.listdir(folder_path))
+        except OSError as list_exception:
+            if list_exception.errno != errno.ENOENT or not recover_known_directory(folder_path):
+                raise
+            folder_names = set(os.listdir(folder_path))
+        known_directories.add(folder_path)
+        return folder_names
+    existing_names = []
+    if not planned_path_type(folder_path) and os.path.isdir(folder_path):
+        existing_names = os.listdir(folder_path)
+    return processing_plan.folder_names(folder_path, existing_names)
+
+
+def scan_directory(directory_path):
+    count_file_system_call("listdir")
+    if scandir is not None:
+        return scandir(directory_path)
+    return [ListedDirectoryEntry(directory_path, name) for name in os.listdir(directory_path)]
+
+
+# The (directory_entries, file_entries) of the directory, each sorted by name. Symbolic links to directories are left
+# out, since they aren't followed.
+def read_directory(directory_path):
+    directory_entries = []
+    file_entries = []
+    for entry in scan_directory(directory_path):
+        if not entry.is_dir():
+            file_entries.append(entry)
+        elif not entry.is_symlink():
+            directory_entries.append(entry)
+    directory_entries.sort(key=lambda directory_entry: directory_entry.name)
+    file_entries.sort(key=lambda file_entry: file_entry.name)
+    return directory_entries, file_entries
 
 
 def make_directory_path(directory_path):
     if not is_directory(directory_path):
-        os.makedirs(directory_path)
+        if processing_plan is not None:
+            processing_plan.plan_make_directory(directory_path)
+            return
+        try:
+            count_file_system_call("mkdir")
+            os.makedirs(directory_path)
+        except OSError:
+            # Another worker may have created the same path in the meantime
+            if not is_directory(directory_path):
+                raise
+    if processing_plan is None:
+        known_directories.add(directory_path)
+
+
+# Returns whether the directory was known to exist but didn't, in which case it has been created again
+def recover_known_directory(directory_path):
+    if not known_directories.contains(directory_path) or os.path.isdir(directory_path):
+        return False
+    print("")
+    timestamp_message("WARNING: directory=" + directory_path + " was removed during processing, creating it again")
+    known_directories.forget(directory_path)
+    make_directory_path(directory_path)
+    increment_statistic("directory cache: removed directories created again")
+    return True
 
 
 def display_parameter_values():
@@ -218,8 +1555,38 @@ def display_parameter_values():
     print("    create_targets=" + str(create_targets))
     print("    pre_process_include_non_pdf_files=" + str(pre_process_include_non_pdf_files))
     print("    move_files=" + str(move_files))
+    print("    link_mode=" + str(link_mode))
+    print("    no_global_sort=" + str(no_global_sort))
+    print("    prune_dated_folders=" + str(prune_dated_folders))
+    print("    index_post_process=" + str(index_post_process))
+    print("    batch_by_issue=" + str(batch_by_issue))
+    print("    mets_checksums=" + str(use_mets_checksums))
+    print("    issue_manifests=" + str(use_issue_manifests))
+    print("    plan_only=" + str(plan_only_path))
+    print("    apply_plan=" + str(apply_plan_path))
+    print("    inventory_snapshot=" + str(inventory_snapshot_path))
+    print("    watch=" + str(watch))
+    print("    watch_interval=" + str(watch_interval))
+    print("    watch_settle_seconds=" + str(watch_settle_seconds))
+    print("    watch_batch_size=" + str(watch_batch_size))
+    print("    watch_cache_refresh_seconds=" + str(watch_cache_refresh_seconds))
+    print("    control_socket=" + str(control_socket_path))
+    print("    journal=" + str(journal_path))
+    print("    resume=" + str(resume))
+    print("    shards=" + str(shards))
+    print("    workers=" + str(workers))
+    print("    pipeline=" + str(pipeline))
+    print("    pipeline_concurrency=" + pipeline_concurrency_parameter)
+    print("    pipeline_queue_size=" + str(pipeline_queue_size))
+    print("    crawl_threads=" + str(crawl_threads))
+    print("    digest_cache=" + str(digest_cache_path))
+    print("    digest_cache_max_age_days=" + str(digest_cache_max_age_days))
+    print("    digest_cache_max_entries=" + str(digest_cache_max_entries))
+    print("    copy_digest_algorithms=" + str(copy_digest_algorithms))
+    print("    verify_copies=" + str(verify_copies))
     print("    verbose=" + str(verbose))
     print("    test=" + str(test))
+    print("    benchmark=" + str(benchmark))
     print("")
 
 
@@ -240,7 +1607,7 @@ def display_processing_legend():
     print("    -  -- indicates that a source file has been deleted. This can happen when:")
     print("              - When pre-processing and the file already exists and --move_files is specified.")
     print("    =  -- indicates that a source folder has been deleted. This can happen when:")
-    print("              - When post-processing and --move_files, the parent folder of the 'done' file deleted.")
+    print("              - When applying a plan that deletes folders.")
     print("")
 
 
@@ -269,12 +1636,76 @@ def process_parameters(parsed_arguments):
     pre_process_include_non_pdf_files = parsed_arguments.pre_process_include_non_pdf_files
     global move_files
     move_files = parsed_arguments.move_files
+    global link_mode
+    link_mode = parsed_arguments.link_mode
+    global no_global_sort
+    no_global_sort = parsed_arguments.no_global_sort
+    global prune_dated_folders
+    prune_dated_folders = parsed_arguments.prune_dated_folders
+    global index_post_process
+    index_post_process = parsed_arguments.index_post_process
+    global batch_by_issue
+    batch_by_issue = parsed_arguments.batch_by_issue
+    global use_mets_checksums
+    use_mets_checksums = parsed_arguments.mets_checksums
+    global use_issue_manifests
+    use_issue_manifests = parsed_arguments.issue_manifests
+    global plan_only_path
+    plan_only_path = parsed_arguments.plan_only
+    global apply_plan_path
+    apply_plan_path = parsed_arguments.apply_plan
+    global inventory_snapshot_path
+    inventory_snapshot_path = parsed_arguments.inventory_snapshot
+    global watch
+    watch = parsed_arguments.watch
+    global watch_interval
+    watch_interval = parsed_arguments.watch_interval
+    global watch_settle_seconds
+    watch_settle_seconds = parsed_arguments.watch_settle_seconds
+    global watch_batch_size
+    watch_batch_size = parsed_arguments.watch_batch_size
+    global watch_cache_refresh_seconds
+    watch_cache_refresh_seconds = parsed_arguments.watch_cache_refresh_seconds
+    global control_socket_path
+    control_socket_path = parsed_arguments.control_socket
+    global journal_path
+    journal_path = parsed_arguments.journal
+    global resume
+    resume = parsed_arguments.resume
+    global shards
+    shards = parsed_arguments.shards
+    global workers
+    workers = parsed_arguments.workers
+    global pipeline
+    pipeline = parsed_arguments.pipeline
+    global pipeline_concurrency_parameter
+    pipeline_concurrency_parameter = parsed_arguments.pipeline_concurrency
+    global pipeline_queue_size
+    pipeline_queue_size = parsed_arguments.pipeline_queue_size
+    global crawl_threads
+    crawl_threads = parsed_arguments.crawl_threads
+    global digest_cache_path
+    digest_cache_path = parsed_arguments.digest_cache
+    global digest_cache_max_age_days
+    digest_cache_max_age_days = parsed_arguments.digest_cache_max_age_days
+    global digest_cache_max_entries
+    digest_cache_max_entries = parsed_arguments.digest_cache_max_entries
+    global copy_digest_algorithms
+    copy_digest_algorithms = None
+    if parsed_arguments.copy_digest_algorithms is not None:
+        copy_digest_algorithms = [algorithm.strip().lower() for algorithm in
+                                  parsed_arguments.copy_digest_algorithms.split(",") if algorithm.strip()]
+    global verify_copies
+    verify_copies = parsed_arguments.verify_copies
+    if verify_copies and copy_digest_algorithms is None:
+        copy_digest_algorithms = ["md5"]
     global verbose
     verbose = parsed_arguments.verbose
     global test
     test = parsed_arguments.test
+    global benchmark
+    benchmark = parsed_arguments.benchmark
 
-    global move_or_copy_flags
     global unacceptable_parameters
 
     display_parameter_values()
@@ -287,11 +1718,6 @@ def process_parameters(parsed_arguments):
 
     print("")
 
-    if verbose and not is_sun_os:
-        move_or_copy_flags = "-v"
-    else:
-        move_or_copy_flags = ""
-
     if is_directory(source_folder):
         print("    source_folder=" + source_folder + " exists and is directory, processing can take place.")
     else:
@@ -346,9 +1772,42 @@ def process_parameters(parsed_arguments):
         do_command_count += 1
     if do_list_unique_files:
         do_command_count += 1
+    if apply_plan_path is not None:
+        do_command_count += 1
     if not do_command_count == 1:
         print("    Only ONE of do_pre_processing=" + str(do_pre_processing) + " AND do_post_processing=" +
-              str(do_post_processing) + " AND do_list_unique_files=" + str(do_list_unique_files) + " MUST be set.")
+              str(do_post_processing) + " AND do_list_unique_files=" + str(do_list_unique_files) +
+              " AND apply_plan=" + str(apply_plan_path) + " MUST be set.")
+        unacceptable_parameters = True
+
+    validate_plan_parameters()
+    validate_journal_parameters()
+    validate_shards_parameters()
+    validate_pipeline_parameters()
+    validate_inventory_snapshot_parameters()
+    validate_watch_parameters()
+
+    for algorithm in copy_digest_algorithms or []:
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            print("    ERROR copy_digest_algorithms contains an unknown algorithm=" + algorithm)
+            unacceptable_parameters = True
+
+    if workers < 1:
+        print("    ERROR workers=" + str(workers) + " must be at least 1.")
+        unacceptable_parameters = True
+    elif workers > 1 and concurrent is None:
+        print("    ERROR workers=" + str(workers) + " requires concurrent.futures (for Python 2.7 install the " +
+              "'futures' package).")
+        unacceptable_parameters = True
+
+    if crawl_threads < 1:
+        print("    ERROR crawl_threads=" + str(crawl_threads) + " must be at least 1.")
+        unacceptable_parameters = True
+    elif crawl_threads > 1 and concurrent is None:
+        print("    ERROR crawl_threads=" + str(crawl_threads) + " requires concurrent.futures (for Python 2.7 " +
+              "install the 'futures' package).")
         unacceptable_parameters = True
 
     if unacceptable_parameters:
@@ -357,6 +1816,203 @@ def process_parameters(parsed_arguments):
         print("")
 
 
+def journal_parameters():
+    parameters = {"do_pre_processing": do_pre_processing, "do_post_processing": do_post_processing,
+                  "source_folder": source_folder, "target_pre_process_folder": target_pre_process_folder,
+                  "target_post_process_folder": target_post_process_folder, "for_review_folder": for_review_folder,
+                  "starting_date": starting_date.strftime(DATE_PARSE_FORMAT),
+                  "ending_date": ending_date.strftime(DATE_PARSE_FORMAT), "move_files": move_files,
+                  "pre_process_include_non_pdf_files": pre_process_include_non_pdf_files}
+    # The same form as the parameters loaded from the journal
+    return json.loads(json.dumps(parameters))
+
+
+def is_journal_run_complete(the_journal_path):
+    with open(the_journal_path, "rb") as journal_file:
+        journal_file.seek(0, os.SEEK_END)
+        journal_file.seek(max(0, journal_file.tell() - JOURNAL_TAIL_SIZE))
+        journal_tail = journal_file.read().decode("utf-8", "replace")
+
+    return journal_tail.rstrip().endswith('["RUN-COMPLETE"]')
+
+
+def validate_plan_parameters():
+    global unacceptable_parameters
+    if plan_only_path is not None:
+        if not (do_pre_processing or do_post_processing):
+            print("    ERROR plan_only=" + plan_only_path + " can only be used when pre-processing or post-processing.")
+            unacceptable_parameters = True
+        if journal_path is not None:
+            print("    ERROR plan_only=" + plan_only_path + " cannot be used with a journal.")
+            unacceptable_parameters = True
+    if apply_plan_path is not None:
+        if not is_file(apply_plan_path):
+            print("    ERROR apply_plan=" + apply_plan_path + " does not exist or is not a file.")
+            unacceptable_parameters = True
+        elif plan_folder_parameters(apply_plan_path) != plan_folder_parameters(None):
+            print("    ERROR apply_plan=" + apply_plan_path + " was planned with different folder parameters=" +
+                  json.dumps(plan_folder_parameters(apply_plan_path), sort_keys=True))
+            unacceptable_parameters = True
+        if journal_path is not None:
+            print("    ERROR apply_plan=" + apply_plan_path + " cannot be used with a journal.")
+            unacceptable_parameters = True
+
+
+# The folders of the plan's parameters (or the current parameters when plan_path is None). A plan is only applied with
+# the same folders as it was planned with.
+def plan_folder_parameters(plan_path):
+    if plan_path is None:
+        parameters = journal_parameters()
+    else:
+        with open(plan_path, "rb") as plan_file:
+            plan_record = json.loads(plan_file.readline().decode("utf-8") or "null")
+        if not isinstance(plan_record, list) or not plan_record or plan_record[0] != "PLAN":
+            return None
+        parameters = plan_record[1]
+    return dict((parameter_name, parameters.get(parameter_name)) for parameter_name in PLAN_FOLDER_PARAMETER_NAMES)
+
+
+def validate_shards_parameters():
+    global unacceptable_parameters
+    if shards < 1:
+        print("    ERROR shards=" + str(shards) + " must be at least 1.")
+        unacceptable_parameters = True
+    elif shards > 1:
+        if not (do_pre_processing or do_post_processing or do_list_unique_files):
+            print("    ERROR shards=" + str(shards) + " can only be used when pre-processing, post-processing or " +
+                  "listing unique files.")
+            unacceptable_parameters = True
+        if journal_path is not None or plan_only_path is not None:
+            print("    ERROR shards=" + str(shards) + " cannot be used with a journal or plan_only.")
+            unacceptable_parameters = True
+        if not hasattr(os, "fork"):
+            print("    ERROR shards=" + str(shards) + " requires processes to be forked, which this platform " +
+                  "doesn't support.")
+            unacceptable_parameters = True
+
+
+def validate_pipeline_parameters():
+    global pipeline_concurrency
+    global unacceptable_parameters
+    pipeline_concurrency = {}
+    for stage_concurrency in PIPELINE_DEFAULT_CONCURRENCY.split(",") + pipeline_concurrency_parameter.split(","):
+        stage_name, separator, stage_tasks = stage_concurrency.strip().partition("=")
+        if stage_name not in PIPELINE_STAGE_NAMES or not stage_tasks.strip().isdigit() or int(stage_tasks) < 1:
+            print("    ERROR pipeline_concurrency=" + pipeline_concurrency_parameter + " must be a comma-separated " +
+                  "list of stage=tasks, where stage is one of " + ", ".join(PIPELINE_STAGE_NAMES) +
+                  " and tasks is at least 1.")
+            unacceptable_parameters = True
+            break
+        pipeline_concurrency[stage_name] = int(stage_tasks)
+
+    if pipeline_queue_size < 1:
+        print("    ERROR pipeline_queue_size=" + str(pipeline_queue_size) + " must be at least 1.")
+        unacceptable_parameters = True
+
+    if pipeline:
+        if not do_pre_processing:
+            print("    ERROR pipeline can only be used when pre-processing.")
+            unacceptable_parameters = True
+        if journal_path is not None or shards > 1 or workers > 1 or batch_by_issue:
+            print("    ERROR pipeline cannot be used with a journal, shards, workers or batch_by_issue (use " +
+                  "pipeline_concurrency instead).")
+            unacceptable_parameters = True
+        if sys.version_info < (3, 7):
+            print("    ERROR pipeline requires Python 3.7 or later.")
+            unacceptable_parameters = True
+
+
+def validate_inventory_snapshot_parameters():
+    global unacceptable_parameters
+    if inventory_snapshot_path is None:
+        return
+    if not do_pre_processing:
+        print("    ERROR inventory_snapshot=" + inventory_snapshot_path + " can only be used when pre-processing.")
+        unacceptable_parameters = True
+    if journal_path is not None or plan_only_path is not None or pipeline:
+        print("    ERROR inventory_snapshot=" + inventory_snapshot_path + " cannot be used with a journal, " +
+              "plan_only or pipeline.")
+        unacceptable_parameters = True
+
+
+def validate_watch_parameters():
+    global unacceptable_parameters
+    if not watch:
+        if control_socket_path is not None:
+            print("    ERROR control_socket=" + control_socket_path + " can only be used when watching.")
+            unacceptable_parameters = True
+        return
+
+    if not (do_pre_processing or do_post_processing):
+        print("    ERROR watch can only be used when pre-processing or post-processing.")
+        unacceptable_parameters = True
+    if journal_path is not None or plan_only_path is not None or pipeline or shards > 1:
+        print("    ERROR watch cannot be used with a journal, plan_only, pipeline or shards.")
+        unacceptable_parameters = True
+    for watch_parameter_name, watch_parameter_value, minimum_value in [
+            ("watch_interval", watch_interval, 1), ("watch_settle_seconds", watch_settle_seconds, 0),
+            ("watch_batch_size", watch_batch_size, 1), ("watch_cache_refresh_seconds", watch_cache_refresh_seconds, 1)]:
+        if watch_parameter_value < minimum_value:
+            print("    ERROR " + watch_parameter_name + "=" + str(watch_parameter_value) + " must be at least " +
+                  str(minimum_value) + ".")
+            unacceptable_parameters = True
+    if control_socket_path is not None:
+        if not hasattr(socket, "AF_UNIX"):
+            print("    ERROR control_socket=" + control_socket_path + " requires Unix sockets, which this " +
+                  "platform doesn't support.")
+            unacceptable_parameters = True
+        elif os.path.lexists(control_socket_path) and not stat.S_ISSOCK(os.lstat(control_socket_path).st_mode):
+            print("    ERROR control_socket=" + control_socket_path + " already exists and is not a socket.")
+            unacceptable_parameters = True
+        elif os.path.lexists(control_socket_path) and is_socket_listening(control_socket_path):
+            print("    ERROR control_socket=" + control_socket_path + " is being used by another watch.")
+            unacceptable_parameters = True
+
+
+def is_socket_listening(socket_path):
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client_socket.close()
+
+
+def validate_journal_parameters():
+    global resumed_journal_state
+    global unacceptable_parameters
+    if journal_path is None:
+        if resume:
+            print("    ERROR resume requires a journal.")
+            unacceptable_parameters = True
+        return
+
+    if do_list_unique_files:
+        print("    ERROR journal=" + journal_path + " can only be used when pre-processing or post-processing.")
+        unacceptable_parameters = True
+    elif resume:
+        if not is_file(journal_path):
+            print("    ERROR resume requires journal=" + journal_path + " to exist.")
+            unacceptable_parameters = True
+            return
+        resumed_journal_state = JournalState.load(journal_path)
+        if resumed_journal_state.parameters != journal_parameters():
+            print("    ERROR journal=" + journal_path + " was written with different parameters=" +
+                  json.dumps(resumed_journal_state.parameters, sort_keys=True))
+            unacceptable_parameters = True
+        elif resumed_journal_state.is_run_complete:
+            print("    ERROR journal=" + journal_path + " is for a run that has already completed.")
+            unacceptable_parameters = True
+    elif is_file(journal_path) and not is_journal_run_complete(journal_path):
+        print("    ERROR journal=" + journal_path + " is for a run that did not complete. Use --resume to " +
+              "resume it, or remove the journal.")
+        unacceptable_parameters = True
+
+    print("")
+
+
 def timestamp_message(message_string):
     current_time = datetime.datetime.now()
     print(current_time.strftime(DATE_TIME_DISPLAY_FORMAT) + ": " + message_string)
@@ -375,74 +2031,318 @@ def convert_to_filename(file_path_string):
     return safe_filename
 
 
-def get_all_suffixed_files(root_directory_path, suffix):
-    all_files = []
-    timestamp_message("finding all files with case-insensitive suffix='" + suffix + "' on path=" + root_directory_path)
-    lower_suffix = suffix.lower()
-    for root, dirs, files in os.walk(root_directory_path):
-        for file_name in files:
-            if file_name.lower().endswith(lower_suffix):
-                all_files.append(FairfaxFile(os.path.join(root, file_name)))
-    timestamp_message(str(len(all_files)) + " files found with case-insensitive suffix='" + suffix + "' on path=" +
-                      root_directory_path)
+def is_folder_outside_date_range(folder_name):
+    match = DATED_FOLDER_NAME_REGEX.search(folder_name)
+    if match is None:
+        return False
+    try:
+        folder_date = datetime.datetime.strptime(match.group("date"), DATE_PARSE_FORMAT).date()
+    except ValueError:
+        return False
+
+    return not starting_date <= folder_date <= ending_date
+
+
+# Yields the files under the folder in the same order as sorting all their full paths would. Entries in each folder
+# are sorted by name, with a '/' appended to sub-folder names so that sub-folders sort the same way as the paths
+# within them.
+# Like os.walk, symbolic links to folders are not followed. With crawl_threads, the sub-folders of each folder are
+# listed ahead by the directory crawler while the files before them are being yielded.
+def scan_files(folder_path, include_file_name=None, only_in_date_range=False, prune_dated_folder_names=False):
+    try:
+        if directory_crawler is not None:
+            directory_entries, file_entries = directory_crawler.listing(folder_path)
+        else:
+            directory_entries, file_entries = read_directory(folder_path)
+    except OSError as scan_exception:
+        warn_unable_to_scan_folder(scan_exception)
+        return
+
+    directory_entries = unpruned_directory_entries(directory_entries, prune_dated_folder_names)
+    if directory_crawler is not None:
+        for directory_entry in directory_entries:
+            directory_crawler.prefetch(directory_entry.path, lambda prefetch_entry: not (
+                prune_dated_folder_names and is_folder_outside_date_range(prefetch_entry.name)))
+    sorted_entries = sorted([(entry.name + "/", entry) for entry in directory_entries] +
+                            [(entry.name, entry) for entry in file_entries])
+    for sort_name, entry in sorted_entries:
+        if sort_name.endswith("/"):
+            for fairfax_file in scan_files(entry.path, include_file_name, only_in_date_range,
+                                           prune_dated_folder_names):
+                yield fairfax_file
+        else:
+            fairfax_file = scanned_fairfax_file(entry, folder_path, include_file_name, only_in_date_range)
+            if fairfax_file is not None:
+                yield fairfax_file
+
+
+# Yields the new and changed files under the folder, in the same order as scan_files, and records the folders in the
+# source inventory. Folders with the same mtime as in the previous snapshot aren't listed: their files are recorded as
+# they were and only their sub-folders are walked. Files are new or changed when they have a different size or mtime.
+def inventory_files(folder_path, relative_path, include_file_name=None, only_in_date_range=False,
+                    prune_dated_folder_names=False):
+    try:
+        listing_time = time.time()
+        count_file_system_call("stat")
+        folder_mtime = os.stat(folder_path).st_mtime
+        previous_folder = source_inventory.previous_folder(relative_path)
+        if previous_folder is not None and previous_folder[0] == folder_mtime:
+            sub_folder_names, inventory_file_entries = previous_folder[1], previous_folder[2]
+            changed_entries = []
+            increment_statistic("inventory folders unchanged")
+            increment_statistic("inventory files unchanged", len(inventory_file_entries))
+        else:
+            directory_entries, file_entries = read_directory(folder_path)
+            increment_statistic("inventory folders listed")
+            sub_folder_names = [directory_entry.name for directory_entry in directory_entries]
+            inventory_file_entries, changed_entries, is_settled = inventory_file_changes(file_entries,
+                                                                                         previous_folder, listing_time)
+            if not is_settled:
+                # Listed again in the next check, when the unsettled files may be ready
+                folder_mtime = None
+    except OSError as scan_exception:
+        warn_unable_to_scan_folder(scan_exception)
+        return
+
+    if folder_mtime is not None and folder_mtime >= listing_time - INVENTORY_RECENTLY_MODIFIED_SECONDS:
+        folder_mtime = None
+    source_inventory.record_folder(relative_path, folder_mtime, sub_folder_names, inventory_file_entries)
+
+    sorted_entries = [(entry.name, entry) for entry in changed_entries]
+    for sub_folder_name in sub_folder_names:
+        if prune_dated_folder_names and is_folder_outside_date_range(sub_folder_name):
+            increment_statistic("folders pruned by date")
+        else:
+            sorted_entries.append((sub_folder_name + "/", None))
+    sorted_entries.sort(key=lambda sorted_entry: sorted_entry[0])
+    for sort_name, entry in sorted_entries:
+        if entry is None:
+            for fairfax_file in inventory_files(os.path.join(folder_path, sort_name[:-1]),
+                                                os.path.join(relative_path, sort_name[:-1]), include_file_name,
+                                                only_in_date_range, prune_dated_folder_names):
+                yield fairfax_file
+        else:
+            fairfax_file = scanned_fairfax_file(entry, folder_path, include_file_name, only_in_date_range)
+            if fairfax_file is not None:
+                yield fairfax_file
+
+
+# Returns the ([name, size, mtime] inventory entries, new or changed file entries, whether all the files are settled) of
+# a listed folder's files. When watching, files modified in the last watch_settle_seconds aren't settled: they are
+# neither recorded nor returned, so they are found again in a later check.
+def inventory_file_changes(file_entries, previous_folder, listing_time):
+    previous_files = {}
+    if previous_folder is not None:
+        previous_files = dict((file_name, (file_size, file_mtime))
+                              for file_name, file_size, file_mtime in previous_folder[2])
+    inventory_file_entries = []
+    changed_entries = []
+    is_settled = True
+    for entry in file_entries:
+        try:
+            entry_stat = entry.stat()
+        except OSError:
+            # Left out of the inventory, so that it is looked at again in the next run
+            changed_entries.append(entry)
+            continue
+        if watch and entry_stat.st_mtime >= listing_time - watch_settle_seconds:
+            increment_statistic("inventory files not yet settled")
+            is_settled = False
+            continue
+        inventory_file_entries.append([entry.name, entry_stat.st_size, entry_stat.st_mtime])
+        if previous_files.get(entry.name) == (entry_stat.st_size, entry_stat.st_mtime):
+            increment_statistic("inventory files unchanged")
+        else:
+            increment_statistic("inventory files new or changed")
+            changed_entries.append(entry)
+    return inventory_file_entries, changed_entries, is_settled
+
+
+# Yields the files under the folder in the order that the directory crawler lists their folders, which is only used
+# when all the files are sorted afterwards
+def crawl_files(folder_path, include_file_name=None, only_in_date_range=False, prune_dated_folder_names=False):
+    for directory_path, directory_entries, file_entries in directory_crawler.walk(
+            folder_path, onerror=warn_unable_to_scan_folder, is_ordered=False):
+        directory_entries[:] = unpruned_directory_entries(directory_entries, prune_dated_folder_names)
+        for entry in file_entries:
+            fairfax_file = scanned_fairfax_file(entry, directory_path, include_file_name, only_in_date_range)
+            if fairfax_file is not None:
+                yield fairfax_file
+
+
+# Yields (folder_path, file_entries) for each folder under the root folder, using the directory crawler if there is one.
+# When is_ordered is set, the folders are yielded depth-first in the same sorted order as scan_files.
+def walk_folders(root_directory_path, prune_dated_folder_names=False, is_ordered=False):
+    if directory_crawler is not None:
+        for folder_path, directory_entries, file_entries in directory_crawler.walk(
+                root_directory_path, onerror=warn_unable_to_scan_folder, is_ordered=is_ordered,
+                include_directory=lambda directory_entry: not (
+                    prune_dated_folder_names and is_folder_outside_date_range(directory_entry.name))):
+            directory_entries[:] = unpruned_directory_entries(directory_entries, prune_dated_folder_names)
+            if is_ordered:
+                directory_entries.sort(key=lambda directory_entry: directory_entry.name + "/")
+            yield folder_path, file_entries
+        return
+
+    folder_paths = [root_directory_path]
+    while folder_paths:
+        folder_path = folder_paths.pop()
+        try:
+            directory_entries, file_entries = read_directory(folder_path)
+        except OSError as scan_exception:
+            warn_unable_to_scan_folder(scan_exception)
+            continue
+        yield folder_path, file_entries
+        unpruned_entries = unpruned_directory_entries(directory_entries, prune_dated_folder_names)
+        if is_ordered:
+            unpruned_entries = sorted(unpruned_entries, key=lambda directory_entry: directory_entry.name + "/",
+                                      reverse=True)
+        folder_paths.extend(directory_entry.path for directory_entry in unpruned_entries)
+
+
+# All the files under the root folder (with names that include_file_name accepts) as a FairfaxFileTable
+def get_file_table(root_directory_path, description, include_file_name=None, prune_dated_folder_names=False):
+    timestamp_message("finding all files" + description + " on path=" + root_directory_path)
+    file_table = FairfaxFileTable()
+    for folder_path, file_entries in walk_folders(root_directory_path, prune_dated_folder_names):
+        file_table.add_folder(folder_path, [entry.name for entry in file_entries
+                                            if include_file_name is None or include_file_name(entry.name)])
+    timestamp_message(str(len(file_table)) + " files found" + description + " on path=" + root_directory_path)
+    return file_table
+
+
+def warn_unable_to_scan_folder(scan_exception):
+    print("")
+    timestamp_message("WARNING: Unable to scan folder=" + str(scan_exception.filename) + ", error=" +
+                      str(scan_exception))
+
+
+def unpruned_directory_entries(directory_entries, prune_dated_folder_names):
+    if not prune_dated_folder_names:
+        return directory_entries
+    unpruned_entries = []
+    for directory_entry in directory_entries:
+        if is_folder_outside_date_range(directory_entry.name):
+            increment_statistic("folders pruned by date")
+        else:
+            unpruned_entries.append(directory_entry)
+    return unpruned_entries
+
+
+def scanned_fairfax_file(entry, folder_path, include_file_name, only_in_date_range):
+    if include_file_name is not None and not include_file_name(entry.name):
+        return None
+    fairfax_file = FairfaxFile(entry.path, folder_path, entry.name)
+    if only_in_date_range and fairfax_file.is_fairfax_pdf_file and \
+            not starting_date <= fairfax_file.file_date <= ending_date:
+        increment_statistic("PDF files outside date range skipped while scanning")
+        return None
+    return fairfax_file
+
+
+# Unless no_global_sort is set, all the files are found and sorted before they are returned. Otherwise the files are
+# returned as they are found.
+def get_all_scanned_files(root_directory_path, description, include_file_name=None, only_in_date_range=False):
+    prune_dated_folder_names = prune_dated_folders and only_in_date_range
+    if no_global_sort:
+        timestamp_message("streaming all files" + description + " on path=" + root_directory_path)
+        if source_inventory is not None:
+            return inventory_files(root_directory_path, "", include_file_name, only_in_date_range,
+                                   prune_dated_folder_names)
+        return scan_files(root_directory_path, include_file_name, only_in_date_range, prune_dated_folder_names)
+
+    timestamp_message("finding all files" + description + " on path=" + root_directory_path)
+    if source_inventory is not None:
+        all_files = list(inventory_files(root_directory_path, "", include_file_name, only_in_date_range,
+                                         prune_dated_folder_names))
+    elif directory_crawler is not None:
+        all_files = list(crawl_files(root_directory_path, include_file_name, only_in_date_range,
+                                     prune_dated_folder_names))
+    else:
+        all_files = list(scan_files(root_directory_path, include_file_name, only_in_date_range,
+                                    prune_dated_folder_names))
+    timestamp_message(str(len(all_files)) + " files found" + description + " on path=" + root_directory_path)
 
     all_files.sort()
     return all_files
 
 
 def get_all_named_files(root_directory_path, filename):
-    all_files = []
-    timestamp_message("finding all files with case-insensitive name='" + filename + "' on path=" + root_directory_path)
     lower_filename = filename.lower()
-    for root, dirs, files in os.walk(root_directory_path):
-        for file_name in files:
-            if file_name.lower() == lower_filename:
-                all_files.append(FairfaxFile(os.path.join(root, file_name)))
-    timestamp_message(str(len(all_files)) + " files found with case-insensitive name='" + filename + "' on path=" +
-                      root_directory_path)
+    return get_all_scanned_files(root_directory_path, " with case-insensitive name='" + filename + "'",
+                                 lambda file_name: file_name.lower() == lower_filename)
 
-    all_files.sort()
-    return all_files
 
+def get_all_files(root_directory_path, only_in_date_range=False):
+    return get_all_scanned_files(root_directory_path, "", only_in_date_range=only_in_date_range)
 
-def get_all_files(root_directory_path):
-    all_files = []
-    timestamp_message("finding all files on path=" + root_directory_path)
-    for root, dirs, files in os.walk(root_directory_path):
-        for file_name in files:
-            all_files.append(FairfaxFile(os.path.join(root, file_name)))
-    timestamp_message(str(len(all_files)) + " files found on path=" + root_directory_path)
 
-    all_files.sort()
-    return all_files
+def total_files_description(all_files):
+    # Files that are still being scanned have no total yet
+    if isinstance(all_files, list):
+        return str(len(all_files))
+    return "?"
 
 
-def get_md5_sum(the_file):
+md5_read_buffers = threading.local()
+
+
+def md5_read_buffer():
+    # Each thread reuses its own read buffer rather than allocating a new one for every read
+    read_buffer = getattr(md5_read_buffers, "read_buffer", None)
+    if read_buffer is None:
+        read_buffer = bytearray(MD5_READ_BUFFER_SIZE)
+        md5_read_buffers.read_buffer = read_buffer
+    return read_buffer
+
+
+def calculate_md5_sum(the_file):
+    return calculate_digest(the_file, "md5")
+
+
+def calculate_digest(the_file, algorithm):
+    digest_hash = hashlib.new(algorithm)
+    count_file_system_call("open")
+    with io.open(the_file, "rb", buffering=0) as file_to_hash:
+        file_size = os.fstat(file_to_hash.fileno()).st_size
+        if file_size >= MD5_MMAP_THRESHOLD_SIZE:
+            mapped_file = mmap.mmap(file_to_hash.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest_hash.update(mapped_file)
+            finally:
+                mapped_file.close()
+        else:
+            read_buffer = md5_read_buffer()
+            read_buffer_view = memoryview(read_buffer)
+            bytes_read = file_to_hash.readinto(read_buffer)
+            while bytes_read:
+                digest_hash.update(read_buffer_view[:bytes_read])
+                bytes_read = file_to_hash.readinto(read_buffer)
+
+    return digest_hash.hexdigest()
+
+
+def calculate_md5_sum_with_retries(the_file, md5_function=calculate_md5_sum):
     max_attempts = 6
     attempt_count = 0
     time_delay_factors = [0.0, 0.3, 0.9, 4.0, 60.0, 120.0]
     is_successful_md5 = False
+    last_exception = None
     md5sum = ""
 
     # We'll try 5 times
     while not is_successful_md5 and attempt_count < max_attempts:
         attempt_count += 1
-        output = "<no-output-provided>"
         try:
-            if is_sun_os:
-                output = subprocess.check_output(["digest", "-a", "md5", "-v", the_file])
-                md5sum = str(output).split(" ")[3]
-            else:
-                output = subprocess.check_output(["md5sum", the_file])
-                md5sum = str(output).split(" ")[0]
-
+            md5sum = md5_function(the_file)
             is_successful_md5 = True
 
-        except subprocess.CalledProcessError:
+        except (IOError, OSError) as md5_exception:
+            last_exception = md5_exception
             print("")
             timestamp_message("WARNING md5 sum (attempt " + str(attempt_count) + "/" + str(max_attempts) +
                               " FAILED for file=" + the_file)
-            timestamp_message("    output=" + output)
+            timestamp_message("    error=" + str(md5_exception))
             if attempt_count < max_attempts:
                 delay = time_delay_factors[attempt_count]
                 timestamp_message("    delaying next md5 sum attempt for " + str(delay) + " seconds.")
@@ -453,16 +2353,157 @@ def get_md5_sum(the_file):
 
     if not is_successful_md5:
         # re-throw the last exception -- there's something more serious happening
-        raise
+        raise last_exception
 
     return md5sum
 
 
-def are_files_the_same(first_file_path, second_file_path):
-    first_file_md5 = get_md5_sum(first_file_path)
-    second_file_md5 = get_md5_sum(second_file_path)
+def get_md5_sum(the_file):
+    if digest_cache is None:
+        return calculate_md5_sum_with_retries(the_file)
+
+    return calculate_md5_sum_with_retries(the_file, calculate_digest_cached_md5_sum)
+
+
+# The stat is retried along with the md5 sum, since on a network file system it fails in the same ways
+def calculate_digest_cached_md5_sum(the_file):
+    count_file_system_call("stat")
+    file_stat = os.stat(the_file)
+    md5sum = digest_cache.lookup(file_stat)
+    if md5sum is None:
+        md5sum = calculate_md5_sum(the_file)
+        digest_cache.store(file_stat, md5sum)
+
+    return md5sum
+
 
-    is_same_file = first_file_md5 == second_file_md5
+# The md5 sum as it was calculated before get_md5_sum was done in-process. Only used for benchmark comparisons.
+def get_md5_sum_via_subprocess(the_file):
+    count_process_started()
+    if is_sun_os:
+        output = subprocess.check_output(["digest", "-a", "md5", "-v", the_file])
+        return output.decode().split(" ")[3].strip()
+    else:
+        output = subprocess.check_output(["md5sum", the_file])
+        return output.decode().split(" ")[0]
+
+
+def read_fingerprint(the_file, file_size):
+    # The fingerprint is the first and last blocks of the file, which is the whole file for small files
+    count_file_system_call("open")
+    with io.open(the_file, "rb") as file_to_read:
+        first_block = file_to_read.read(FINGERPRINT_BLOCK_SIZE)
+        last_block = b""
+        if file_size > FINGERPRINT_BLOCK_SIZE:
+            file_to_read.seek(max(FINGERPRINT_BLOCK_SIZE, file_size - FINGERPRINT_BLOCK_SIZE))
+            last_block = file_to_read.read(FINGERPRINT_BLOCK_SIZE)
+
+    return first_block, last_block
+
+
+def are_fingerprints_the_same(first_file_path, second_file_path, file_size):
+    try:
+        return read_fingerprint(first_file_path, file_size) == read_fingerprint(second_file_path, file_size)
+    except (IOError, OSError) as fingerprint_exception:
+        # The full md5 comparison retries on errors, so leave it to that
+        print("")
+        timestamp_message("WARNING fingerprint comparison FAILED, first=" + first_file_path + ", second=" +
+                          second_file_path + ", error=" + str(fingerprint_exception))
+        return None
+
+
+# Returns the manifest of the pre-process <date>/<title_code> folder that the file is in, or None if the file isn't in
+# one (or manifests aren't used)
+def issue_manifest_for_file(the_file):
+    if not use_issue_manifests or processing_plan is not None:
+        return None
+    folder_path = os.path.dirname(os.path.normpath(the_file))
+    if os.path.dirname(os.path.dirname(folder_path)) != os.path.normpath(target_pre_process_folder):
+        return None
+    with issue_manifests_lock:
+        issue_manifest = issue_manifests.get(folder_path)
+        if issue_manifest is None:
+            issue_manifest = IssueManifest(folder_path)
+            issue_manifests[folder_path] = issue_manifest
+    return issue_manifest
+
+
+def issue_manifest_md5_sum(the_file, file_stat):
+    issue_manifest = issue_manifest_for_file(the_file)
+    if issue_manifest is None:
+        return None
+    return issue_manifest.lookup(os.path.basename(the_file), file_stat)
+
+
+# The md5 sum is usually already known, from hashing the file while it was copied or from comparing its source with an
+# existing target: a moved file keeps its source's inode, and a copied file has its source's md5 sum, so source_stat
+# (taken before the move or copy) is looked up as well. The file is only read when neither is in the digest cache.
+def add_to_issue_manifest(the_file, source_stat=None):
+    issue_manifest = issue_manifest_for_file(the_file)
+    if issue_manifest is not None:
+        count_file_system_call("stat")
+        file_stat = os.stat(the_file)
+        md5sum = cached_md5_sum(file_stat)
+        if md5sum is None and source_stat is not None:
+            md5sum = cached_md5_sum(source_stat)
+        if md5sum is None:
+            md5sum = get_md5_sum(the_file)
+        issue_manifest.add(os.path.basename(the_file), file_stat, md5sum)
+
+
+def cached_md5_sum(file_stat):
+    if digest_cache is None:
+        return None
+    return digest_cache.lookup(file_stat, count_misses=False)
+
+
+# Comparisons are done in tiers, each one more expensive than the last:
+# 1. Different sizes means different files.
+# 2. Both md5 sums already in the digest cache.
+# 3. Different first or last blocks means different files. For files no bigger than two blocks this is conclusive.
+# 4. Full md5 sums.
+# second_file_digest is an (algorithm, digest) recorded for the second file elsewhere, such as in a mets.xml
+def are_files_the_same(first_file_path, second_file_path, second_file_size=None, second_file_digest=None):
+    if processing_plan is not None:
+        second_file_path = processing_plan.planned_file_source(second_file_path)
+    count_file_system_call("stat")
+    first_file_stat = os.stat(first_file_path)
+    file_size = first_file_stat.st_size
+    if second_file_size is None or second_file_size == file_size:
+        count_file_system_call("stat")
+        second_file_stat = os.stat(second_file_path)
+        second_file_size = second_file_stat.st_size
+
+    if file_size != second_file_size:
+        is_same_file = False
+        increment_statistic("comparisons resolved by size")
+    else:
+        first_file_md5 = cached_md5_sum(first_file_stat)
+        second_file_md5 = cached_md5_sum(second_file_stat)
+        if second_file_md5 is None:
+            second_file_md5 = issue_manifest_md5_sum(second_file_path, second_file_stat)
+        if second_file_md5 is None and second_file_digest is not None and second_file_digest[0] == "md5":
+            second_file_md5 = second_file_digest[1]
+        if first_file_md5 is not None and second_file_md5 is not None:
+            is_same_file = first_file_md5 == second_file_md5
+            increment_statistic("comparisons resolved by cached digest")
+        elif second_file_md5 is not None:
+            # Only the first file needs to be read
+            is_same_file = get_md5_sum(first_file_path) == second_file_md5
+            increment_statistic("comparisons resolved by full digest of first file")
+        elif second_file_digest is not None:
+            first_file_digest = calculate_md5_sum_with_retries(
+                first_file_path, lambda the_file: calculate_digest(the_file, second_file_digest[0]))
+            is_same_file = first_file_digest == second_file_digest[1]
+            increment_statistic("comparisons resolved by full digest of first file")
+        else:
+            is_same_fingerprint = are_fingerprints_the_same(first_file_path, second_file_path, file_size)
+            if is_same_fingerprint is False or (is_same_fingerprint and file_size <= 2 * FINGERPRINT_BLOCK_SIZE):
+                is_same_file = is_same_fingerprint
+                increment_statistic("comparisons resolved by partial fingerprint")
+            else:
+                is_same_file = get_md5_sum(first_file_path) == get_md5_sum(second_file_path)
+                increment_statistic("comparisons resolved by full digest")
 
     if verbose:
         if is_same_file:
@@ -482,29 +2523,301 @@ def non_duplicate_filename(file_path):
     extension = regex.group(2)
     # print("file_name_root=" + file_name_root + ", extension=" + extension)
     # print("")
-    file_name_exists = True
-    duplicate_index = 0
-    while file_name_exists:
-        candidate_file_name = file_name_root + "-DUPLICATE-" + str(duplicate_index) + extension
-        candidate_full_file_path = os.path.join(file_path_root, candidate_file_name)
-        file_name_exists = is_file_or_directory(candidate_full_file_path)
-        duplicate_index += 1
-
-    return candidate_full_file_path
+    return duplicate_names.allocate(file_path_root, file_name_root + "-DUPLICATE-", extension)
 
 
 def non_duplicate_directory(file_path):
-    directory_name_exists = True
-    duplicate_index = 0
-    while directory_name_exists:
-        candidate_directory_name = file_path + "-" + str(duplicate_index)
-        directory_name_exists = is_file_or_directory(candidate_directory_name)
-        duplicate_index += 1
+    return duplicate_names.allocate(os.path.dirname(file_path), os.path.basename(file_path) + "-", "")
 
-    return candidate_directory_name
 
+@contextlib.contextmanager
+def journal_unit(unit_path):
+    journal_units.unit = unit_path
+    yield
+    journal_units.unit = None
+    if processing_journal is not None:
+        processing_journal.write_record(["DONE", unit_path])
 
-def move_or_copy(source_file_path, target_file_or_folder):
+
+# Operations within another journaled operation are part of that operation, so they are not journaled themselves
+@contextlib.contextmanager
+def journal_operation(operation, source_path, target_path):
+    if processing_journal is None or getattr(journal_units, "is_operation_in_progress", False):
+        yield
+        return
+
+    sequence = processing_journal.begin_operation(getattr(journal_units, "unit", None), operation, source_path,
+                                                  target_path)
+    journal_units.is_operation_in_progress = True
+    try:
+        yield
+    finally:
+        journal_units.is_operation_in_progress = False
+    processing_journal.write_record(["END", sequence])
+
+
+def kernel_copy_functions():
+    # Each function copies up to the given count from the current position of the source to the current position of
+    # the target, returning 0 at the end of the source file.
+    copy_functions = []
+    if hasattr(os, "copy_file_range"):
+        copy_functions.append(lambda source_fd, target_fd, count: os.copy_file_range(source_fd, target_fd, count))
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        copy_functions.append(lambda source_fd, target_fd, count:
+                              os.sendfile(target_fd, source_fd, os.lseek(source_fd, 0, os.SEEK_CUR), count))
+    return copy_functions
+
+
+def copy_file_data(source_fd, target_fd):
+    copied_size = 0
+    for copy_function in kernel_copy_functions():
+        try:
+            os.lseek(source_fd, copied_size, os.SEEK_SET)
+            os.lseek(target_fd, copied_size, os.SEEK_SET)
+            chunk_size = copy_function(source_fd, target_fd, KERNEL_COPY_CHUNK_SIZE)
+            while chunk_size > 0:
+                copied_size += chunk_size
+                # sendfile leaves the source position unchanged
+                os.lseek(source_fd, copied_size, os.SEEK_SET)
+                chunk_size = copy_function(source_fd, target_fd, KERNEL_COPY_CHUNK_SIZE)
+            return copied_size
+        except OSError as copy_exception:
+            if copy_exception.errno not in KERNEL_COPY_UNSUPPORTED_ERRORS:
+                raise
+
+    os.lseek(source_fd, copied_size, os.SEEK_SET)
+    os.lseek(target_fd, copied_size, os.SEEK_SET)
+    chunk = os.read(source_fd, COPY_BUFFER_SIZE)
+    while chunk:
+        written_size = 0
+        while written_size < len(chunk):
+            written_size += os.write(target_fd, chunk[written_size:])
+        copied_size += len(chunk)
+        chunk = os.read(source_fd, COPY_BUFFER_SIZE)
+
+    return copied_size
+
+
+def copy_metadata(source_path, target_path, source_stat):
+    # Preserve what 'cp -a' preserves: ownership (where permitted), permissions and timestamps
+    try:
+        os.lchown(target_path, source_stat.st_uid, source_stat.st_gid)
+    except OSError:
+        pass
+    if not os.path.islink(target_path):
+        shutil.copystat(source_path, target_path)
+
+
+# Returns whether the hard link was made
+def link_file(source_file_path, target_file_path):
+    count_file_system_call("link")
+    try:
+        os.link(source_file_path, target_file_path)
+    except OSError as link_exception:
+        if link_exception.errno not in LINK_UNSUPPORTED_ERRORS:
+            raise
+        return False
+    increment_statistic("hard links created")
+    return True
+
+
+# Returns whether the target's data was reflinked to the source's data
+def reflink_file_data(source_fd, target_fd, source_device):
+    if fcntl is None or not sys.platform.startswith("linux") or source_device in reflink_unsupported_devices:
+        return False
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+    except (IOError, OSError) as reflink_exception:
+        if reflink_exception.errno not in LINK_UNSUPPORTED_ERRORS:
+            raise
+        if reflink_exception.errno in REFLINK_UNSUPPORTED_DEVICE_ERRORS:
+            # Reflinks from this file system aren't possible (to the target file systems), so don't try again
+            reflink_unsupported_devices.add(source_device)
+        return False
+    increment_statistic("reflinks created")
+    return True
+
+
+def copy_file(source_file_path, target_file_path):
+    count_file_system_call("copy")
+    if link_mode == "hardlink" and link_file(source_file_path, target_file_path):
+        return
+
+    source_fd = os.open(source_file_path, os.O_RDONLY)
+    try:
+        source_stat = os.fstat(source_fd)
+        # O_EXCL means an existing target is never overwritten
+        target_fd = os.open(target_file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        is_reflinked = False
+        copy_digests = None
+        try:
+            if link_mode in ["reflink", "auto"]:
+                is_reflinked = reflink_file_data(source_fd, target_fd, source_stat.st_dev)
+            if not is_reflinked and link_mode == "auto":
+                # Replace the empty target with a hard link instead
+                os.close(target_fd)
+                target_fd = None
+                os.remove(target_file_path)
+                if link_file(source_file_path, target_file_path):
+                    return
+                target_fd = os.open(target_file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            if not is_reflinked and copy_digest_algorithms is not None:
+                copied_size, copy_digests = copy_and_hash_file_data(source_fd, target_fd, copy_digest_algorithms)
+                increment_statistic("bytes copied", copied_size)
+            elif not is_reflinked:
+                increment_statistic("bytes copied", copy_file_data(source_fd, target_fd))
+        finally:
+            if target_fd is not None:
+                os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    copy_metadata(source_file_path, target_file_path, source_stat)
+    if copy_digests is not None:
+        store_copy_digests(source_stat, target_file_path, copy_digests)
+
+
+# Copies through a buffer (rather than in-kernel) so that the data can be hashed on its way to the target
+def copy_and_hash_file_data(source_fd, target_fd, algorithms):
+    digest_hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    read_buffer = md5_read_buffer()
+    read_buffer_view = memoryview(read_buffer)
+    source_file = io.FileIO(source_fd, closefd=False)
+    copied_size = 0
+    bytes_read = source_file.readinto(read_buffer)
+    while bytes_read:
+        chunk = read_buffer_view[:bytes_read]
+        for digest_hash in digest_hashes:
+            digest_hash.update(chunk)
+        written_size = 0
+        while written_size < bytes_read:
+            written_size += os.write(target_fd, chunk[written_size:])
+        copied_size += bytes_read
+        bytes_read = source_file.readinto(read_buffer)
+
+    return copied_size, collections.OrderedDict((algorithm, digest_hash.hexdigest())
+                                                for algorithm, digest_hash in zip(algorithms, digest_hashes))
+
+
+# The source and target digests are the same, so both go into the digest cache. When copies are verified, the target
+# is read again and checked against the first digest before any digests are stored, and a target that fails the check
+# is removed, so that a corrupt copy is never left in place or cached as a good one.
+def store_copy_digests(source_stat, target_file_path, copy_digests):
+    if verify_copies:
+        algorithm, digest = list(copy_digests.items())[0]
+        target_digest = calculate_digest(target_file_path, algorithm)
+        if target_digest != digest:
+            increment_statistic("copies FAILED verification")
+            count_file_system_call("remove")
+            os.remove(target_file_path)
+            raise IOError("Copy verification FAILED for target=" + target_file_path + " (which has been removed), " +
+                          algorithm + " copied=" + digest + ", " + algorithm + " of target=" + target_digest)
+        increment_statistic("copies verified")
+
+    count_file_system_call("stat")
+    target_stat = os.stat(target_file_path)
+    for algorithm, digest in copy_digests.items():
+        digest_cache.store(source_stat, digest, algorithm)
+        digest_cache.store(target_stat, digest, algorithm)
+    increment_statistic("files hashed while copying")
+
+
+def copy_path(source_path, target_path):
+    if os.path.islink(source_path):
+        os.symlink(os.readlink(source_path), target_path)
+        copy_metadata(source_path, target_path, os.lstat(source_path))
+    elif os.path.isdir(source_path):
+        source_stat = os.stat(source_path)
+        os.mkdir(target_path)
+        for entry_name in sorted(os.listdir(source_path)):
+            copy_path(os.path.join(source_path, entry_name), os.path.join(target_path, entry_name))
+        # The folder's timestamps are set after its contents have been copied, as copying them changes the timestamps
+        copy_metadata(source_path, target_path, source_stat)
+    else:
+        copy_file(source_path, target_path)
+
+
+def move_path(source_path, target_path):
+    count_file_system_call("rename")
+    try:
+        os.rename(source_path, target_path)
+    except OSError as move_exception:
+        if move_exception.errno != errno.EXDEV:
+            raise
+        # Different file systems, so copy and then remove the source. The copy is made under a temporary name and
+        # renamed when it is complete, so an existing target is always a complete one.
+        increment_statistic("moves between file systems")
+        partial_target_path = partial_path(target_path)
+        copy_path(source_path, partial_target_path)
+        count_file_system_call("rename")
+        os.rename(partial_target_path, target_path)
+        remove_path(source_path)
+
+
+def partial_path(target_path):
+    return os.path.join(os.path.dirname(target_path), "." + os.path.basename(target_path) + ".partial")
+
+
+def remove_path(the_path):
+    if os.path.isdir(the_path) and not os.path.islink(the_path):
+        known_directories.forget(the_path)
+        shutil.rmtree(the_path)
+    else:
+        os.remove(the_path)
+
+
+# Moves or copies the source to the target. If the target is a folder, the source is moved or copied into that folder.
+# Existing targets are never overwritten (like 'mv -n'). Returns whether the move or copy took place. When the caller
+# already knows that the target is a new path (from a listing of its folder), the target is not checked again.
+def move_or_copy(source_file_path, target_file_or_folder, is_target_a_new_path=False):
+    if is_target_a_new_path:
+        target_path = target_file_or_folder
+    elif is_directory(target_file_or_folder):
+        target_path = os.path.join(target_file_or_folder, os.path.basename(source_file_path))
+    else:
+        target_path = target_file_or_folder
+
+    if not is_target_a_new_path and is_existing_path_or_link(target_path):
+        if verbose:
+            print("Not overwriting existing target=" + target_path + ", source=" + source_file_path)
+        return False
+
+    operation = "move" if move_files else "copy"
+    if processing_plan is not None:
+        processing_plan.plan_move_or_copy(operation, source_file_path, target_path)
+    else:
+        with journal_operation(operation, source_file_path, target_path):
+            move_or_copy_path(operation, source_file_path, target_path)
+    if verbose:
+        print("'" + source_file_path + "' -> '" + target_path + "'")
+
+    return True
+
+
+def move_or_copy_path(operation, source_path, target_path):
+    try:
+        if operation == "move":
+            move_path(source_path, target_path)
+        else:
+            copy_path(source_path, target_path)
+    except OSError as move_or_copy_exception:
+        # The target folder may be a known directory that has since been removed
+        if move_or_copy_exception.errno != errno.ENOENT or \
+                not recover_known_directory(os.path.dirname(target_path)):
+            raise
+        move_or_copy_path(operation, source_path, target_path)
+
+
+def is_existing_path_or_link(the_path):
+    planned_type = planned_path_type(the_path)
+    if planned_type is not None:
+        return planned_type != PLANNED_REMOVED
+    count_file_system_call("stat")
+    return os.path.lexists(the_path)
+
+
+# The move or copy as it was done before move_or_copy was done in-process. Only used for benchmark comparisons.
+def move_or_copy_via_subprocess(source_file_path, target_file_or_folder):
+    count_process_started()
     command_list = []
     if move_files:
         command_list.append("mv")
@@ -517,8 +2830,6 @@ def move_or_copy(source_file_path, target_file_or_folder):
             command_list.append("-p")
         else:
             command_list.append("-a")
-    if len(move_or_copy_flags) > 0:
-        command_list.append(move_or_copy_flags)
 
     full_command = ""
     for argument in command_list:
@@ -528,22 +2839,21 @@ def move_or_copy(source_file_path, target_file_or_folder):
     full_command += " \"" + target_file_or_folder + "\""
 
     # Note that using shell=True has security implications (as there is no python checking of the full_command itself)
-    output = subprocess.check_output(full_command, shell=True)
-    if verbose:
-        print(output)
+    subprocess.check_output(full_command, shell=True)
 
 
 def delete_file(file_to_delete):
     if is_file(file_to_delete):
-        if is_sun_os:
-            command_list = ["rm", file_to_delete]
+        if processing_plan is not None:
+            processing_plan.plan_delete("delete-file", file_to_delete)
         else:
-            command_list = ["rm", "-f", file_to_delete]
-        output = subprocess.check_output(command_list)
+            with journal_operation("delete-file", file_to_delete, None):
+                count_file_system_call("remove")
+                os.remove(file_to_delete)
         sys.stdout.write('-')
         sys.stdout.flush()
         if verbose:
-            print(output)
+            print("removed '" + file_to_delete + "'")
     else:
         print("")
         timestamp_message("WARNING: Not deleting, not a file=" + file_to_delete)
@@ -551,12 +2861,15 @@ def delete_file(file_to_delete):
 
 def delete_folder(folder_to_delete):
     if is_directory(folder_to_delete):
-        command_list = ["rm", "-rf", folder_to_delete]
-        output = subprocess.check_output(command_list)
+        if processing_plan is not None:
+            processing_plan.plan_delete("delete-folder", folder_to_delete)
+        else:
+            known_directories.forget(folder_to_delete)
+            shutil.rmtree(folder_to_delete)
         sys.stdout.write('=')
         sys.stdout.flush()
         if verbose:
-            print(output)
+            print("removed directory '" + folder_to_delete + "'")
     else:
         print("")
         timestamp_message("WARNING: Not deleting, not a directory=" + folder_to_delete)
@@ -569,25 +2882,45 @@ def delete_folder(folder_to_delete):
 #                                                               |- mets.xml
 #                                                               |- streams/
 #                                                                       |- <pdf-files>
-def file_exists_post_processing(fairfax_file, post_processing_folder):
+def find_post_processing_file(fairfax_file, post_processing_folder):
+    if post_process_index is not None:
+        return post_process_index.find(fairfax_file)
+
     target_file_post_type = fairfax_file.title_code + "/" + str(fairfax_file.file_date.year) + "/" +\
                        fairfax_file.file_date_string + "/content/streams/" + fairfax_file.file_name
     target_file_path_newspapers = "" + post_processing_folder + "/newspapers/" + target_file_post_type
+    if is_file(target_file_path_newspapers):
+        return target_file_path_newspapers, None
+
+    target_file_path_magazines = "" + post_processing_folder + "/magazines/" + target_file_post_type
+    if is_file(target_file_path_magazines):
+        return target_file_path_magazines, None
+
+    return None, None
+
 
-    post_processing_file_exists = is_file(target_file_path_newspapers)
-    if post_processing_file_exists:
-        same_file = are_files_the_same(fairfax_file.full_path, target_file_path_newspapers)
-        file_comparison = FileComparison(fairfax_file.full_path, target_file_path_newspapers,
-                                         post_processing_file_exists, same_file)
+# The checksum recorded for the post-processed file in the mets.xml of its issue, as an (algorithm, digest), or None
+def mets_checksum_for_post_processing_file(target_file_path):
+    if not use_mets_checksums:
+        return None
+    content_folder = os.path.dirname(os.path.dirname(target_file_path))
+    checksum = mets_checksums_cache.checksums(content_folder + "/mets.xml").get(os.path.basename(target_file_path))
+    if checksum is not None:
+        increment_statistic("mets.xml checksums found")
+    return checksum
+
+
+def file_exists_post_processing(fairfax_file, post_processing_folder, issue_batch=None):
+    if issue_batch is not None and post_process_index is None:
+        target_file_path, target_file_size = issue_batch.find_post_processing_file(fairfax_file)
     else:
-        target_file_path_magazines = "" + post_processing_folder + "/magazines/" + target_file_post_type
-        post_processing_file_exists = is_file(target_file_path_magazines)
-        if post_processing_file_exists:
-            same_file = are_files_the_same(fairfax_file.full_path, target_file_path_magazines)
-            file_comparison = FileComparison(fairfax_file.full_path, target_file_path_magazines,
-                                             post_processing_file_exists, same_file)
-        else:
-            file_comparison = FileComparison(fairfax_file.full_path, None, False, False)
+        target_file_path, target_file_size = find_post_processing_file(fairfax_file, post_processing_folder)
+    if target_file_path is not None:
+        same_file = are_files_the_same(fairfax_file.full_path, target_file_path, target_file_size,
+                                       mets_checksum_for_post_processing_file(target_file_path))
+        file_comparison = FileComparison(fairfax_file.full_path, target_file_path, True, same_file)
+    else:
+        file_comparison = FileComparison(fairfax_file.full_path, None, False, False)
 
     # TODO What if it's the same-named file BUT NOT the same md5 hash? What do we do then?
     # Actually, we are probably better off assuming that if the same-named file is processed then
@@ -627,41 +2960,130 @@ def post_process_for_given_done_file(fairfax_file, post_processing_folder):
         if verbose:
             fairfax_file.show_values()
 
-        # TODO This won't copy files that start with '.'
-        done_source = fairfax_file.dirname + "/*"
         target_folder = post_processing_folder + "/" + newspapers_or_magazines_name + "/" + title_code +\
                         "/" + file_date_year_string + "/" + file_date_string
-        if is_file_or_directory(target_folder):
-            # TODO it already exists, make duplicate
-            target_folder = non_duplicate_directory(target_folder)
-            sys.stdout.write('#')
-            sys.stdout.flush()
+        # With workers, another 'done' folder with the same target must not be given the same duplicate name
+        with target_folder_lock(target_folder):
+            if is_file_or_directory(target_folder):
+                # TODO it already exists, make duplicate
+                target_folder = non_duplicate_directory(target_folder)
+                sys.stdout.write('#')
+                sys.stdout.flush()
 
-        make_directory_path(target_folder)
-        move_or_copy(done_source, target_folder)
-        sys.stdout.write(':')
-        sys.stdout.flush()
-        # The parent folder should now contain no files if a move took place
-        if move_files:
-            delete_folder(fairfax_file.dirname)
+            relocate_done_folder(fairfax_file.dirname, target_folder)
+
+
+target_folder_locks = [threading.Lock() for target_folder_lock_index in range(0, TARGET_FOLDER_LOCK_COUNT)]
+
+
+def target_folder_lock(target_folder):
+    return target_folder_locks[hash(target_folder) % TARGET_FOLDER_LOCK_COUNT]
+
+
+# The whole 'done' parent folder (including any dot files) becomes the target folder. When moving on the same file
+# system that is a single rename, otherwise the folder's tree is copied file by file.
+def relocate_done_folder(done_folder_path, target_folder):
+    relocation_start_time = time.time()
+    make_directory_path(os.path.dirname(target_folder))
+    if move_or_copy(done_folder_path, target_folder):
+        increment_statistic("post-process folders relocated")
+    sys.stdout.write(':')
+    sys.stdout.flush()
+
+    relocation_milliseconds = int((time.time() - relocation_start_time) * 1000)
+    increment_statistic("post-process relocation total milliseconds", relocation_milliseconds)
+    maximum_statistic("post-process relocation maximum milliseconds", relocation_milliseconds)
 
 
 def post_process_via_going_through_all_done_files(all_done_files):
+    start_time = time.time()
+    bytes_copied_before = processing_statistics.get("bytes copied", 0)
+    if shards > 1:
+        current_file_count = sum(run_in_shards(partition_by_date(all_done_files, post_processing_date_key),
+                                               post_process_done_files))
+        total_files = str(current_file_count)
+    else:
+        current_file_count = post_process_done_files(all_done_files)
+        total_files = total_files_description(all_done_files)
+
+    print("")
+    timestamp_message("Processing completed for 'done' files, status: " + str(current_file_count) + "/" + str(total_files))
+    relocated_folder_count = processing_statistics.get("post-process folders relocated", 0)
+    if relocated_folder_count > 0:
+        timestamp_message("    average relocation milliseconds=" +
+                          str(processing_statistics["post-process relocation total milliseconds"] //
+                              relocated_folder_count))
+    # Moves on the same file system are renames, so only copied bytes are counted
+    elapsed_seconds = max(time.time() - start_time, 0.000001)
+    timestamp_message("    issues per minute=" + "{0:.1f}".format(current_file_count * 60.0 / elapsed_seconds) +
+                      ", bytes copied per second=" +
+                      "{0:.0f}".format((processing_statistics.get("bytes copied", 0) - bytes_copied_before) /
+                                       elapsed_seconds))
+
+
+# Returns the number of 'done' files processed
+def post_process_done_files(all_done_files):
+    if workers > 1:
+        return post_process_done_files_in_parallel(all_done_files)
+
     current_file_count = 0
-    total_files = len(all_done_files)
+    total_files = total_files_description(all_done_files)
     for fairfax_done_file in all_done_files:
-        post_process_for_given_done_file(fairfax_done_file, target_post_process_folder)
+        post_process_done_file(fairfax_done_file)
 
         current_file_count += 1
         if current_file_count % 100 == 0:
             print("")
             timestamp_message("Processing 'done' files, status: " + str(current_file_count) + "/" + str(total_files))
 
-    print("")
-    timestamp_message("Processing completed for 'done' files, status: " + str(current_file_count) + "/" + str(total_files))
+    return current_file_count
+
 
+def post_process_done_file(fairfax_done_file):
+    with journal_unit(fairfax_done_file.full_path):
+        post_process_for_given_done_file(fairfax_done_file, target_post_process_folder)
+
+
+# Each 'done' folder is relocated by one of the workers. Folders with different targets don't affect each other, and
+# those with the same target (which need duplicate names) take turns. Only a few folders per worker are submitted
+# ahead, so the 'done' files can still be streamed.
+def post_process_done_files_in_parallel(all_done_files):
+    current_file_count = 0
+    total_files = total_files_description(all_done_files)
+    timestamp_message("Post-processing 'done' files with workers=" + str(workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending_futures = set()
+        try:
+            for fairfax_done_file in all_done_files:
+                if len(pending_futures) >= workers * POST_PROCESS_PENDING_FOLDERS_PER_WORKER:
+                    completed_futures, pending_futures = concurrent.futures.wait(
+                        pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    current_file_count = count_completed_done_files(completed_futures, current_file_count,
+                                                                    total_files)
+                pending_futures.add(executor.submit(post_process_done_file, fairfax_done_file))
+            current_file_count = count_completed_done_files(concurrent.futures.as_completed(pending_futures),
+                                                            current_file_count, total_files)
+        except BaseException:
+            for future in pending_futures:
+                future.cancel()
+            raise
+
+    return current_file_count
+
+
+def count_completed_done_files(completed_futures, current_file_count, total_files):
+    for future in completed_futures:
+        future.result()
+        current_file_count += 1
+        if current_file_count % 100 == 0:
+            print("")
+            timestamp_message("Processing 'done' files, status: " + str(current_file_count) + "/" + str(total_files))
+    return current_file_count
 
-def pre_process_for_given_pdf_file(fairfax_file, pre_processing_folder, post_processing_folder):
+
+# file_comparison is the result of file_exists_post_processing when it has already been found for the file
+def pre_process_for_given_pdf_file(fairfax_file, pre_processing_folder, post_processing_folder, issue_batch=None,
+                                   file_comparison=None):
     title_code = fairfax_file.title_code
     file_date = fairfax_file.file_date
     if verbose:
@@ -669,7 +3091,8 @@ def pre_process_for_given_pdf_file(fairfax_file, pre_processing_folder, post_pro
 
     process_file = False
     if starting_date <= file_date <= ending_date:
-        file_comparison = file_exists_post_processing(fairfax_file, post_processing_folder)
+        if file_comparison is None:
+            file_comparison = file_exists_post_processing(fairfax_file, post_processing_folder, issue_batch)
         if file_comparison.are_files_the_same:
             process_file = False
             if verbose:
@@ -702,10 +3125,14 @@ def pre_process_for_given_pdf_file(fairfax_file, pre_processing_folder, post_pro
             if verbose:
                 print(starting_date.strftime(DATE_DISPLAY_FORMAT) + " <= " +
                       file_date.strftime(DATE_DISPLAY_FORMAT) + " < =" + ending_date.strftime(DATE_DISPLAY_FORMAT))
-            make_directory_path(target_folder_for_file)
             candidate_target_name = target_folder_for_file + "/" + target_file_name
             target_file_name = candidate_target_name
-            if is_file_or_directory(candidate_target_name):
+            if issue_batch is not None:
+                is_existing_target = issue_batch.target_folder_contains(fairfax_file.file_name)
+            else:
+                make_directory_path(target_folder_for_file)
+                is_existing_target = is_file_or_directory(candidate_target_name)
+            if is_existing_target:
                 if are_files_the_same(fairfax_file.full_path, candidate_target_name):
                     process_file = False
                     if verbose:
@@ -739,7 +3166,17 @@ def pre_process_for_given_pdf_file(fairfax_file, pre_processing_folder, post_pro
         else:
             sys.stdout.write('.')
             sys.stdout.flush()
-        move_or_copy(fairfax_file.full_path, actual_target)
+        source_stat = None
+        if use_issue_manifests and processing_plan is None:
+            count_file_system_call("stat")
+            source_stat = os.stat(fairfax_file.full_path)
+        if issue_batch is not None:
+            is_moved_or_copied = move_or_copy(fairfax_file.full_path, target_file_name, is_target_a_new_path=True)
+            issue_batch.add_to_target_folder(os.path.basename(target_file_name))
+        else:
+            is_moved_or_copied = move_or_copy(fairfax_file.full_path, actual_target)
+        if is_moved_or_copied:
+            add_to_issue_manifest(target_file_name, source_stat)
 
     return process_file
 
@@ -768,33 +3205,141 @@ def pre_process_for_other_file(fairfax_file, unprocessed_other_folder):
     sys.stdout.flush()
 
 
+def issue_key(fairfax_file):
+    return fairfax_file.file_date_string, fairfax_file.title_code
+
+
+def group_files_by_issue(pdf_files):
+    files_by_issue = collections.OrderedDict()
+    for fairfax_file in pdf_files:
+        files_by_issue.setdefault(issue_key(fairfax_file), []).append(fairfax_file)
+    return files_by_issue
+
+
+def pre_process_issue_files(issue_files):
+    issue_batch = None
+    if batch_by_issue:
+        file_date_string, title_code = issue_key(issue_files[0])
+        issue_batch = IssueBatch(file_date_string, title_code, target_pre_process_folder, target_post_process_folder)
+        issue_batches.current = issue_batch
+
+    processed_count = 0
+    try:
+        for fairfax_file in issue_files:
+            with journal_unit(fairfax_file.full_path):
+                if pre_process_for_given_pdf_file(fairfax_file, target_pre_process_folder, target_post_process_folder,
+                                                  issue_batch):
+                    processed_count += 1
+    finally:
+        issue_batches.current = None
+
+    if issue_batch is not None:
+        increment_statistic("issue batches")
+        increment_statistic("issue batch files", len(issue_files))
+        increment_statistic("issue batch file system calls", issue_batch.file_system_call_count)
+        increment_statistic("issue batch processes started", issue_batch.processes_started_count)
+        if verbose:
+            timestamp_message("Issue batch date=" + issue_batch.file_date_string + ", title_code=" +
+                              issue_batch.title_code + ", files=" + str(len(issue_files)) + ", file system calls=" +
+                              str(issue_batch.file_system_call_count) + ", processes started=" +
+                              str(issue_batch.processes_started_count))
+
+    return processed_count
+
+
+def pre_process_pdf_files_in_issue_batches(pdf_files):
+    files_by_issue = group_files_by_issue(pdf_files)
+    timestamp_message("Pre-processing " + str(len(pdf_files)) + " PDF files in " + str(len(files_by_issue)) +
+                      " date and title_code batches")
+    processed_count = 0
+    for issue_files in files_by_issue.values():
+        processed_count += pre_process_issue_files(issue_files)
+
+    return processed_count
+
+
+# Files with the same file_date_string and title_code share a pre-process target folder (and same-named files share a
+# for_review_folder target), so each of those groups is processed in sorted order by a single worker. No two groups
+# touch the same target, which means the results are exactly the same as processing the files sequentially.
+def pre_process_pdf_files_in_parallel(pdf_files):
+    files_by_issue = group_files_by_issue(pdf_files)
+
+    processed_count = 0
+    completed_issue_count = 0
+    total_issues = len(files_by_issue)
+    timestamp_message("Pre-processing " + str(len(pdf_files)) + " PDF files in " + str(total_issues) +
+                      " date and title_code groups with workers=" + str(workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(pre_process_issue_files, issue_files) for issue_files in files_by_issue.values()]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                processed_count += future.result()
+                completed_issue_count += 1
+                if completed_issue_count % 100 == 0:
+                    print("")
+                    timestamp_message("Processing status: date and title_code groups " + str(completed_issue_count) +
+                                      "/" + str(total_issues))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return processed_count
+
+
 def pre_process_via_going_through_all_files(all_files):
-    unprocessed_mets_folder = for_review_folder + "/UNPROCESSED/METS"
-    make_directory_path(unprocessed_mets_folder)
-    unprocessed_other_folder = for_review_folder + "/UNPROCESSED/OTHER"
-    make_directory_path(unprocessed_other_folder)
-    exists_in_post_but_not_same_file_folder_name = for_review_folder + "/" +\
-                                                   EXISTS_IN_POST_PROCESSING_BUT_NOT_THE_SAME_FILE_FOLDER_NAME
-    make_directory_path(exists_in_post_but_not_same_file_folder_name)
+    if shards > 1:
+        shard_results = run_in_shards(partition_by_date(all_files, pre_processing_date_key), pre_process_files)
+        file_counts = [sum(shard_counts) for shard_counts in zip(*shard_results)]
+        total_files = str(file_counts[0])
+    else:
+        file_counts = pre_process_files(all_files)
+        total_files = total_files_description(all_files)
+    display_pre_processing_summary(file_counts, total_files)
+
+
+def display_pre_processing_summary(file_counts, total_files):
+    current_file_count, pdf_files_checked_count, pdf_files_processed_count, mets_xml_files_processed_count, \
+        other_files_processed_count = file_counts
+
+    print("")
+    timestamp_message("Processing completed: " + str(current_file_count) + "/" + str(total_files))
+    # PDF files outside of the date range are dropped while scanning, so they are not counted as checked here.
+    timestamp_message("    PDF files in date range checked=" + str(pdf_files_checked_count) +
+                      ", processed=" + str(pdf_files_processed_count))
+    timestamp_message("    mets.xml files processed=" + str(mets_xml_files_processed_count))
+    timestamp_message("    other files processed=" + str(other_files_processed_count))
+
+
+# Returns the (files, PDF files checked, PDF files processed, mets.xml files processed, other files processed) counts
+def pre_process_files(all_files):
+    unprocessed_mets_folder, unprocessed_other_folder = make_for_review_folders()
 
     current_file_count = 0
     pdf_files_checked_count = 0
     pdf_files_processed_count = 0
     mets_xml_files_processed_count = 0
     other_files_processed_count = 0
-    total_files = len(all_files)
+    total_files = total_files_description(all_files)
+    pdf_files_for_workers = []
     for fairfax_file in all_files:
-        if fairfax_file.is_fairfax_pdf_file:
-            is_processed = pre_process_for_given_pdf_file(fairfax_file, target_pre_process_folder,
-                                                          target_post_process_folder)
+        if fairfax_file.is_fairfax_pdf_file and (workers > 1 or batch_by_issue):
+            # Processed in parallel or in issue batches once all the files have been found
+            pdf_files_for_workers.append(fairfax_file)
+        elif fairfax_file.is_fairfax_pdf_file:
+            with journal_unit(fairfax_file.full_path):
+                is_processed = pre_process_for_given_pdf_file(fairfax_file, target_pre_process_folder,
+                                                              target_post_process_folder)
             if is_processed:
                 pdf_files_processed_count += 1
             pdf_files_checked_count += 1
         elif pre_process_include_non_pdf_files and fairfax_file.is_mets_xml_file:
-            pre_process_for_unprocessed_mets_xml_file(fairfax_file, unprocessed_mets_folder)
+            with journal_unit(fairfax_file.full_path):
+                pre_process_for_unprocessed_mets_xml_file(fairfax_file, unprocessed_mets_folder)
             mets_xml_files_processed_count += 1
         elif pre_process_include_non_pdf_files:
-            pre_process_for_other_file(fairfax_file, unprocessed_other_folder)
+            with journal_unit(fairfax_file.full_path):
+                pre_process_for_other_file(fairfax_file, unprocessed_other_folder)
             other_files_processed_count += 1
 
         current_file_count += 1
@@ -802,44 +3347,799 @@ def pre_process_via_going_through_all_files(all_files):
             print("")
             timestamp_message("Processing status: " + str(current_file_count) + "/" + str(total_files))
 
-    print("")
-    timestamp_message("Processing completed: " + str(current_file_count) + "/" + str(total_files))
-    timestamp_message("    PDF files checked=" + str(pdf_files_checked_count) +
-                      ", processed=" + str(pdf_files_processed_count))
-    timestamp_message("    mets.xml files processed=" + str(mets_xml_files_processed_count))
-    timestamp_message("    other files processed=" + str(other_files_processed_count))
+    if workers > 1:
+        pdf_files_processed_count = pre_process_pdf_files_in_parallel(pdf_files_for_workers)
+        pdf_files_checked_count = len(pdf_files_for_workers)
+    elif batch_by_issue:
+        pdf_files_processed_count = pre_process_pdf_files_in_issue_batches(pdf_files_for_workers)
+        pdf_files_checked_count = len(pdf_files_for_workers)
 
+    return current_file_count, pdf_files_checked_count, pdf_files_processed_count, mets_xml_files_processed_count, \
+        other_files_processed_count
+
+
+# Returns the (unprocessed mets.xml, unprocessed other) folders
+def make_for_review_folders():
+    unprocessed_mets_folder = for_review_folder + "/UNPROCESSED/METS"
+    make_directory_path(unprocessed_mets_folder)
+    unprocessed_other_folder = for_review_folder + "/UNPROCESSED/OTHER"
+    make_directory_path(unprocessed_other_folder)
+    exists_in_post_but_not_same_file_folder_name = for_review_folder + "/" +\
+                                                   EXISTS_IN_POST_PROCESSING_BUT_NOT_THE_SAME_FILE_FOLDER_NAME
+    make_directory_path(exists_in_post_but_not_same_file_folder_name)
+    return unprocessed_mets_folder, unprocessed_other_folder
 
-def list_unique_files(all_files):
-    unique_files = set([])
-    for fairfax_file in all_files:
-        if fairfax_file.is_fairfax_pdf_file and starting_date <= fairfax_file.file_date <= ending_date:
-            unique_files.add(fairfax_file.file_name)
 
-    unique_files_list = []
-    for file_name in unique_files:
-        unique_files_list.append(FairfaxFile(file_name))
+# The source folder's listings go through the classify, compare and act stages of a pipeline (see
+# asyncio_staged_pipeline.py), so that scanning, reading files to compare them and moving or copying them all happen at
+# the same time. The folders are scanned in sorted order, but the files can reach the act stage in a different order
+# when there is more than one compare or act task. Files with the same file_date_string and title_code can go to the
+# same targets, so the act stage processes them one at a time.
+def pre_process_via_pipeline():
+    import asyncio_staged_pipeline
 
-    unique_files_list.sort(key=lambda fairfax_file: fairfax_file.file_date)
+    unprocessed_mets_folder, unprocessed_other_folder = make_for_review_folders()
+    file_counts = [0, 0, 0, 0, 0]
+
+    def count_processed_file(processed_file):
+        fairfax_file, is_processed = processed_file
+        if fairfax_file.is_fairfax_pdf_file:
+            file_counts[1] += 1
+            if is_processed:
+                file_counts[2] += 1
+        elif is_processed and fairfax_file.is_mets_xml_file:
+            file_counts[3] += 1
+        elif is_processed:
+            file_counts[4] += 1
+        file_counts[0] += 1
+        if file_counts[0] % 5000 == 0:
+            print("")
+            timestamp_message("Processing status: " + str(file_counts[0]) + "/?")
+
+    stages = [asyncio_staged_pipeline.PipelineStage("classify", classify_listed_files,
+                                                    pipeline_concurrency["classify"]),
+              asyncio_staged_pipeline.PipelineStage("compare", compare_classified_file,
+                                                    pipeline_concurrency["compare"]),
+              asyncio_staged_pipeline.PipelineStage("act", lambda compared_file: act_on_compared_file(
+                  compared_file, unprocessed_mets_folder, unprocessed_other_folder), pipeline_concurrency["act"])]
+    scanned_folders = walk_folders(source_folder, prune_dated_folders, is_ordered=True)
+    file_pipeline = asyncio_staged_pipeline.StagedPipeline("scan", scanned_folders, stages, pipeline_queue_size,
+                                                           count_processed_file)
+    timestamp_message("Pre-processing the files on path=" + source_folder + " in a pipeline with " +
+                      ", ".join(stage.name + "=" + str(stage.concurrency) for stage in stages) + " tasks")
+    file_pipeline.run()
+
+    display_pre_processing_summary(file_counts, str(file_counts[0]))
+    display_pipeline_statistics(file_pipeline)
+
+
+# Pipeline stage: (folder_path, file_entries) to the folder's files
+def classify_listed_files(folder_listing):
+    folder_path, file_entries = folder_listing
+    for entry in file_entries:
+        fairfax_file = scanned_fairfax_file(entry, folder_path, None, only_in_date_range=True)
+        if fairfax_file is not None:
+            yield fairfax_file
+
+
+# Pipeline stage: a file to (file, file_comparison), where only PDF files in the date range have a file_comparison
+def compare_classified_file(fairfax_file):
+    file_comparison = None
+    if fairfax_file.is_fairfax_pdf_file and starting_date <= fairfax_file.file_date <= ending_date:
+        file_comparison = file_exists_post_processing(fairfax_file, target_post_process_folder)
+    yield fairfax_file, file_comparison
+
+
+# Pipeline stage: (file, file_comparison) to (file, is_processed)
+def act_on_compared_file(compared_file, unprocessed_mets_folder, unprocessed_other_folder):
+    fairfax_file, file_comparison = compared_file
+    is_processed = False
+    if fairfax_file.is_fairfax_pdf_file:
+        with target_folder_lock(target_pre_process_folder + "/" + fairfax_file.file_date_string + "/" +
+                                fairfax_file.title_code):
+            is_processed = pre_process_for_given_pdf_file(fairfax_file, target_pre_process_folder,
+                                                          target_post_process_folder, file_comparison=file_comparison)
+    elif pre_process_include_non_pdf_files and fairfax_file.is_mets_xml_file:
+        pre_process_for_unprocessed_mets_xml_file(fairfax_file, unprocessed_mets_folder)
+        is_processed = True
+    elif pre_process_include_non_pdf_files:
+        pre_process_for_other_file(fairfax_file, unprocessed_other_folder)
+        is_processed = True
+    yield fairfax_file, is_processed
+
+
+def display_pipeline_statistics(file_pipeline):
+    elapsed_seconds = file_pipeline.elapsed_seconds
+    timestamp_message("Pipeline stages, elapsed seconds=" + "{:.1f}".format(elapsed_seconds))
+    for statistics in file_pipeline.all_statistics():
+        timestamp_message("    " + statistics.name + ": tasks=" + str(statistics.concurrency) +
+                          ", items in=" + str(statistics.items_in) + ", items out=" + str(statistics.items_out) +
+                          ", busy=" + "{:.0%}".format(statistics.utilisation(elapsed_seconds)) +
+                          ", input queue depth mean=" + "{:.1f}".format(statistics.mean_queue_depth()) +
+                          ", maximum=" + str(statistics.queue_depth_maximum) +
+                          ", seconds waiting for input=" + "{:.1f}".format(statistics.input_wait_seconds) +
+                          ", for output=" + "{:.1f}".format(statistics.output_wait_seconds))
+    timestamp_message("    limiting stage=" + file_pipeline.limiting_statistics().name)
+
+
+def list_unique_files(file_table):
+    pdf_rows = file_table.pdf_rows_in_date_range(starting_date, ending_date)
+    if shards > 1:
+        # A file's name includes its date, so each unique name is only in one shard
+        shard_rows = partition_by_date(pdf_rows, lambda row: file_table.date_ordinals[row])
+        shard_results = run_in_shards(shard_rows, lambda rows: unique_file_names_sorted_by_date(file_table, rows))
+        unique_file_names = [file_name for shard_file_names, shard_issue_count in shard_results
+                             for file_name in shard_file_names]
+        issue_count = sum(shard_issue_count for shard_file_names, shard_issue_count in shard_results)
+    else:
+        unique_file_names, issue_count = unique_file_names_sorted_by_date(file_table, pdf_rows)
 
     print("")
     timestamp_message("Files by name sorted by date")
-    for fairfax_file in unique_files_list:
-        print(fairfax_file.file_name)
+    for file_name in unique_file_names:
+        print(file_name)
     print("")
+    timestamp_message(str(len(unique_file_names)) + " unique files in " + str(issue_count) +
+                      " date and title_code issues")
+
+
+# Returns the unique file names of the rows sorted by date and then name, and the number of issues they are in
+def unique_file_names_sorted_by_date(file_table, rows):
+    unique_rows = {}
+    for row in rows:
+        unique_rows.setdefault(file_table.file_names[row], row)
+    unique_file_names = [file_table.file_names[row] for row in file_table.rows_sorted_by_date(unique_rows.values())]
+    return unique_file_names, len(file_table.rows_by_issue(rows))
+
+
+def pre_processing_date_key(fairfax_file):
+    if fairfax_file.is_fairfax_pdf_file:
+        return fairfax_file.file_date_string
+    return None
+
+
+# The date of the folder that the 'done' file's folder becomes, which is part of the target folder path
+def post_processing_date_key(fairfax_done_file):
+    done_parent_name = os.path.basename(fairfax_done_file.dirname)
+    if "_" in done_parent_name:
+        return done_parent_name.split("_")[1]
+    return None
+
+
+# Splits the items into shards lists, each with whole dates (as given by date_key) in date order and about the same
+# number of items. Files with the same date share their targets, so no two shards change the same target. Items
+# without a date, which don't share targets by date, are in the first shard. Items keep their order within a shard.
+def partition_by_date(items, date_key):
+    items = list(items)
+    item_date_keys = [date_key(item) for item in items]
+    item_counts_by_date = collections.Counter(item_date_key for item_date_key in item_date_keys
+                                              if item_date_key is not None)
+    total_dated_count = sum(item_counts_by_date.values())
+    shard_indexes_by_date = {}
+    items_before_date_count = 0
+    for item_date_key in sorted(item_counts_by_date):
+        shard_indexes_by_date[item_date_key] = min(shards - 1, items_before_date_count * shards // total_dated_count)
+        items_before_date_count += item_counts_by_date[item_date_key]
+
+    shard_items = [[] for shard_index in range(0, shards)]
+    for item, item_date_key in zip(items, item_date_keys):
+        shard_items[shard_indexes_by_date.get(item_date_key, 0)].append(item)
+    return shard_items
+
+
+# Runs shard_function(items) for each shard's items in a separate forked worker process, and returns what each shard
+# returned, in shard order. The processing statistics of the shards are merged into this process's statistics.
+def run_in_shards(shard_items, shard_function):
+    if hasattr(multiprocessing, "get_context"):
+        context = multiprocessing.get_context("fork")
+    else:
+        # Python 2.7 always forks on POSIX platforms
+        context = multiprocessing
+    timestamp_message("Processing in shards=" + str(len(shard_items)) + " with items=" +
+                      ", ".join(str(len(items)) for items in shard_items))
+    result_queue = context.Queue()
+    shard_processes = []
+    # Anything still buffered would be written again by each shard, and the shards can't see uncommitted digests
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if digest_cache is not None:
+        digest_cache.commit()
+    for shard_index, items in enumerate(shard_items):
+        shard_process = context.Process(target=run_shard, args=(shard_index, items, shard_function, result_queue))
+        shard_process.start()
+        shard_processes.append(shard_process)
+
+    # The results are read before waiting for the processes, which can't exit until their results have been read
+    shard_results = [None] * len(shard_items)
+    shard_errors = []
+    unfinished_shard_indexes = set(range(0, len(shard_processes)))
+    while unfinished_shard_indexes:
+        try:
+            shard_index, shard_error, shard_result, shard_statistics, shard_maximum_names = result_queue.get(
+                timeout=SHARD_RESULT_POLL_SECONDS)
+        except queue.Empty:
+            # A shard that was killed never returns its result
+            for shard_index in sorted(unfinished_shard_indexes):
+                if not shard_processes[shard_index].is_alive() and result_queue.empty():
+                    shard_errors.append("shard=" + str(shard_index) + ": exited with exitcode=" +
+                                        str(shard_processes[shard_index].exitcode))
+                    unfinished_shard_indexes.discard(shard_index)
+            continue
+        if shard_error is not None:
+            shard_errors.append("shard=" + str(shard_index) + ": " + shard_error)
+        shard_results[shard_index] = shard_result
+        merge_statistics(shard_statistics, shard_maximum_names)
+        unfinished_shard_indexes.discard(shard_index)
+    for shard_process in shard_processes:
+        shard_process.join()
+
+    if shard_errors:
+        raise RuntimeError("Processing failed in shards:\n" + "\n".join(shard_errors))
+    return shard_results
+
+
+def run_shard(shard_index, items, shard_function, result_queue):
+    global digest_cache
+    shard_error = None
+    shard_result = None
+    try:
+        # Only this shard's statistics are returned, and a SQLite connection can't be shared with the parent process
+        processing_statistics.clear()
+        maximum_statistic_names.clear()
+        if digest_cache is not None:
+            digest_cache = DigestCache(digest_cache.cache_path, digest_cache.max_age_days, digest_cache.max_entries,
+                                       DIGEST_CACHE_SHARD_COMMIT_BATCH_SIZE)
+        shard_result = shard_function(items)
+        if digest_cache is not None:
+            digest_cache.close(is_evicting=False)
+            digest_cache = None
+    except BaseException:
+        shard_error = traceback.format_exc()
+    try:
+        sys.stdout.flush()
+        result_queue.put((shard_index, shard_error, shard_result, list(processing_statistics.items()),
+                          list(maximum_statistic_names)))
+        result_queue.close()
+        result_queue.join_thread()
+    finally:
+        # The parent process's exit handlers (and threads) aren't this process's to run
+        os._exit(0)
+
+
+def open_directory_crawler():
+    global directory_crawler
+    if crawl_threads > 1:
+        directory_crawler = ParallelDirectoryCrawler(crawl_threads, read_directory)
+
+
+def close_directory_crawler():
+    global directory_crawler
+    if directory_crawler is not None:
+        directory_crawler.close()
+        directory_crawler = None
+
+
+def open_digest_cache():
+    global digest_cache
+    if digest_cache_path is not None:
+        timestamp_message("Opening digest cache=" + digest_cache_path)
+        digest_cache = DigestCache(digest_cache_path, digest_cache_max_age_days, digest_cache_max_entries)
+    elif copy_digest_algorithms is not None or use_issue_manifests:
+        # The digests calculated while copying or comparing are only kept for this run, so that the issue manifests
+        # can use them rather than reading the files again
+        digest_cache = DigestCache(":memory:", digest_cache_max_age_days, digest_cache_max_entries)
+
+
+def close_digest_cache():
+    global digest_cache
+    if digest_cache is not None:
+        digest_cache.close()
+        digest_cache = None
+
+
+def recover_journal_operation(operation, source_path, target_path):
+    if operation == "move":
+        # A move's target only appears once it is complete, but a move between file systems may have stopped part
+        # way through copying (leaving a partial copy) or part way through removing the source afterwards
+        if os.path.lexists(partial_path(target_path)):
+            remove_path(partial_path(target_path))
+        if os.path.lexists(target_path):
+            if os.path.lexists(source_path):
+                remove_path(source_path)
+        elif os.path.lexists(source_path):
+            move_path(source_path, target_path)
+    elif operation == "copy":
+        if os.path.lexists(source_path) and os.path.lexists(target_path):
+            # Stopped part way through the copy
+            if os.path.isfile(source_path) and os.path.isfile(target_path) and \
+                    are_files_the_same(source_path, target_path):
+                return
+            remove_path(target_path)
+        if os.path.lexists(source_path):
+            copy_path(source_path, target_path)
+    elif operation == "delete-file":
+        if is_file(source_path):
+            os.remove(source_path)
+
+
+def recover_unfinished_journal_operations():
+    for unit, operation, source_path, target_path in resumed_journal_state.unfinished_operations():
+        timestamp_message("Recovering unfinished operation=" + operation + ", source=" + source_path + ", target=" +
+                          str(target_path))
+        sequence = processing_journal.begin_operation(unit, operation, source_path, target_path)
+        recover_journal_operation(operation, source_path, target_path)
+        processing_journal.write_record(["END", sequence])
+        if unit is not None:
+            resumed_journal_state.done_units.add(unit)
+        increment_statistic("journal operations recovered")
+
+
+def resumed_files(all_files):
+    for fairfax_file in all_files:
+        if fairfax_file.full_path in resumed_journal_state.done_units:
+            increment_statistic("journal files already done")
+        elif not os.path.lexists(fairfax_file.full_path):
+            increment_statistic("journal files no longer in source folder")
+        else:
+            yield fairfax_file
 
 
-def processing_loop():
+def journal_found_files(all_files):
+    if isinstance(all_files, list):
+        for fairfax_file in all_files:
+            processing_journal.write_record(["FOUND", fairfax_file.full_path])
+        processing_journal.write_record(["SCAN-COMPLETE"])
+        return all_files
+
+    def journal_found_files_as_found():
+        for found_fairfax_file in all_files:
+            processing_journal.write_record(["FOUND", found_fairfax_file.full_path])
+            yield found_fairfax_file
+        processing_journal.write_record(["SCAN-COMPLETE"])
+
+    return journal_found_files_as_found()
+
+
+def open_processing_journal():
+    global processing_journal
+    if journal_path is None:
+        return
+    if resumed_journal_state is None:
+        timestamp_message("Starting journal=" + journal_path)
+        processing_journal = ProcessingJournal(journal_path)
+        processing_journal.write_record(["RUN", journal_parameters()])
+    else:
+        timestamp_message("Resuming journal=" + journal_path)
+        processing_journal = ProcessingJournal(journal_path, resumed_journal_state.next_sequence, append=True)
+        recover_unfinished_journal_operations()
+
+
+def close_processing_journal():
+    global processing_journal
+    if processing_journal is not None:
+        processing_journal.close(is_run_complete=True)
+        processing_journal = None
+
+
+# When resuming a run where all the files were found, the source folder isn't scanned again
+def get_all_files_for_processing(get_all_files_function):
+    if resumed_journal_state is not None:
+        if resumed_journal_state.is_scan_complete:
+            timestamp_message("Using the " + str(len(resumed_journal_state.found_paths)) + " files found in journal=" +
+                              journal_path)
+            all_files = [FairfaxFile(found_path) for found_path in resumed_journal_state.found_paths]
+        else:
+            all_files = get_all_files_function()
+        all_files = resumed_files(all_files)
+        if not no_global_sort:
+            all_files = list(all_files)
+        return all_files
+
+    all_files = get_all_files_function()
+    if processing_journal is not None:
+        all_files = journal_found_files(all_files)
+    return all_files
+
+
+def open_source_inventory():
+    global source_inventory
+    if inventory_snapshot_path is None and not watch:
+        return
+    source_inventory = SourceInventory(inventory_snapshot_path, journal_parameters())
+    if inventory_snapshot_path is None:
+        return
+    if not is_file(inventory_snapshot_path):
+        timestamp_message("No inventory snapshot=" + inventory_snapshot_path + ", all folders will be listed")
+        return
+    try:
+        is_loaded = source_inventory.load()
+    except (IOError, OSError, EOFError, ValueError) as load_exception:
+        timestamp_message("WARNING: Unable to read inventory snapshot=" + inventory_snapshot_path + ", error=" +
+                          str(load_exception) + ", all folders will be listed")
+        source_inventory.previous_folders = {}
+        return
+    if is_loaded:
+        timestamp_message("Using inventory snapshot=" + inventory_snapshot_path + " of " +
+                          str(len(source_inventory.previous_folders)) + " folders")
+    else:
+        timestamp_message("Inventory snapshot=" + inventory_snapshot_path + " was written with different " +
+                          "parameters, all folders will be listed")
+        source_inventory.previous_folders = {}
+
+
+def close_source_inventory():
+    global source_inventory
+    if source_inventory is not None:
+        source_inventory.complete_scan()
+        if source_inventory.save():
+            timestamp_message("Saved inventory snapshot=" + inventory_snapshot_path)
+        elif inventory_snapshot_path is not None:
+            timestamp_message("Inventory snapshot=" + inventory_snapshot_path + " is unchanged")
+        source_inventory = None
+
+
+watch_condition = threading.Condition()
+watch_status = collections.OrderedDict()
+
+
+# Checks the source folder for new and changed files every watch_interval seconds (or when a flush is requested) and
+# processes them in batches of watch_batch_size, until stopped with SIGTERM or SIGINT. The source inventory is kept in
+# memory, so each check only lists the folders that have changed. The digest cache stays open throughout, and the
+# caches of folder contents are rebuilt every watch_cache_refresh_seconds so that they see the changes made by other
+# processes.
+def watch_source_folder():
+    global watch_stop_requested
+    global watch_flush_requested
+    watch_stop_requested = False
+    watch_flush_requested = False
+    with watch_condition:
+        watch_status.clear()
+        watch_status["state"] = "starting"
+        watch_status["started"] = datetime.datetime.now().strftime(DATE_TIME_DISPLAY_FORMAT)
+        watch_status["checks started"] = 0
+        watch_status["checks"] = 0
+        watch_status["checks failed"] = 0
+        watch_status["last check error"] = None
+        watch_status["batches"] = 0
+        watch_status["files processed"] = 0
+        watch_status["last check"] = None
+        watch_status["last check files found"] = 0
+        watch_status["caches rebuilt"] = None
+
+    timestamp_message("Watching source_folder=" + source_folder + " every " + str(watch_interval) + " seconds")
+    control_server = None
+    if control_socket_path is not None:
+        control_server = ControlServer(control_socket_path, handle_control_command)
+        timestamp_message("Listening for status and flush commands on control_socket=" + control_socket_path)
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, request_watch_stop)
+    try:
+        next_cache_refresh_time = time.time() + watch_cache_refresh_seconds
+        while not watch_stop_requested:
+            if time.time() >= next_cache_refresh_time:
+                refresh_watch_caches()
+                next_cache_refresh_time = time.time() + watch_cache_refresh_seconds
+            check_source_folder()
+            wait_for_next_check()
+    except KeyboardInterrupt:
+        # Some of the files found by the interrupted check may not have been processed, so they must be found again
+        source_inventory.recorded_folders = {}
+        print("")
+        timestamp_message("Watch interrupted")
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        if control_server is not None:
+            control_server.close()
+        with watch_condition:
+            watch_status["state"] = "stopped"
+            watch_condition.notify_all()
+    timestamp_message("Stopped watching source_folder=" + source_folder)
+
+
+# A check that fails is logged and counted, and the watch carries on. The files that it didn't process are found again
+# by the next check.
+def check_source_folder():
+    with watch_condition:
+        watch_status["state"] = "checking"
+        watch_status["checks started"] += 1
+
+    found_files = []
+    try:
+        found_files = process_source_folder_changes()
+        source_inventory.complete_scan()
+    except Exception as check_exception:
+        source_inventory.recorded_folders = {}
+        print("")
+        timestamp_message("ERROR: Check of source_folder=" + source_folder + " FAILED, the watch continues, error=" +
+                          str(check_exception))
+        print(traceback.format_exc())
+        increment_statistic("watch checks failed")
+        with watch_condition:
+            watch_status["checks failed"] += 1
+            watch_status["last check error"] = str(check_exception)
+    if digest_cache is not None:
+        digest_cache.commit()
+    if source_inventory.save(WATCH_INVENTORY_SAVE_SECONDS):
+        timestamp_message("Saved inventory snapshot=" + inventory_snapshot_path)
+
+    with watch_condition:
+        watch_status["state"] = "waiting"
+        watch_status["checks"] += 1
+        watch_status["last check"] = datetime.datetime.now().strftime(DATE_TIME_DISPLAY_FORMAT)
+        watch_status["last check files found"] = len(found_files)
+        watch_condition.notify_all()
+
+
+# Returns the new and changed files found in the source folder, once they have been processed
+def process_source_folder_changes():
     if do_pre_processing:
-        all_files = get_all_files(source_folder)
-        pre_process_via_going_through_all_files(all_files)
-    elif do_post_processing:
-        all_done_files = get_all_named_files(source_folder, "done")
-        post_process_via_going_through_all_done_files(all_done_files)
-    elif do_list_unique_files:
-        # We are really only looking for unique pdf files
-        all_pdf_files = get_all_suffixed_files(source_folder, ".pdf")
-        list_unique_files(all_pdf_files)
+        found_files = sorted(inventory_files(source_folder, "", only_in_date_range=True,
+                                             prune_dated_folder_names=prune_dated_folders))
+    else:
+        found_files = sorted(inventory_files(source_folder, "", lambda file_name: file_name.lower() == "done"))
+
+    if found_files:
+        print("")
+        timestamp_message(str(len(found_files)) + " new or changed files found on path=" + source_folder)
+        with watch_condition:
+            watch_status["state"] = "processing"
+    for batch_start in range(0, len(found_files), watch_batch_size):
+        if watch_stop_requested:
+            # The files that weren't processed are found again when the watch is restarted
+            source_inventory.recorded_folders = {}
+            break
+        batch_files = found_files[batch_start:batch_start + watch_batch_size]
+        if do_pre_processing:
+            pre_process_via_going_through_all_files(batch_files)
+        else:
+            post_process_via_going_through_all_done_files(batch_files)
+        with watch_condition:
+            watch_status["batches"] += 1
+            watch_status["files processed"] += len(batch_files)
+    return found_files
+
+
+def wait_for_next_check():
+    global watch_flush_requested
+    wait_until = time.time() + watch_interval
+    with watch_condition:
+        while not (watch_stop_requested or watch_flush_requested) and time.time() < wait_until:
+            watch_condition.wait(wait_until - time.time())
+        watch_flush_requested = False
+
+
+def refresh_watch_caches():
+    global post_process_index
+    global known_directories
+    global duplicate_names
+    global mets_checksums_cache
+    if index_post_process:
+        post_process_index = PostProcessIndex(target_post_process_folder, starting_date, ending_date)
+    known_directories = KnownDirectories()
+    duplicate_names = DuplicateNameIndex()
+    mets_checksums_cache = MetsChecksumsCache(METS_CHECKSUMS_CACHE_SIZE)
+    with issue_manifests_lock:
+        issue_manifests.clear()
+    increment_statistic("watch cache rebuilds")
+    with watch_condition:
+        watch_status["caches rebuilt"] = datetime.datetime.now().strftime(DATE_TIME_DISPLAY_FORMAT)
+
+
+def request_watch_stop(signal_number=None, stack_frame=None):
+    global watch_stop_requested
+    watch_stop_requested = True
+    with watch_condition:
+        watch_condition.notify_all()
+
+
+# Run by the control server's threads. A flush waits until a check that started after it was requested has finished.
+def handle_control_command(command):
+    global watch_flush_requested
+    with watch_condition:
+        if command == "status":
+            status = collections.OrderedDict(watch_status)
+            with processing_statistics_lock:
+                status["statistics"] = collections.OrderedDict(processing_statistics)
+            return status
+        if command == "flush":
+            flushed_check = watch_status["checks started"] + 1
+            watch_flush_requested = True
+            watch_condition.notify_all()
+            while watch_status["checks"] < flushed_check:
+                if watch_status["state"] == "stopped":
+                    return {"flush": "stopped"}
+                watch_condition.wait()
+            return {"flush": "done", "files found": watch_status["last check files found"]}
+    return {"error": "unknown command=" + command + ", the commands are status and flush"}
+
+
+def open_processing_plan():
+    global processing_plan
+    if plan_only_path is not None:
+        timestamp_message("Writing plan=" + plan_only_path + ", no files will be moved, copied or deleted")
+        processing_plan = ProcessingPlan(plan_only_path)
+        processing_plan.write_record(["PLAN", journal_parameters()])
+
+
+def close_processing_plan():
+    global processing_plan
+    if processing_plan is not None:
+        processing_plan.close()
+        timestamp_message("Plan=" + plan_only_path + " written with operations=" +
+                          str(processing_plan.operation_count))
+        processing_plan = None
+
+
+def load_processing_plan(plan_path):
+    plan_parameters = None
+    plan_operations = []
+    with open(plan_path, "rb") as plan_file:
+        for line in plan_file:
+            record = [journal_value(value) for value in json.loads(line.decode("utf-8"))]
+            if record[0] == "PLAN":
+                plan_parameters = record[1]
+            elif record[0] in PLAN_OPERATION_TYPES:
+                plan_operations.append(record)
+            else:
+                raise ValueError("Unknown operation=" + str(record[0]) + " in plan=" + plan_path)
+
+    return plan_parameters, plan_operations
+
+
+# The source must still be what was planned: the same size, and the same md5 sum if the digest cache has it
+def is_planned_source_unchanged(source_path, planned_size, planned_digest):
+    if not is_existing_path_or_link(source_path):
+        return False
+    if planned_size is None:
+        return True
+    count_file_system_call("stat")
+    source_stat = os.stat(source_path)
+    if source_stat.st_size != planned_size:
+        return False
+    cached_digest = cached_md5_sum(source_stat)
+    return cached_digest is None or planned_digest is None or cached_digest == planned_digest
+
+
+def skip_planned_operation(operation, source_path, reason):
+    print("")
+    timestamp_message("WARNING: Not applying planned " + operation + ", " + reason + ", source=" + source_path)
+    increment_statistic("plan operations skipped")
+
+
+# Returns the sources of the operations that were applied
+def apply_planned_moves_and_copies(plan_operations):
+    applied_sources = []
+    for operation, source_path, target_path, planned_size, planned_digest in plan_operations:
+        if not is_planned_source_unchanged(source_path, planned_size, planned_digest):
+            skip_planned_operation(operation, source_path, "source has changed or no longer exists")
+        elif is_existing_path_or_link(target_path):
+            skip_planned_operation(operation, source_path, "target already exists=" + target_path)
+        else:
+            move_or_copy_path(operation, source_path, target_path)
+            if verbose:
+                print("'" + source_path + "' -> '" + target_path + "'")
+            else:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            increment_statistic("plan operations applied: " + operation)
+            applied_sources.append(source_path)
+
+    return applied_sources
+
+
+# Deleting a folder would lose files if any of the planned moves or deletes of the files in it were skipped, or if files
+# that weren't planned have been added to it since the plan was made. Returns why the folder can't be deleted, or None.
+def planned_folder_delete_problem(plan_operation, applied_sources):
+    folder_path = plan_operation[1]
+    if len(plan_operation) < 7:
+        return "the plan does not list the folder's files"
+    planned_sources = [journal_value(planned_source) for planned_source in plan_operation[5]]
+    remaining_paths = set(journal_value(remaining_path) for remaining_path in plan_operation[6])
+    for planned_source in planned_sources:
+        if planned_source not in applied_sources:
+            return "the planned operation for file=" + planned_source + " was not applied"
+    for walked_folder_path, folder_names, file_names in os.walk(folder_path):
+        linked_folder_names = [name for name in folder_names if os.path.islink(os.path.join(walked_folder_path, name))]
+        for name in file_names + linked_folder_names:
+            the_path = os.path.join(walked_folder_path, name)
+            if the_path not in remaining_paths:
+                return "the folder has an unplanned file=" + the_path
+    return None
+
+
+# Folders are created first (parents before children), then moves and copies are done in batches of the same target
+# folder, sorted by source within each batch. Batches have different targets, so with workers they are done in
+# parallel. Deletes are done last, files before folders. A folder is only deleted when all the planned operations on
+# the files in it were applied.
+def apply_processing_plan(plan_path):
+    plan_parameters, plan_operations = load_processing_plan(plan_path)
+    timestamp_message("Applying plan=" + plan_path + " with operations=" + str(len(plan_operations)) +
+                      ", planned with parameters=" + json.dumps(plan_parameters, sort_keys=True))
+    operations_by_type = dict((operation_type, []) for operation_type in PLAN_OPERATION_TYPES)
+    for plan_operation in plan_operations:
+        operations_by_type[plan_operation[0]].append(plan_operation)
+
+    for plan_operation in sorted(operations_by_type["mkdir"], key=lambda mkdir_operation: mkdir_operation[2]):
+        make_directory_path(plan_operation[2])
+        increment_statistic("plan operations applied: mkdir")
+
+    target_folder_batches = collections.OrderedDict()
+    for plan_operation in sorted(operations_by_type["move"] + operations_by_type["copy"],
+                                 key=lambda file_operation: (os.path.dirname(file_operation[2]), file_operation[1])):
+        target_folder_batches.setdefault(os.path.dirname(plan_operation[2]), []).append(plan_operation)
+    timestamp_message("Applying " + str(len(operations_by_type["move"]) + len(operations_by_type["copy"])) +
+                      " moves and copies in " + str(len(target_folder_batches)) + " target folder batches")
+    applied_sources = set()
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(apply_planned_moves_and_copies, batch_operations)
+                       for batch_operations in target_folder_batches.values()]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    applied_sources.update(future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    else:
+        for batch_operations in target_folder_batches.values():
+            applied_sources.update(apply_planned_moves_and_copies(batch_operations))
+
+    for operation, source_path, target_path, planned_size, planned_digest in \
+            sorted(operations_by_type["delete-file"], key=lambda delete_operation: delete_operation[1]):
+        if is_planned_source_unchanged(source_path, planned_size, planned_digest):
+            delete_file(source_path)
+            increment_statistic("plan operations applied: " + operation)
+            applied_sources.add(source_path)
+        else:
+            skip_planned_operation(operation, source_path, "file has changed or no longer exists")
+
+    for plan_operation in sorted(operations_by_type["delete-folder"],
+                                 key=lambda delete_operation: delete_operation[1], reverse=True):
+        folder_delete_problem = planned_folder_delete_problem(plan_operation, applied_sources)
+        if folder_delete_problem is None:
+            delete_folder(plan_operation[1])
+            increment_statistic("plan operations applied: delete-folder")
+        else:
+            skip_planned_operation("delete-folder", plan_operation[1], folder_delete_problem)
+
+    print("")
+    timestamp_message("Applying plan completed for operations=" + str(len(plan_operations)))
+
+
+def processing_loop():
+    global post_process_index
+    open_digest_cache()
+    # The digest cache is closed even when processing fails, so that the md5 sums calculated so far are committed
+    try:
+        open_directory_crawler()
+        open_processing_journal()
+        open_processing_plan()
+        open_source_inventory()
+        if index_post_process:
+            post_process_index = PostProcessIndex(target_post_process_folder, starting_date, ending_date)
+        if apply_plan_path is not None:
+            apply_processing_plan(apply_plan_path)
+        elif watch:
+            watch_source_folder()
+        elif do_pre_processing and pipeline:
+            pre_process_via_pipeline()
+        elif do_pre_processing:
+            all_files = get_all_files_for_processing(lambda: get_all_files(source_folder, only_in_date_range=True))
+            pre_process_via_going_through_all_files(all_files)
+        elif do_post_processing:
+            all_done_files = get_all_files_for_processing(lambda: get_all_named_files(source_folder, "done"))
+            post_process_via_going_through_all_done_files(all_done_files)
+        elif do_list_unique_files:
+            # We are really only looking for unique pdf files
+            list_unique_files(get_file_table(source_folder, " with case-insensitive suffix='.pdf'",
+                                             lambda file_name: file_name.lower().endswith(".pdf"), prune_dated_folders))
+        close_source_inventory()
+        close_processing_plan()
+        close_processing_journal()
+    finally:
+        close_directory_crawler()
+        close_digest_cache()
+    display_processing_statistics()
 
     # for index in range(0, 5):
     #    print("Getting md5sum for file=" + all_files[index] + ", type=" + str(type(all_files[index])))
@@ -856,6 +4156,209 @@ def do_tests():
         test_fairfax_file.show_values()
 
 
+def benchmark_files_per_second(description, file_paths, file_function):
+    start_time = time.time()
+    for file_path in file_paths:
+        file_function(file_path)
+    elapsed_seconds = max(time.time() - start_time, 0.000001)
+    files_per_second = len(file_paths) / elapsed_seconds
+    timestamp_message("    " + description + ": " + str(len(file_paths)) + " files in " +
+                      "{0:.3f}".format(elapsed_seconds) + " seconds, " + "{0:.1f}".format(files_per_second) +
+                      " files/second")
+
+    return files_per_second
+
+
+def benchmark_md5_sums(benchmark_folder):
+    file_paths = []
+    for file_index in range(0, BENCHMARK_MD5_NUMBER_OF_FILES):
+        file_path = os.path.join(benchmark_folder, "BENCHED1-20190101-" + str(file_index).zfill(4) + ".pdf")
+        with open(file_path, "wb") as benchmark_file:
+            benchmark_file.write(os.urandom(BENCHMARK_MD5_FILE_SIZE))
+        file_paths.append(file_path)
+
+    for file_path in file_paths[:5]:
+        if get_md5_sum(file_path) != get_md5_sum_via_subprocess(file_path):
+            timestamp_message("ERROR md5 sums differ between in-process and subprocess for file=" + file_path)
+
+    timestamp_message("md5 sum benchmark, file size=" + str(BENCHMARK_MD5_FILE_SIZE) + " bytes:")
+    subprocess_rate = benchmark_files_per_second("subprocess md5", file_paths, get_md5_sum_via_subprocess)
+    in_process_rate = benchmark_files_per_second("in-process md5", file_paths, get_md5_sum)
+    timestamp_message("    in-process speedup=" + "{0:.1f}".format(in_process_rate / subprocess_rate) + "x")
+
+
+def benchmark_move_or_copy(benchmark_folder):
+    global move_files
+    original_move_files = move_files
+    try:
+        for move_files in [False, True]:
+            operation = "move" if move_files else "copy"
+            timestamp_message(operation + " benchmark, file size=" + str(BENCHMARK_MOVE_OR_COPY_FILE_SIZE) + " bytes:")
+            for description, move_or_copy_function in [("subprocess", move_or_copy_via_subprocess),
+                                                       ("in-process", move_or_copy)]:
+                source_folder_path = os.path.join(benchmark_folder, operation + "-" + description + "-source")
+                target_folder_path = os.path.join(benchmark_folder, operation + "-" + description + "-target")
+                os.mkdir(source_folder_path)
+                os.mkdir(target_folder_path)
+                file_paths = []
+                for file_index in range(0, BENCHMARK_MOVE_OR_COPY_NUMBER_OF_FILES):
+                    file_path = os.path.join(source_folder_path, "BENCHED1-20190101-" + str(file_index).zfill(4) +
+                                             ".pdf")
+                    with open(file_path, "wb") as benchmark_file:
+                        benchmark_file.write(os.urandom(BENCHMARK_MOVE_OR_COPY_FILE_SIZE))
+                    file_paths.append(file_path)
+                files_per_second = benchmark_files_per_second(
+                    description + " " + operation, file_paths,
+                    lambda file_path: move_or_copy_function(file_path, target_folder_path))
+                timestamp_message("        per-file latency=" + "{0:.3f}".format(1000.0 / files_per_second) + " ms")
+    finally:
+        move_files = original_move_files
+
+
+# The values of a FairfaxFile as a plain dict, with nothing shared between files, for comparison in the benchmark
+def fairfax_file_dict(file_path):
+    file_dict = {"file_name": os.path.basename(file_path), "dirname": os.path.dirname(file_path),
+                 "full_path": file_path}
+    match = FAIRFAX_PDF_FILE_REGEX.search(file_dict["file_name"])
+    if match is not None:
+        file_dict["title_code"] = match.group("titleCode")
+        file_dict["edition_code"] = match.group("editionCode")
+        file_dict["file_date_string"] = match.group("date")
+        file_dict["file_date"] = convert_string_to_date(file_dict["file_date_string"])
+        file_dict["qualifier"] = match.group("qualifier")
+        file_dict["extension"] = match.group("extension")
+    return file_dict
+
+
+def benchmark_fairfax_file_memory():
+    try:
+        import tracemalloc
+    except ImportError:
+        timestamp_message("FairfaxFile memory benchmark skipped, it requires tracemalloc (Python 3.4+)")
+        return
+
+    folder_paths = []
+    for folder_index in range(0, BENCHMARK_FAIRFAX_FILE_NUMBER_OF_FOLDERS):
+        folder_paths.append("/benchmark/source/" + str(folder_index).zfill(3) + "/2018")
+
+    file_names_by_folder = collections.OrderedDict((folder_path, []) for folder_path in folder_paths)
+    for file_index in range(0, BENCHMARK_FAIRFAX_FILE_NUMBER_OF_FILES):
+        folder_path = folder_paths[file_index % BENCHMARK_FAIRFAX_FILE_NUMBER_OF_FOLDERS]
+        file_name = "BEN" + "ABCDEFGHIJ"[file_index % 10] + "ED1-2018" + str(file_index % 12 + 1).zfill(2) +\
+                    str(file_index % 28 + 1).zfill(2) + "-A" + str(file_index % 100).zfill(3) + ".pdf"
+        file_names_by_folder[folder_path].append(file_name)
+
+    tracemalloc.start()
+    # The same values as the FairfaxFile instances hold, kept the way FairfaxFile kept them before it was made compact:
+    # a dict per file with its own full_path, dirname, codes and date
+    memory_before = tracemalloc.get_traced_memory()[0]
+    start_time = time.time()
+    file_dicts = []
+    for folder_path, file_names in file_names_by_folder.items():
+        for file_name in file_names:
+            file_dicts.append(fairfax_file_dict(folder_path + "/" + file_name))
+    file_dicts_seconds = time.time() - start_time
+    memory_after = tracemalloc.get_traced_memory()[0]
+    file_dicts_bytes = memory_after - memory_before
+
+    memory_before = tracemalloc.get_traced_memory()[0]
+    start_time = time.time()
+    fairfax_files = []
+    for folder_path, file_names in file_names_by_folder.items():
+        for file_name in file_names:
+            fairfax_files.append(FairfaxFile(folder_path + "/" + file_name, folder_path, file_name))
+    fairfax_files_seconds = time.time() - start_time
+    memory_after = tracemalloc.get_traced_memory()[0]
+    fairfax_files_bytes = memory_after - memory_before
+
+    # The file names are already in memory, so only the table's columns are counted
+    memory_before = tracemalloc.get_traced_memory()[0]
+    start_time = time.time()
+    file_table = FairfaxFileTable()
+    for folder_path, file_names in file_names_by_folder.items():
+        file_table.add_folder(folder_path, file_names)
+    file_table_seconds = time.time() - start_time
+    memory_after = tracemalloc.get_traced_memory()[0]
+    file_table_bytes = memory_after - memory_before
+    tracemalloc.stop()
+
+    timestamp_message("FairfaxFile memory benchmark, " + str(len(fairfax_files)) + " files in " +
+                      str(len(folder_paths)) + " folders:")
+    timestamp_message("    dict per file bytes per file=" + "{0:.1f}".format(float(file_dicts_bytes) /
+                                                                             len(file_dicts)) +
+                      ", seconds=" + "{0:.3f}".format(file_dicts_seconds))
+    timestamp_message("    FairfaxFile bytes per file=" + "{0:.1f}".format(float(fairfax_files_bytes) /
+                                                                           len(fairfax_files)) +
+                      ", seconds=" + "{0:.3f}".format(fairfax_files_seconds))
+    timestamp_message("    FairfaxFileTable bytes per file=" + "{0:.1f}".format(float(file_table_bytes) /
+                                                                                len(file_table)) +
+                      ", seconds=" + "{0:.3f}".format(file_table_seconds))
+
+
+def make_benchmark_crawl_tree(folder_path, depth, branches):
+    os.mkdir(folder_path)
+    for file_index in range(0, BENCHMARK_CRAWL_FILES_PER_FOLDER):
+        open(os.path.join(folder_path, "BENCHED1-20190101-" + str(file_index).zfill(4) + ".pdf"), "wb").close()
+    if depth > 0:
+        for branch_index in range(0, branches):
+            make_benchmark_crawl_tree(os.path.join(folder_path, str(branch_index).zfill(3)), depth - 1, branches)
+
+
+def benchmark_directory_crawl(benchmark_folder):
+    if concurrent is None:
+        timestamp_message("directory crawl benchmark skipped, it requires concurrent.futures")
+        return
+
+    def read_directory_with_latency(directory_path):
+        time.sleep(BENCHMARK_CRAWL_LISTING_LATENCY_SECONDS)
+        return read_directory(directory_path)
+
+    deep_tree_path = os.path.join(benchmark_folder, "crawl-deep")
+    make_benchmark_crawl_tree(deep_tree_path, BENCHMARK_CRAWL_DEEP_TREE_DEPTH, BENCHMARK_CRAWL_DEEP_TREE_BRANCHES)
+    wide_tree_path = os.path.join(benchmark_folder, "crawl-wide")
+    make_benchmark_crawl_tree(wide_tree_path, 1, BENCHMARK_CRAWL_WIDE_TREE_FOLDERS)
+    for tree_description, tree_path in [("deep", deep_tree_path), ("wide", wide_tree_path)]:
+        for latency_description, read_function in [("no added latency", read_directory),
+                                                   ("listing latency=" + str(BENCHMARK_CRAWL_LISTING_LATENCY_SECONDS) +
+                                                    " seconds", read_directory_with_latency)]:
+            timestamp_message("directory crawl benchmark, " + tree_description + " tree, " + latency_description + ":")
+            expected_paths = None
+            sequential_seconds = None
+            # Without any pending directories, the ordered walk lists each folder as it gets to it
+            crawl_configurations = [(1, 0, True),
+                                    (BENCHMARK_CRAWL_THREADS, CRAWL_MAXIMUM_PENDING_DIRECTORIES, True),
+                                    (BENCHMARK_CRAWL_THREADS, CRAWL_MAXIMUM_PENDING_DIRECTORIES, False)]
+            for threads, maximum_pending, is_ordered in crawl_configurations:
+                crawler = ParallelDirectoryCrawler(threads, read_function, maximum_pending)
+                start_time = time.time()
+                crawled_paths = [directory_path for directory_path, directory_entries, file_entries in
+                                 crawler.walk(tree_path, is_ordered=is_ordered)]
+                elapsed_seconds = max(time.time() - start_time, 0.000001)
+                crawler.close()
+                if expected_paths is None:
+                    expected_paths = crawled_paths
+                    sequential_seconds = elapsed_seconds
+                elif (crawled_paths if is_ordered else sorted(crawled_paths)) != \
+                        (expected_paths if is_ordered else sorted(expected_paths)):
+                    timestamp_message("ERROR folders crawled differ with threads=" + str(threads))
+                timestamp_message("    " + ("sequential" if maximum_pending == 0 else "threads=" + str(threads)) +
+                                  (", ordered" if is_ordered else ", unordered") +
+                                  ": " + str(len(crawled_paths)) + " folders in " +
+                                  "{0:.3f}".format(elapsed_seconds) + " seconds, speedup=" +
+                                  "{0:.1f}".format(sequential_seconds / elapsed_seconds) + "x")
+
+
+def do_benchmarks():
+    benchmark_folder = tempfile.mkdtemp(prefix="fairfax-grouper-benchmark-")
+    try:
+        benchmark_md5_sums(benchmark_folder)
+        benchmark_move_or_copy(benchmark_folder)
+        benchmark_fairfax_file_memory()
+        benchmark_directory_crawl(benchmark_folder)
+    finally:
+        shutil.rmtree(benchmark_folder)
+
+
 def main():
     determine_if_sun_os()
     parsed_arguments = parse_parameters()
@@ -867,6 +4370,8 @@ def main():
 
     if test:
         do_tests()
+    elif benchmark:
+        do_benchmarks()
     elif not unacceptable_parameters:
         processing_loop()
 
@@ -5,19 +5,33 @@
 # daily-file-usage-report.py
 # Requires source_folder, reports_folder.
 # Uses number_previous_days.
-# Optional create_reports_folder, include_file_details_in_console_output, verbose, test, debug.
+# Optional create_reports_folder, include_file_details_in_console_output, crawl_threads, verbose, test, debug.
 
 import argparse
 import datetime
+import hashlib
+import io
+import mmap
 import os
 import platform
 import subprocess
 import sys
 import time
 
+try:
+    import concurrent.futures
+except ImportError:
+    # Python 2.7 only has concurrent.futures when the 'futures' backport is installed
+    concurrent = None
+
+# The directory crawler is shared by the scripts in this repository, and kept in the utilities folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "utilities"))
+from parallel_directory_crawler import ParallelDirectoryCrawler
+
 is_sun_os = False
 unacceptable_parameters = False
 source_folder = ""
+crawl_threads = 1
 reports_folder = ""
 
 DATE_PARSE_FORMAT = "%Y%m%d"
@@ -31,6 +45,11 @@ REPLACEMENT_FILE_PATH_SEPARATOR = "_"
 
 ZERO_LENGTH_FILE_MD5_HASH = "d41d8cd98f00b204e9800998ecf8427e"
 
+# md5 sums are calculated in-process. Files are read into a reused buffer, unless they are large enough that mapping
+# them into memory is cheaper than copying them through the buffer.
+MD5_READ_BUFFER_SIZE = 1024 * 1024
+MD5_MMAP_THRESHOLD_SIZE = 64 * 1024 * 1024
+
 CSV_COLUMN_SEPARATOR_CHARACTER = "|"
 CSV_COLUMN_SEPARATOR = CSV_COLUMN_SEPARATOR_CHARACTER + " "
 
@@ -84,6 +103,9 @@ def parse_parameters():
                         action='store_true', help="Include first-level root subdirectories that start with a '.'")
     parser.add_argument('--ignore_unchanged_directories', dest='ignore_unchanged_directories',
                         action='store_true', help="Do not report changes for directories that haven't changed.")
+    parser.add_argument('--crawl_threads', type=int, default=1,
+                        help='The number of threads used to list the folders and get the file sizes. The default ' +
+                             'is 1, which lists folders one at a time.')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Indicates that operations will be done in a verbose manner. ' +
                              'NOTE: This means that no csv report file will be generated.')
@@ -112,6 +134,7 @@ def display_parameter_values():
     print("    include_dot_directories=" + str(include_dot_directories))
     print("    ignore_unchanged_directories=" + str(ignore_unchanged_directories))
     print("    calculate_md5_hash=" + str(calculate_md5_hash))
+    print("    crawl_threads=" + str(crawl_threads))
     print("    verbose=" + str(verbose))
     print("    debug=" + str(debug))
     print("    test=" + str(test))
@@ -139,6 +162,8 @@ def process_parameters(parsed_arguments):
     include_dot_directories = parsed_arguments.include_dot_directories
     global ignore_unchanged_directories
     ignore_unchanged_directories = parsed_arguments.ignore_unchanged_directories
+    global crawl_threads
+    crawl_threads = parsed_arguments.crawl_threads
     global verbose
     verbose = parsed_arguments.verbose
     global debug
@@ -156,6 +181,16 @@ def process_parameters(parsed_arguments):
         print("ERROR number_previous_days=" + str(number_previous_days) + " must be >= 0")
         unacceptable_parameters = True
 
+    if crawl_threads < 1:
+        print("")
+        print("ERROR crawl_threads=" + str(crawl_threads) + " must be >= 1")
+        unacceptable_parameters = True
+    elif crawl_threads > 1 and concurrent is None:
+        print("")
+        print("ERROR crawl_threads=" + str(crawl_threads) + " requires concurrent.futures (for Python 2.7 install " +
+              "the 'futures' package)")
+        unacceptable_parameters = True
+
     print("")
 
     if verbose and not is_sun_os:
@@ -259,9 +294,9 @@ class DirectoryStatistics:
 
     @staticmethod
     def handle_os_walk_error(exception_instance):
-        print("ERROR: trying file=" + exception_instance.filename)
-        print("ERROR: exception_instance.args=" + exception_instance.args)
-        print("ERROR: type(exception_instance)=" + type(exception_instance))
+        print("ERROR: trying file=" + str(exception_instance.filename))
+        print("ERROR: exception_instance.args=" + str(exception_instance.args))
+        print("ERROR: type(exception_instance)=" + str(type(exception_instance)))
 
     @classmethod
     def calculate_for_directory(cls, root_directory):
@@ -272,19 +307,20 @@ class DirectoryStatistics:
         files_list = []
         the_number_of_folders = 0
         already_processed_directories = set()
-        for dirpath, dirnames, filenames in os.walk(root_directory, onerror=DirectoryStatistics.handle_os_walk_error):
+        for dirpath, file_entries in walk_directory(root_directory, DirectoryStatistics.handle_os_walk_error):
             print_debug("processing dirpath=" + dirpath)
             if dirpath in already_processed_directories:
                 print_debug("already processed dirpath=" + dirpath)
             else:
                 already_processed_directories.add(dirpath)
                 the_number_of_folders += 1
-                for the_filename in filenames:
+                for file_entry in file_entries:
+                    the_filename = file_entry.name
                     print_debug("processing the_filename=" + the_filename)
                     the_number_of_files += 1
-                    file_path = os.path.join(dirpath, the_filename)
-                    file_size = os.path.getsize(file_path)
-                    file_creation_date = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
+                    file_path = file_entry.path
+                    file_size = file_entry.stat().st_size
+                    file_creation_date = datetime.datetime.fromtimestamp(file_entry.stat().st_mtime)
                     file_md5_hash = get_md5_sum(file_path) if calculate_md5_hash else "<not-calculated>"
                     file_statistics = FileStatistics(the_filename, dirpath, file_size, file_creation_date, file_md5_hash)
                     files_list.append(file_statistics)
@@ -429,6 +465,54 @@ def make_directory_path(directory_path):
         os.makedirs(directory_path)
 
 
+# A file or folder in a directory, which keeps the stat of the file once it has been done
+class ListedDirectoryEntry:
+    def __init__(self, directory_path, name):
+        self.name = name
+        self.path = os.path.join(directory_path, name)
+        self.entry_stat = None
+
+    def stat(self):
+        if self.entry_stat is None:
+            self.entry_stat = os.stat(self.path)
+        return self.entry_stat
+
+
+# The (directory_entries, file_entries) of the directory, each sorted by name. Like os.walk, symbolic links to
+# directories are neither walked nor counted as files. Files are stat-ed here, so that it's done by the crawler's
+# threads.
+def read_directory(directory_path):
+    directory_entries = []
+    file_entries = []
+    for name in sorted(os.listdir(directory_path)):
+        entry = ListedDirectoryEntry(directory_path, name)
+        if not os.path.isdir(entry.path):
+            try:
+                entry.stat()
+            except OSError:
+                # Reported when the file's size is needed, as it would be without the crawler
+                pass
+            file_entries.append(entry)
+        elif not os.path.islink(entry.path):
+            directory_entries.append(entry)
+    return directory_entries, file_entries
+
+
+# Yields (dirpath, file_entries) for each directory under the root directory, using a ParallelDirectoryCrawler when
+# crawl_threads is more than 1
+def walk_directory(root_directory, onerror):
+    if crawl_threads > 1:
+        crawler = ParallelDirectoryCrawler(crawl_threads, read_directory)
+        try:
+            for dirpath, directory_entries, file_entries in crawler.walk(root_directory, onerror=onerror):
+                yield dirpath, file_entries
+        finally:
+            crawler.close()
+    else:
+        for dirpath, dirnames, filenames in os.walk(root_directory, onerror=onerror):
+            yield dirpath, [ListedDirectoryEntry(dirpath, file_name) for file_name in filenames]
+
+
 def immediate_subdirectories(root_directory):
     the_subdirectories = []
     for name in os.listdir(root_directory):
@@ -560,32 +644,50 @@ def get_all_files(root_directory_path):
     return all_files
 
 
+md5_read_buffer = bytearray(MD5_READ_BUFFER_SIZE)
+
+
+def calculate_md5_sum(the_file):
+    md5_hash = hashlib.md5()
+    with io.open(the_file, "rb", buffering=0) as file_to_hash:
+        file_size = os.fstat(file_to_hash.fileno()).st_size
+        if file_size >= MD5_MMAP_THRESHOLD_SIZE:
+            mapped_file = mmap.mmap(file_to_hash.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                md5_hash.update(mapped_file)
+            finally:
+                mapped_file.close()
+        else:
+            read_buffer_view = memoryview(md5_read_buffer)
+            bytes_read = file_to_hash.readinto(md5_read_buffer)
+            while bytes_read:
+                md5_hash.update(read_buffer_view[:bytes_read])
+                bytes_read = file_to_hash.readinto(md5_read_buffer)
+
+    return md5_hash.hexdigest()
+
+
 def get_md5_sum(the_file):
     max_attempts = 6
     attempt_count = 0
     time_delay_factors = [0.0, 0.3, 0.9, 4.0, 60.0, 120.0]
     is_successful_md5 = False
+    last_exception = None
     md5sum = ""
 
     # We'll try 5 times
     while not is_successful_md5 and attempt_count < max_attempts:
         attempt_count += 1
-        output = "<no-output-provided>"
         try:
-            if is_sun_os:
-                output = subprocess.check_output(["digest", "-a", "md5", "-v", the_file])
-                md5sum = str(output).split(" ")[3]
-            else:
-                output = subprocess.check_output(["md5sum", the_file])
-                md5sum = str(output).split(" ")[0]
-
+            md5sum = calculate_md5_sum(the_file)
             is_successful_md5 = True
 
-        except subprocess.CalledProcessError:
+        except (IOError, OSError) as md5_exception:
+            last_exception = md5_exception
             print("")
             timestamp_message("WARNING md5 sum (attempt " + str(attempt_count) + "/" + str(max_attempts) +
                               " FAILED for file=" + the_file)
-            timestamp_message("    output=" + output)
+            timestamp_message("    error=" + str(md5_exception))
             if attempt_count < max_attempts:
                 delay = time_delay_factors[attempt_count]
                 timestamp_message("    delaying next md5 sum attempt for " + str(delay) + " seconds.")
@@ -596,7 +698,7 @@ def get_md5_sum(the_file):
 
     if not is_successful_md5:
         # re-throw the last exception -- there's something more serious happening
-        raise
+        raise last_exception
 
     return md5sum
 
@@ -4,7 +4,7 @@
 
 # bulk-file-rename.py
 # Requires source_folder, file_name_portion_to_replace, file_name_portion_replacement.
-# Optional verbose, test, debug.
+# Optional crawl_threads, verbose, test, debug.
 
 import argparse
 import datetime
@@ -13,9 +13,19 @@ import platform
 import subprocess
 import sys
 
+try:
+    import concurrent.futures
+except ImportError:
+    # Python 2.7 only has concurrent.futures when the 'futures' backport is installed
+    concurrent = None
+
+# The directory crawler is shared by the scripts in this repository, and kept in this folder
+from parallel_directory_crawler import ParallelDirectoryCrawler
+
 is_sun_os = False
 unacceptable_parameters = False
 source_folder = ""
+crawl_threads = 1
 
 DATE_PARSE_FORMAT = "%Y%m%d"
 DATE_DISPLAY_FORMAT = "%Y-%m-%d"
@@ -39,6 +49,9 @@ def parse_parameters():
                         help='The portion of the filename that will be replacement.')
     parser.add_argument('--file_name_portion_replacement', type=str, required=False,
                         help='The replacement portion of the filename. If not specified, then an empty string is used.')
+    parser.add_argument('--crawl_threads', type=int, default=1,
+                        help='The number of threads used to list the folders. The default is 1, which lists ' +
+                             'folders one at a time.')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Indicates that operations will be done in a verbose manner. ' +
                              'NOTE: This means that no csv report file will be generated.')
@@ -60,6 +73,7 @@ def display_parameter_values():
     print("    source_folder=" + source_folder)
     print("    file_name_portion_to_replace=" + file_name_portion_to_replace)
     print("    file_name_portion_replacement=" + file_name_portion_replacement)
+    print("    crawl_threads=" + str(crawl_threads))
     print("    verbose=" + str(verbose))
     print("    debug=" + str(debug))
     print("    test=" + str(test))
@@ -77,6 +91,8 @@ def process_parameters(parsed_arguments):
     file_name_portion_to_replace = parsed_arguments.file_name_portion_to_replace
     global file_name_portion_replacement
     file_name_portion_replacement = parsed_arguments.file_name_portion_replacement
+    global crawl_threads
+    crawl_threads = parsed_arguments.crawl_threads
     global verbose
     verbose = parsed_arguments.verbose
     global debug
@@ -106,6 +122,14 @@ def process_parameters(parsed_arguments):
         print("file_name_portion_to_replace='" + file_name_portion_to_replace + "' cannot be an empty string")
         unacceptable_parameters = True
 
+    if crawl_threads < 1:
+        print("ERROR crawl_threads=" + str(crawl_threads) + " must be >= 1")
+        unacceptable_parameters = True
+    elif crawl_threads > 1 and concurrent is None:
+        print("ERROR crawl_threads=" + str(crawl_threads) + " requires concurrent.futures (for Python 2.7 install " +
+              "the 'futures' package)")
+        unacceptable_parameters = True
+
     if unacceptable_parameters:
         print("")
         print("Parameters are incomplete or incorrect. Please try again.")
@@ -130,12 +154,42 @@ def timestamp_message(message_string):
     sys.stdout.flush()
 
 
+# A file or folder in a directory
+class ListedDirectoryEntry:
+    def __init__(self, directory_path, name):
+        self.name = name
+        self.path = os.path.join(directory_path, name)
+
+
+# The (directory_entries, file_entries) of the directory, each sorted by name. Like os.walk, symbolic links to
+# directories are neither walked nor counted as files.
+def read_directory(directory_path):
+    directory_entries = []
+    file_entries = []
+    for name in sorted(os.listdir(directory_path)):
+        entry = ListedDirectoryEntry(directory_path, name)
+        if not os.path.isdir(entry.path):
+            file_entries.append(entry)
+        elif not os.path.islink(entry.path):
+            directory_entries.append(entry)
+    return directory_entries, file_entries
+
+
 def get_all_files(root_directory_path):
     all_files = []
     timestamp_message("finding all files on path=" + root_directory_path)
-    for root, dirs, files in os.walk(root_directory_path):
-        for file_name in files:
-            all_files.append(os.path.join(root, file_name))
+    if crawl_threads > 1:
+        crawler = ParallelDirectoryCrawler(crawl_threads, read_directory)
+        try:
+            for root, directory_entries, file_entries in crawler.walk(root_directory_path, is_ordered=False):
+                for file_entry in file_entries:
+                    all_files.append(file_entry.path)
+        finally:
+            crawler.close()
+    else:
+        for root, dirs, files in os.walk(root_directory_path):
+            for file_name in files:
+                all_files.append(os.path.join(root, file_name))
     timestamp_message(str(len(all_files)) + " files found on path=" + root_directory_path)
 
     all_files.sort()
@@ -0,0 +1,150 @@
+# parallel_directory_crawler.py
+# Lists directories with a pool of threads, for walking large trees of directories on network file systems.
+# Used by fairfax-ingestion/fairfax-pre-and-post-process-grouper.py, reports/daily-file-usage-report.py and
+# utilities/bulk-file-rename.py, which add this folder to sys.path to import it.
+
+import collections
+import os
+import threading
+
+try:
+    import concurrent.futures
+except ImportError:
+    # Python 2.7 only has concurrent.futures when the 'futures' backport is installed
+    concurrent = None
+
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+
+# When directories are listed by a pool of threads, this is the most directories that are listed ahead of being used
+CRAWL_MAXIMUM_PENDING_DIRECTORIES = 1024
+# How many levels below a directory that is about to be used are listed ahead
+CRAWL_PREFETCH_DEPTH = 2
+
+
+# Lists directories with a pool of threads, so that the latency of listing (and checking the entries of) each directory
+# on a network file system overlaps with the others instead of being paid one directory at a time. read_directory is
+# run by the threads and returns the (directory_entries, file_entries) of a directory. At most maximum_pending
+# directories are listed ahead of being used.
+class ParallelDirectoryCrawler:
+    def __init__(self, crawl_threads, read_directory, maximum_pending=CRAWL_MAXIMUM_PENDING_DIRECTORIES):
+        self.read_directory = read_directory
+        self.maximum_pending = maximum_pending
+        self.pending_listings = {}
+        self.is_closed = False
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=crawl_threads)
+
+    def close(self):
+        with self.lock:
+            self.is_closed = True
+            for pending_listing in self.pending_listings.values():
+                pending_listing.cancel()
+            self.pending_listings.clear()
+        self.executor.shutdown(wait=True)
+
+    # Starts listing a directory that will be needed soon, unless enough directories are already being listed. Once it
+    # has been listed, its sub-directories (those that include_directory accepts) are prefetched too, down to depth
+    # levels below the directory, so that a deep tree isn't listed one level at a time.
+    def prefetch(self, directory_path, include_directory=None, depth=CRAWL_PREFETCH_DEPTH):
+        with self.lock:
+            if self.is_closed or directory_path in self.pending_listings or \
+                    len(self.pending_listings) >= self.maximum_pending:
+                return
+            self.pending_listings[directory_path] = self.executor.submit(self.read_and_prefetch, directory_path,
+                                                                         include_directory, depth)
+
+    def read_and_prefetch(self, directory_path, include_directory, depth):
+        directory_entries, file_entries = self.read_directory(directory_path)
+        with self.lock:
+            # Once the listing has been used, whoever used it prefetches its sub-directories, and once it has been
+            # discarded they aren't wanted
+            is_pending = directory_path in self.pending_listings
+        if is_pending and depth > 0:
+            for directory_entry in directory_entries:
+                if include_directory is None or include_directory(directory_entry):
+                    self.prefetch(directory_entry.path, include_directory, depth - 1)
+        return directory_entries, file_entries
+
+    # The (directory_entries, file_entries) of the directory, waiting for them if the directory was prefetched
+    def listing(self, directory_path):
+        with self.lock:
+            pending_listing = self.pending_listings.pop(directory_path, None)
+        if pending_listing is None:
+            return self.read_directory(directory_path)
+        return pending_listing.result()
+
+    # Drops the prefetched listings of a directory that won't be used, and of any directories below it
+    def discard(self, directory_path):
+        directory_prefix = os.path.join(directory_path, "")
+        with self.lock:
+            discarded_paths = [pending_path for pending_path in self.pending_listings
+                               if pending_path == directory_path or pending_path.startswith(directory_prefix)]
+            for discarded_path in discarded_paths:
+                self.pending_listings.pop(discarded_path).cancel()
+
+    # Like a top-down os.walk, yields (directory_path, directory_entries, file_entries) for each directory, and removing
+    # entries from directory_entries stops those directories being walked. With is_ordered, the directories are
+    # yielded in the same order as a sequential walk would yield them; otherwise each directory is yielded as soon as
+    # it has been listed. onerror is called with the OSError of any directory that can't be listed. include_directory
+    # should accept the directory entries that the caller doesn't remove, so that the directories listed ahead of being
+    # used are only those that the caller will walk.
+    def walk(self, root_directory_path, onerror=None, is_ordered=True, include_directory=None):
+        if is_ordered:
+            walk_listings = self.ordered_listings(root_directory_path, include_directory)
+        else:
+            walk_listings = self.unordered_listings(root_directory_path)
+        for directory_path, listing_exception, directory_entries, file_entries in walk_listings:
+            if listing_exception is not None:
+                if onerror is not None:
+                    onerror(listing_exception)
+                continue
+            yield directory_path, directory_entries, file_entries
+
+    def ordered_listings(self, root_directory_path, include_directory):
+        directory_paths = [root_directory_path]
+        while directory_paths:
+            directory_path = directory_paths.pop()
+            try:
+                directory_entries, file_entries = self.listing(directory_path)
+            except OSError as listing_exception:
+                yield directory_path, listing_exception, None, None
+                continue
+            # The walk's caller can remove entries from directory_entries before this carries on
+            listed_entries = list(directory_entries)
+            yield directory_path, None, directory_entries, file_entries
+            walked_paths = set(directory_entry.path for directory_entry in directory_entries)
+            for directory_entry in listed_entries:
+                if directory_entry.path not in walked_paths:
+                    self.discard(directory_entry.path)
+            for directory_entry in directory_entries:
+                self.prefetch(directory_entry.path, include_directory)
+            directory_paths.extend(reversed([directory_entry.path for directory_entry in directory_entries]))
+
+    def unordered_listings(self, root_directory_path):
+        completed_listings = queue.Queue()
+
+        def read_directory_into_queue(directory_path):
+            try:
+                completed_listings.put((directory_path, None) + tuple(self.read_directory(directory_path)))
+            except Exception as listing_exception:
+                completed_listings.put((directory_path, listing_exception, None, None))
+
+        waiting_paths = collections.deque([root_directory_path])
+        running_count = 0
+        while waiting_paths or running_count:
+            while waiting_paths and running_count < self.maximum_pending:
+                self.executor.submit(read_directory_into_queue, waiting_paths.popleft())
+                running_count += 1
+            directory_path, listing_exception, directory_entries, file_entries = completed_listings.get()
+            running_count -= 1
+            if listing_exception is not None:
+                if not isinstance(listing_exception, OSError):
+                    raise listing_exception
+                yield directory_path, listing_exception, None, None
+                continue
+            yield directory_path, None, directory_entries, file_entries
+            waiting_paths.extend(directory_entry.path for directory_entry in directory_entries)